@@ -0,0 +1,237 @@
+import os
+import json
+import hashlib
+import argparse
+import threading
+
+import numpy as np
+
+from cache import normalize_query
+from db import db_connection
+
+
+ANSWER_CACHE_ENABLED = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() == "true"
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", str(7 * 24 * 3600)))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "100000"))
+# Expired and least recently hit entries are deleted after this many stores per process
+ANSWER_CACHE_EVICT_EVERY = int(os.getenv("ANSWER_CACHE_EVICT_EVERY", "100"))
+# Reuse the answer of another query that retrieved the same documents when the query
+# embeddings are at least this similar, 0 only matches identical normalized queries
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0"))
+ANSWER_CACHE_NEAR_CANDIDATES = int(os.getenv("ANSWER_CACHE_NEAR_CANDIDATES", "50"))
+
+# Verdicts reused with the answer, PENDING and UNKNOWN answers are judged again.
+# NON_RELEVANT answers are never served from the cache, they are generated again and replaced.
+FINAL_RELEVANCE = ("RELEVANT", "PARTLY_RELEVANT", "NON_RELEVANT")
+
+ANSWER_CACHE_DDL = """
+CREATE TABLE IF NOT EXISTS answer_cache (
+    cache_key TEXT PRIMARY KEY,
+    scope_key TEXT NOT NULL,
+    normalized_query TEXT NOT NULL,
+    doc_ids TEXT[] NOT NULL,
+    model_used TEXT NOT NULL,
+    prompt_version TEXT NOT NULL,
+    query_vector FLOAT4[],
+    answer TEXT NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    total_tokens INTEGER NOT NULL,
+    relevance TEXT NOT NULL,
+    relevance_explanation TEXT NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_hit_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+);
+CREATE INDEX IF NOT EXISTS answer_cache_scope_idx ON answer_cache (scope_key, last_hit_at);
+CREATE INDEX IF NOT EXISTS answer_cache_last_hit_idx ON answer_cache (last_hit_at);
+"""
+
+ENTRY_COLUMNS = [
+    "cache_key", "normalized_query", "answer", "prompt_tokens", "completion_tokens", "total_tokens",
+    "relevance", "relevance_explanation",
+]
+
+LOOKUP_SQL = f"""
+    UPDATE answer_cache SET hits = hits + 1, last_hit_at = CURRENT_TIMESTAMP
+    WHERE cache_key = %s AND expires_at > CURRENT_TIMESTAMP AND relevance <> 'NON_RELEVANT'
+    RETURNING {", ".join(ENTRY_COLUMNS)}
+"""
+
+NEAR_CANDIDATES_SQL = f"""
+    SELECT {", ".join(ENTRY_COLUMNS)}, query_vector
+    FROM answer_cache
+    WHERE scope_key = %s AND expires_at > CURRENT_TIMESTAMP AND query_vector IS NOT NULL
+      AND relevance <> 'NON_RELEVANT'
+    ORDER BY last_hit_at DESC
+    LIMIT %s
+"""
+
+HIT_SQL = """
+    UPDATE answer_cache SET hits = hits + 1, last_hit_at = CURRENT_TIMESTAMP
+    WHERE cache_key = %s
+"""
+
+STORE_SQL = """
+    INSERT INTO answer_cache (
+        cache_key, scope_key, normalized_query, doc_ids, model_used, prompt_version, query_vector, answer,
+        prompt_tokens, completion_tokens, total_tokens, relevance, relevance_explanation, expires_at
+    )
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, CURRENT_TIMESTAMP + %s * INTERVAL '1 second')
+    ON CONFLICT (cache_key) DO UPDATE SET
+        query_vector = EXCLUDED.query_vector, answer = EXCLUDED.answer,
+        prompt_tokens = EXCLUDED.prompt_tokens, completion_tokens = EXCLUDED.completion_tokens,
+        total_tokens = EXCLUDED.total_tokens, relevance = EXCLUDED.relevance,
+        relevance_explanation = EXCLUDED.relevance_explanation, hits = 0,
+        created_at = CURRENT_TIMESTAMP, last_hit_at = CURRENT_TIMESTAMP, expires_at = EXCLUDED.expires_at
+"""
+
+# A verdict never overwrites a final one, so a late PENDING or UNKNOWN cannot undo it
+UPDATE_RELEVANCE_SQL = f"""
+    UPDATE answer_cache SET relevance = %s, relevance_explanation = %s
+    WHERE cache_key = %s AND relevance NOT IN {FINAL_RELEVANCE}
+"""
+
+EVICT_SQL = """
+    DELETE FROM answer_cache
+    WHERE expires_at <= CURRENT_TIMESTAMP
+       OR cache_key IN (SELECT cache_key FROM answer_cache ORDER BY last_hit_at DESC OFFSET %s)
+"""
+
+_stores = {'count': 0}
+_stores_lock = threading.Lock()
+
+
+def create_answer_cache(cur):
+    cur.execute(ANSWER_CACHE_DDL)
+
+
+def hash_key(*parts):
+    return hashlib.sha256(json.dumps(parts, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class CacheRef:
+    """ Where an answer is (or would be) cached: the query, the documents it was built from and the model """
+
+    def __init__(self, query, search_results, model_choice, prompt_version, query_vector=None):
+        self.normalized_query = normalize_query(query)
+        self.doc_ids = sorted(str(doc.get('id')) for doc in search_results)
+        self.model_choice = model_choice
+        self.prompt_version = prompt_version
+        self.query_vector = query_vector
+        # Everything but the query, near-duplicates are only looked for within one scope
+        self.scope_key = hash_key(self.doc_ids, model_choice, prompt_version)
+        self.key = hash_key(self.normalized_query, self.scope_key)
+
+
+def near_duplicates_enabled():
+    return ANSWER_CACHE_SIMILARITY > 0
+
+
+def entry_from_row(row):
+    return dict(zip(ENTRY_COLUMNS, row))
+
+
+def lookup(ref):
+    """ The cached entry for ref, or the most similar one in its scope, None on a miss """
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(LOOKUP_SQL, (ref.key,))
+            row = cur.fetchone()
+            if row is None and near_duplicates_enabled() and ref.query_vector is not None:
+                row = nearest(cur, ref)
+        conn.commit()
+    return entry_from_row(row) if row is not None else None
+
+
+def nearest(cur, ref):
+    cur.execute(NEAR_CANDIDATES_SQL, (ref.scope_key, ANSWER_CACHE_NEAR_CANDIDATES))
+    candidates = cur.fetchall()
+    if not candidates:
+        return None
+    vectors = np.array([row[-1] for row in candidates], dtype=np.float32)
+    query = np.asarray(ref.query_vector, dtype=np.float32)
+    similarities = vectors @ query / (np.linalg.norm(vectors, axis=1) * np.linalg.norm(query) + 1e-12)
+    best = int(np.argmax(similarities))
+    if similarities[best] < ANSWER_CACHE_SIMILARITY:
+        return None
+    row = candidates[best][:-1]
+    cur.execute(HIT_SQL, (row[0],))
+    return row
+
+
+def store(ref, answer_data):
+    vector = None
+    if ref.query_vector is not None:
+        vector = [float(x) for x in ref.query_vector]
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(STORE_SQL, (
+                ref.key, ref.scope_key, ref.normalized_query, ref.doc_ids, ref.model_choice, ref.prompt_version,
+                vector, answer_data['answer'], answer_data['prompt_tokens'], answer_data['completion_tokens'],
+                answer_data['total_tokens'], answer_data['relevance'], answer_data['relevance_explanation'],
+                ANSWER_CACHE_TTL,
+            ))
+        conn.commit()
+
+    with _stores_lock:
+        _stores['count'] += 1
+        due = _stores['count'] % ANSWER_CACHE_EVICT_EVERY == 0
+    if due:
+        evict()
+
+
+def update_relevance(cache_key, relevance, explanation):
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(UPDATE_RELEVANCE_SQL, (relevance, explanation, cache_key))
+        conn.commit()
+
+
+def evict(max_entries=ANSWER_CACHE_MAX_ENTRIES):
+    """ Delete expired entries and the least recently hit ones above max_entries """
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute(EVICT_SQL, (max_entries,))
+            deleted = cur.rowcount
+        conn.commit()
+    if deleted:
+        print(f"Evicted {deleted} cached answers")
+    return deleted
+
+
+def clear():
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("TRUNCATE answer_cache")
+        conn.commit()
+
+
+def stats():
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT COUNT(*), COALESCE(SUM(hits), 0), COUNT(*) FILTER (WHERE expires_at <= CURRENT_TIMESTAMP)
+                FROM answer_cache
+            """)
+            entries, hits, expired = cur.fetchone()
+    return {'entries': entries, 'hits': hits, 'expired': expired}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Persistent answer cache")
+    parser.add_argument("command", choices=["stats", "evict", "clear"])
+    args = parser.parse_args()
+
+    if args.command == "stats":
+        print(stats())
+    elif args.command == "evict":
+        print(f"Deleted {evict()} entries")
+    else:
+        clear()
+        print("Answer cache cleared")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import os
+import json
+
+import requests
+
+
+ANSWER_SERVICE_URL = os.getenv("ANSWER_SERVICE_URL", "")
+# Seconds to wait for the service to send the next line, not for the whole answer
+ANSWER_SERVICE_TIMEOUT = float(os.getenv("ANSWER_SERVICE_TIMEOUT", "90"))
+
+_session = requests.Session()
+
+
+def service_url(path):
+    return ANSWER_SERVICE_URL.rstrip("/") + path
+
+
+def raise_for_error(response):
+    if response.status_code >= 400:
+        try:
+            message = response.json().get("error")
+        except ValueError:
+            message = response.text
+        raise RuntimeError(f"Answer service returned {response.status_code}: {message}")
+
+
+def stream_answer(query, group, model_choice, search_type, conversation_id=None):
+    """ Same contract as assistant.get_answer_stream, answer_data also gets the conversation_id the service saved """
+    answer_data = {}
+
+    def generate():
+        payload = {
+            "question": query,
+            "group": group,
+            "model_choice": model_choice,
+            "search_type": search_type,
+            "conversation_id": conversation_id,
+        }
+        with _session.post(service_url("/answer/stream"), json=payload, stream=True, timeout=ANSWER_SERVICE_TIMEOUT) as response:
+            raise_for_error(response)
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                message = json.loads(line)
+                if "token" in message:
+                    yield message["token"]
+                elif "error" in message:
+                    raise RuntimeError(f"Answer failed: {message['error']}")
+                else:
+                    answer_data.update(message["answer_data"])
+                    answer_data["conversation_id"] = message["conversation_id"]
+
+    return generate(), answer_data
+
+
+def send_feedback(conversation_id, feedback):
+    response = _session.post(
+        service_url("/feedback"), json={"conversation_id": conversation_id, "feedback": feedback},
+        timeout=ANSWER_SERVICE_TIMEOUT
+    )
+    raise_for_error(response)
+
+
+def get_recent_conversations(limit=5, relevance=None):
+    params = {"limit": limit}
+    if relevance:
+        params["relevance"] = relevance
+    response = _session.get(service_url("/conversations/recent"), params=params, timeout=ANSWER_SERVICE_TIMEOUT)
+    raise_for_error(response)
+    return response.json()
+
+
+def get_feedback_stats():
+    response = _session.get(service_url("/feedback/stats"), timeout=ANSWER_SERVICE_TIMEOUT)
+    raise_for_error(response)
+    return response.json()
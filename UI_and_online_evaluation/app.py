@@ -1,17 +1,45 @@
+import os
 import streamlit as st
 import time
 import uuid
 
-from assistant import get_answer
-from db import save_conversation, save_feedback, get_recent_conversations, get_feedback_stats
+# With an answer service the app only renders, search, the LLM and the database are behind HTTP
+ANSWER_SERVICE_URL = os.getenv("ANSWER_SERVICE_URL", "")
+
+if ANSWER_SERVICE_URL:
+    from answer_client import get_feedback_stats, get_recent_conversations, send_feedback, stream_answer
+else:
+    from assistant import get_answer_stream, warm_up
+    from db import get_recent_conversations, get_feedback_stats
+    from batch_writer import get_batch_writer
+    from relevance_worker import submit_relevance_evaluation
+    from tracing import start_exporter
 
 
 def print_log(message):
     print(message, flush=True)
 
 
+@st.cache_resource
+def warm_up_assistant():
+    # Once per process, not once per session or rerun
+    if ANSWER_SERVICE_URL:
+        print_log(f"Using the answer service at {ANSWER_SERVICE_URL}")
+        return
+    warm_up()
+    start_exporter()
+
+
+def save_feedback(conversation_id, feedback):
+    if ANSWER_SERVICE_URL:
+        send_feedback(conversation_id, feedback)
+    else:
+        get_batch_writer().save_feedback(conversation_id, feedback)
+
+
 def main():
     print_log("Starting the Vietnamese chatbot application")
+    warm_up_assistant()
     st.title("Vietnamese chatbot")
 
     # Session state initialization
@@ -51,15 +79,22 @@ def main():
         with st.spinner('Processing...'):
             print_log(f"Getting answer from assistant using {model_choice} model and {search_type} search")
             start_time = time.time()
-            answer_data = get_answer(user_input, group, model_choice, search_type)
+            if ANSWER_SERVICE_URL:
+                tokens, answer_data = stream_answer(user_input, group, model_choice, search_type, st.session_state.conversation_id)
+            else:
+                tokens, answer_data = get_answer_stream(user_input, group, model_choice, search_type)
+            st.write_stream(tokens)
             end_time = time.time()
             print_log(f"Answer received in {end_time - start_time:.2f} seconds")
-            st.success("Completed!")
+            print_log(f"Stage timings: {answer_data.get('stage_timings')}")
+            st.success("Completed!" if not answer_data.get('cache_hit') else "Completed! (cached answer)")
             print(answer_data)
-            st.write(answer_data['answer'])
             
             # Display monitoring information
             st.write(f"Response time: {answer_data['response_time']:.2f} seconds")
+            st.write(f"Time to first token: {answer_data['time_to_first_token']:.2f} seconds")
+            if answer_data['tokens_per_second']:
+                st.write(f"Tokens per second: {answer_data['tokens_per_second']:.1f}")
             st.write(f"Relevance: {answer_data['relevance']}")
             st.write(f"Explanation: {answer_data['relevance_explanation']}")
             st.write(f"Model used: {answer_data['model_used']}")
@@ -67,10 +102,25 @@ def main():
             if answer_data['groq_cost'] > 0:
                 st.write(f"Groq cost: ${answer_data['groq_cost']:.4f}")
 
-            # Save conversation to database
-            print_log("Saving conversation to database")
-            save_conversation(st.session_state.conversation_id, user_input, answer_data, group)
-            print_log("Conversation saved successfully")
+            if ANSWER_SERVICE_URL:
+                # The service saved it and queued the judge, feedback goes to the id it was saved under
+                st.session_state.conversation_id = answer_data['conversation_id']
+                print_log(f"Conversation saved by the answer service as {answer_data['conversation_id']}")
+            else:
+                # Save conversation to database
+                print_log("Saving conversation to database")
+                # The judge is queued once the row has been written under its final id,
+                # a cached answer that was already judged keeps its verdict
+                on_saved = None
+                if answer_data['relevance'] == "PENDING":
+                    on_saved = lambda conversation_id: submit_relevance_evaluation(
+                        conversation_id, user_input, answer_data['answer'], answer_data.get('cache_key')
+                    )
+                # Every answer is its own conversation, feedback goes to the id it was queued under
+                st.session_state.conversation_id = get_batch_writer().save_conversation(
+                    None, user_input, answer_data, group, on_saved=on_saved
+                )
+                print_log(f"Conversation queued for saving as {st.session_state.conversation_id}")
 
     # Feedback buttons
     col1, col2 = st.columns(2)
@@ -79,19 +129,19 @@ def main():
             st.session_state.count += 1
             print_log(f"Positive feedback received. New count: {st.session_state.count}")
             save_feedback(st.session_state.conversation_id, 1)
-            print_log("Positive feedback saved to database")
+            print_log("Positive feedback queued for saving")
     with col2:
         if st.button("-1"):
             st.session_state.count -= 1
             print_log(f"Negative feedback received. New count: {st.session_state.count}")
             save_feedback(st.session_state.conversation_id, -1)
-            print_log("Negative feedback saved to database")
+            print_log("Negative feedback queued for saving")
 
     st.write(f"Current count: {st.session_state.count}")
 
     # Display recent conversations
     st.subheader("Recent Conversations")
-    relevance_filter = st.selectbox("Filter by relevance:", ["All", "RELEVANT", "PARTLY_RELEVANT", "NON_RELEVANT", "UNKNOWN"])
+    relevance_filter = st.selectbox("Filter by relevance:", ["All", "RELEVANT", "PARTLY_RELEVANT", "NON_RELEVANT", "UNKNOWN", "PENDING"])
     recent_conversations = get_recent_conversations(limit=5, relevance=relevance_filter if relevance_filter != "All" else None)
     for conv in recent_conversations:
         st.write(f"Q: {conv['question']}")
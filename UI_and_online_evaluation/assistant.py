@@ -1,38 +1,203 @@
 import os
 import time
 import json
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from groq import Groq
 
 from elasticsearch import Elasticsearch
-from sentence_transformers import SentenceTransformer
+
+import answer_cache
+from answer_cache import ANSWER_CACHE_ENABLED, FINAL_RELEVANCE
+from cache import TTLCache, normalize_query
+from prompt_budget import assemble_context, count_tokens
+from rerank import rerank
+from tracing import record, span, trace
 
 
 ELASTIC_URL = os.getenv("ELASTIC_URL", "http://elasticsearch:9200")
 GROQ_API_KEY = os.getenv("GROQ_API_KEY", "your-api-key-here")
+INDEX_NAME = os.getenv("INDEX_NAME", "vietnamese-questions")
+VECTOR_BACKEND = os.getenv("VECTOR_BACKEND", "elasticsearch")
+# "group" searches the per-group index prep.py creates instead of filtering one index by group
+INDEX_PARTITIONING = os.getenv("INDEX_PARTITIONING", "none")
+# Used for groups and k without an entry in the num_candidates profile written by knn_profile.py
+KNN_NUM_CANDIDATES = int(os.getenv("KNN_NUM_CANDIDATES", "10000"))
+KNN_PROFILE_PATH = os.getenv("KNN_PROFILE_PATH", "knn_profile.json")
+JUDGE_MODEL = 'groq/llama3-8b-8192'
+QUERY_MODEL_NAME = os.getenv("QUERY_MODEL_NAME", "paraphrase-multilingual-MiniLM-L12-v2")
+# torch (SentenceTransformer) or onnx (int8 export from encoder.py)
+QUERY_ENCODER = os.getenv("QUERY_ENCODER", "torch")
+
+# Prompt token budgets, leaving room for the completion in each model's 8k context
+PROMPT_TOKEN_BUDGETS = {
+    'groq/llama3-8b-8192': 6000,
+    'groq/gemma2-9b-it': 6000,
+    'groq/gemma-7b-it': 6000,
+}
+DEFAULT_PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "6000"))
+PROMPT_SELECT_SENTENCES = os.getenv("PROMPT_SELECT_SENTENCES", "false").lower() == "true"
+PROMPT_MAX_CONTEXT_TOKENS = int(os.getenv("PROMPT_MAX_CONTEXT_TOKENS", "600"))
+
+PROMPT_TEMPLATE = """
+You're an assistant working in customer service. Your job is to provide answers to users' questions. Answer the QUESTION based on the CONTEXT from the documents database.
+Use only the facts from the CONTEXT when answering the QUESTION. Provide answer in Vietnamese , in normal text form, not using any markdown form, no need to rewrite the question and make sure that is an answer, not listing questions. Also make sure that the answer provides most information from the CONTEXT as possible .
+
+QUESTION: {question}
+
+CONTEXT: 
+{context}
+""".strip()
+
+# Part of the answer cache key, changes whenever the template or the context settings do
+PROMPT_VERSION = hashlib.sha256(json.dumps([
+    PROMPT_TEMPLATE, PROMPT_TOKEN_BUDGETS, DEFAULT_PROMPT_TOKEN_BUDGET, PROMPT_SELECT_SENTENCES, PROMPT_MAX_CONTEXT_TOKENS
+]).encode("utf-8")).hexdigest()[:12]
+
+RERANK_ENABLED = os.getenv("RERANK_ENABLED", "false").lower() == "true"
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "20"))
+
+EMPTY_TOKENS = {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+
+# Concurrent LLM calls per get_answers_batch call
+BATCH_LLM_WORKERS = int(os.getenv("BATCH_LLM_WORKERS", "4"))
+
+CACHE_MAX_ENTRIES = int(os.getenv("CACHE_MAX_ENTRIES", "1024"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "3600"))
+CACHE_INDEX_CHECK_INTERVAL = float(os.getenv("CACHE_INDEX_CHECK_INTERVAL", "30"))
+
+# Clients and the query encoder are built on first use and shared by every thread in the process
+_clients = {}
+_client_locks = {name: threading.Lock() for name in ('groq', 'elasticsearch', 'encoder', 'knn_profile')}
+
+query_vector_cache = TTLCache(CACHE_MAX_ENTRIES, CACHE_TTL)
+search_results_cache = TTLCache(CACHE_MAX_ENTRIES, CACHE_TTL)
+_index_version = {'value': None, 'checked_at': 0.0}
+
+
+def _get_client(name, factory):
+    client = _clients.get(name)
+    if client is None:
+        with _client_locks[name]:
+            client = _clients.get(name)
+            if client is None:
+                client = _clients[name] = factory()
+    return client
 
-groq_client =  Groq(api_key = GROQ_API_KEY)
-es_client = Elasticsearch(ELASTIC_URL)
 
+def load_query_encoder():
+    if QUERY_ENCODER == "onnx":
+        from encoder import ONNX_MODEL_DIR, OnnxQueryEncoder
+        print(f"Loading ONNX query encoder from {ONNX_MODEL_DIR}")
+        return OnnxQueryEncoder(ONNX_MODEL_DIR, model_name=QUERY_MODEL_NAME)
+    from sentence_transformers import SentenceTransformer
+    print(f"Loading query encoder: {QUERY_MODEL_NAME}")
+    return SentenceTransformer(QUERY_MODEL_NAME, device="cpu")
 
-model = SentenceTransformer("paraphrase-multilingual-MiniLM-L12-v2")
+
+def get_groq_client():
+    return _get_client('groq', lambda: Groq(api_key=GROQ_API_KEY))
+
+
+def get_es_client():
+    return _get_client('elasticsearch', lambda: Elasticsearch(ELASTIC_URL))
+
+
+def get_model():
+    return _get_client('encoder', load_query_encoder)
+
+
+def set_groq_client(client):
+    _clients['groq'] = client
+
+
+def set_es_client(client):
+    _clients['elasticsearch'] = client
+
+
+def model_loaded():
+    return 'encoder' in _clients
+
+
+def warm_up():
+    """ Load the encoder (and reranker) and run one query through them, so the first user does not wait """
+    start_time = time.time()
+    get_groq_client()
+    get_es_client()
+    check_index_model()
+    get_model().encode("xin chào")
+    get_knn_profile()
+    if RERANK_ENABLED:
+        from rerank import warm_up as warm_up_rerank
+        warm_up_rerank()
+    print(f"Assistant warmed up in {time.time() - start_time:.1f}s")
 
 
 def compute_rrf(rank, k=60):
     """ Our own implementation of the relevance score """
     return 1 / (k + rank)
 
-def elastic_search_hybrid_rrf(field, query, vector, group, k=60, index_name="vietnamese-questions"):
+SOURCE_FIELDS = ["group", "context", "question", "answer", "id"]
+
+
+def group_index_name(index_name, group):
+    """ Alias of group's own index, see prep.py """
+    slug = "".join(c if c.isalnum() else "-" for c in group.lower())
+    return f"{index_name}-group-{slug}"
+
+
+def search_index(group, index_name=None):
+    """ Index (alias) to search for group, index_name overrides it """
+    if index_name:
+        return index_name
+    if INDEX_PARTITIONING == "group":
+        return group_index_name(INDEX_NAME, group)
+    return INDEX_NAME
+
+
+def group_filter(group):
+    # A per-group index holds only that group, filtering it would only slow kNN down
+    if INDEX_PARTITIONING == "group":
+        return None
+    return {"term": {"group": group}}
+
+
+def load_knn_profile(path=KNN_PROFILE_PATH):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'rt', encoding='utf-8') as f_in:
+        profile = json.load(f_in)
+    if profile.get('model') != QUERY_MODEL_NAME or profile.get('partitioning') != INDEX_PARTITIONING:
+        print(f"Ignoring {path}: measured for {profile.get('model')} with partitioning {profile.get('partitioning')}")
+        return {}
+    print(f"Loaded num_candidates profile from {path}")
+    return profile
+
+
+def get_knn_profile():
+    return _get_client('knn_profile', load_knn_profile)
+
+
+def num_candidates(field, group, k):
+    """ Smallest num_candidates that reached the target recall for group, at the nearest profiled k >= k """
+    profile = get_knn_profile()
+    if profile.get('field') != field:
+        return max(k, KNN_NUM_CANDIDATES)
+    sizes = profile['groups'].get(group, {}).get('num_candidates', {})
+    fits = [int(profiled_k) for profiled_k in sizes if int(profiled_k) >= k]
+    if not fits:
+        return max(k, KNN_NUM_CANDIDATES)
+    return max(k, sizes[str(min(fits))])
+
+
+def hybrid_search_bodies(field, query, vector, group, size=10):
     knn_query = {
         "field": field,
         "query_vector": vector,
-        "k": 10,
-        "num_candidates": 10000,
+        "k": size,
+        "num_candidates": num_candidates(field, group, size),
         "boost": 0.5,
-        "filter": {
-            "term": {
-                "group": group
-            }
-        }
     }
 
     keyword_query = {
@@ -45,107 +210,147 @@ def elastic_search_hybrid_rrf(field, query, vector, group, k=60, index_name="vie
                     "boost": 0.5,
                 }
             },
-            "filter": {
-                "term": {
-                    "group": group
-                }
-            }
         }
     }
 
-    knn_results = es_client.search(
-        index=index_name, 
-        body={
-            "knn": knn_query, 
-            "size": 10
-        }
-    )['hits']['hits']
-    
-    keyword_results = es_client.search(
-        index=index_name, 
-        body={
-            "query": keyword_query, 
-            "size": 10
-        }
-    )['hits']['hits']
-    
+    if group_filter(group) is not None:
+        knn_query["filter"] = group_filter(group)
+        keyword_query["bool"]["filter"] = group_filter(group)
+
+    knn_body = {"knn": knn_query, "size": size, "_source": SOURCE_FIELDS}
+    keyword_body = {"query": keyword_query, "size": size, "_source": SOURCE_FIELDS}
+    return knn_body, keyword_body
+
+
+def fuse_rrf(result_lists, weights, k=60, top_n=5):
+    """ Weighted reciprocal rank fusion, returns (doc_id, score, source) sorted by score """
     rrf_scores = {}
-    # Calculate RRF using vector search results
-    for rank, hit in enumerate(knn_results):
-        doc_id = hit['_id']
-        rrf_scores[doc_id] = compute_rrf(rank + 1, k)
-
-    # Adding keyword search result scores
-    for rank, hit in enumerate(keyword_results):
-        doc_id = hit['_id']
-        if doc_id in rrf_scores:
-            rrf_scores[doc_id] += compute_rrf(rank + 1, k)
-        else:
-            rrf_scores[doc_id] = compute_rrf(rank + 1, k)
+    sources = {}
+    for hits, weight in zip(result_lists, weights):
+        for rank, hit in enumerate(hits):
+            doc_id = hit['_id']
+            rrf_scores[doc_id] = rrf_scores.get(doc_id, 0) + weight * compute_rrf(rank + 1, k)
+            if hit.get('_source') is not None:
+                sources.setdefault(doc_id, hit['_source'])
+
+    reranked_docs = sorted(rrf_scores.items(), key=lambda x: x[1], reverse=True)[:top_n]
+    return [(doc_id, score, sources.get(doc_id)) for doc_id, score in reranked_docs]
+
+
+def fetch_missing_sources(fused, index_name):
+    missing = [doc_id for doc_id, _, source in fused if source is None]
+    if not missing:
+        return [source for _, _, source in fused]
+
+    # One multi-get for anything the searches did not return a _source for
+    with span("fetch_sources"):
+        docs = get_es_client().mget(index=index_name, ids=missing, _source=SOURCE_FIELDS)['docs']
+    fetched = {doc['_id']: doc['_source'] for doc in docs if doc.get('found')}
 
-    # Sort RRF scores in descending order
-    reranked_docs = sorted(rrf_scores.items(), key=lambda x: x[1], reverse=True)
-    
-    # Get top-K documents by the score
     final_results = []
-    for doc_id, score in reranked_docs[:5]:
-        doc = es_client.get(index=index_name, id=doc_id)
-        final_results.append(doc['_source'])
-    
+    for doc_id, _, source in fused:
+        if source is None:
+            source = fetched.get(doc_id)
+        if source is not None:
+            final_results.append(source)
     return final_results
 
-def elastic_search_knn(field, vector, group, index_name="vietnamese-questions"):
+
+def check_responses(responses):
+    for response in responses:
+        if 'error' in response:
+            raise RuntimeError(f"Search failed: {response['error']}")
+
+
+def hybrid_results(knn_response, keyword_response, index_name=INDEX_NAME, k=60, knn_weight=1.0, keyword_weight=1.0, top_n=5):
+    check_responses([knn_response, keyword_response])
+    knn_results = knn_response['hits']['hits']
+    keyword_results = keyword_response['hits']['hits']
+
+    with span("fuse"):
+        fused = fuse_rrf([knn_results, keyword_results], [knn_weight, keyword_weight], k, top_n)
+    return fetch_missing_sources(fused, index_name)
+
+
+def elastic_search_hybrid_rrf(field, query, vector, group, k=60, index_name=None, knn_weight=1.0, keyword_weight=1.0, top_n=5, size=10):
+    index_name = search_index(group, index_name)
+    knn_body, keyword_body = hybrid_search_bodies(field, query, vector, group, size)
+
+    # Both legs go out in one multi-search round trip
+    with span("msearch"):
+        responses = get_es_client().msearch(
+            index=index_name,
+            searches=[{}, knn_body, {}, keyword_body]
+        )['responses']
+    return hybrid_results(responses[0], responses[1], index_name, k, knn_weight, keyword_weight, top_n)
+
+
+def knn_search_body(field, vector, group, k=5, candidates=None):
+    """ candidates overrides the profiled num_candidates, see knn_profile.py """
     knn = {
         "field": field,
         "query_vector": vector,
-        "k": 5,
-        "num_candidates": 10000,
-        "filter": {"term": {"group": group}},
+        "k": k,
+        "num_candidates": candidates or num_candidates(field, group, k),
     }
+    if group_filter(group) is not None:
+        knn["filter"] = group_filter(group)
 
-    search_query = {
+    return {
         "knn": knn,
-        "_source": ["group", "context", "question", "answer", "id"],
+        "_source": SOURCE_FIELDS,
     }
 
-    es_results = es_client.search(index=index_name, body=search_query)
+
+def elastic_search_knn(field, vector, group, index_name=None, k=5):
+    es_results = get_es_client().search(index=search_index(group, index_name), body=knn_search_body(field, vector, group, k))
 
     return [hit["_source"] for hit in es_results["hits"]["hits"]]
 
 
-def build_prompt(query, search_results):
-    prompt_template = """
-You're an assistant working in customer service. Your job is to provide answers to users' questions. Answer the QUESTION based on the CONTEXT from the documents database.
-Use only the facts from the CONTEXT when answering the QUESTION. Provide answer in Vietnamese , in normal text form, not using any markdown form, no need to rewrite the question and make sure that is an answer, not listing questions. Also make sure that the answer provides most information from the CONTEXT as possible .
+def get_knn_search():
+    """ kNN retriever selected by VECTOR_BACKEND, all share elastic_search_knn's signature """
+    if VECTOR_BACKEND == "numpy":
+        from vector_search import numpy_search_knn
+        return numpy_search_knn
+    return elastic_search_knn
 
-QUESTION: {question}
-
-CONTEXT: 
-{context}
-""".strip()
 
-    context = "\n\n".join(
-        [
-            f"group: {doc['group']}\nquestion: {doc['question']}\nanswer: {doc['answer']}\ncontext: {doc['context']}"
-            for doc in search_results
-        ]
+def build_prompt_with_stats(query, search_results, model_choice=None, token_budget=None):
+    if token_budget is None:
+        token_budget = PROMPT_TOKEN_BUDGETS.get(model_choice, DEFAULT_PROMPT_TOKEN_BUDGET)
+    # Whatever the template and question leave over goes to the retrieved documents
+    context_budget = token_budget - count_tokens(PROMPT_TEMPLATE.format(question=query, context=""))
+    context, stats = assemble_context(
+        query, search_results, context_budget,
+        select_sentences=PROMPT_SELECT_SENTENCES, max_context_tokens=PROMPT_MAX_CONTEXT_TOKENS
     )
-    return prompt_template.format(question=query, context=context).strip()
+    prompt = PROMPT_TEMPLATE.format(question=query, context=context).strip()
+    stats['prompt_tokens_estimate'] = count_tokens(prompt)
+    return prompt, stats
+
+
+def build_prompt(query, search_results, model_choice=None):
+    return build_prompt_with_stats(query, search_results, model_choice)[0]
+
+
+def tokens_from_usage(usage):
+    return {
+        'prompt_tokens': usage.prompt_tokens,
+        'completion_tokens': usage.completion_tokens,
+        'total_tokens': usage.total_tokens
+    }
 
 
 def llm(prompt, model_choice):
     start_time = time.time()
     if model_choice.startswith('groq/'):
-        response = groq_client.chat.completions.create(
+        response = get_groq_client().chat.completions.create(
             model=model_choice.split('/')[-1],
             messages=[{"role": "user", "content": prompt}]
         )
         answer = response.choices[0].message.content
-        tokens = {
-            'prompt_tokens': response.usage.prompt_tokens,
-            'completion_tokens': response.usage.completion_tokens,
-            'total_tokens': response.usage.total_tokens
-        }
+        tokens = tokens_from_usage(response.usage)
     else:
         raise ValueError(f"Unknown model choice: {model_choice}")
     
@@ -155,7 +360,61 @@ def llm(prompt, model_choice):
     return answer, tokens, response_time
 
 
-def evaluate_relevance(question, answer):
+def llm_stream(prompt, model_choice, stats):
+    """ Yield answer tokens as they arrive, stats is filled in once the stream is exhausted """
+    start_time = time.time()
+    if not model_choice.startswith('groq/'):
+        raise ValueError(f"Unknown model choice: {model_choice}")
+
+    stream = get_groq_client().chat.completions.create(
+        model=model_choice.split('/')[-1],
+        messages=[{"role": "user", "content": prompt}],
+        stream=True
+    )
+
+    first_token_time = None
+    parts = []
+    usage = None
+    for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            if first_token_time is None:
+                first_token_time = time.time()
+            parts.append(chunk.choices[0].delta.content)
+            yield chunk.choices[0].delta.content
+        # Groq reports usage on the last chunk
+        x_groq = getattr(chunk, 'x_groq', None)
+        if x_groq is not None and getattr(x_groq, 'usage', None) is not None:
+            usage = x_groq.usage
+
+    stats.update(stream_stats(prompt, parts, usage, start_time, first_token_time, time.time()))
+
+
+def stream_stats(prompt, parts, usage, start_time, first_token_time, end_time):
+    if usage is not None:
+        tokens = tokens_from_usage(usage)
+    else:
+        # Rough estimate so cost tracking still works if usage is missing
+        prompt_tokens = len(prompt) // 4
+        tokens = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': len(parts),
+            'total_tokens': prompt_tokens + len(parts)
+        }
+
+    if first_token_time is None:
+        first_token_time = end_time
+    record("first_token", first_token_time - start_time)
+    generation_time = end_time - first_token_time
+    return {
+        'answer': "".join(parts),
+        'tokens': tokens,
+        'response_time': end_time - start_time,
+        'time_to_first_token': first_token_time - start_time,
+        'tokens_per_second': tokens['completion_tokens'] / generation_time if generation_time > 0 else None,
+    }
+
+
+def relevance_prompt(question, answer):
     prompt_template = """
     You are an expert evaluator for a Retrieval-Augmented Generation (RAG) system.
     Your task is to analyze the relevance of the generated answer to the given question.
@@ -176,9 +435,10 @@ def evaluate_relevance(question, answer):
     }}
     """.strip()
 
-    prompt = prompt_template.format(question=question, answer=answer)
-    evaluation, tokens, _ = llm(prompt, 'groq/llama3-8b-8192')
-    
+    return prompt_template.format(question=question, answer=answer)
+
+
+def parse_relevance(evaluation, tokens):
     try:
         json_eval = json.loads(evaluation)
         return json_eval['Relevance'], json_eval['Explanation'], tokens
@@ -191,6 +451,11 @@ def evaluate_relevance(question, answer):
             return "UNKNOWN", "Failed to parse evaluation", tokens
 
 
+def evaluate_relevance(question, answer):
+    evaluation, tokens, _ = llm(relevance_prompt(question, answer), JUDGE_MODEL)
+    return parse_relevance(evaluation, tokens)
+
+
 def calculate_groq_cost(model_choice, tokens):
     groq_cost = 0
 
@@ -201,25 +466,214 @@ def calculate_groq_cost(model_choice, tokens):
 
     return groq_cost
 
-def get_answer(query, group, model_choice, search_type):
-    if search_type == 'Vector':
-        vector = model.encode(query)
-        search_results = elastic_search_knn('question_vector', vector, group)
+def get_index_version(index_name=INDEX_NAME):
+    return index_version_from_mappings(get_es_client().indices.get_mapping(index=index_name))
+
+
+def index_version_from_mappings(mappings):
+    # With an alias the response is keyed by the concrete index name
+    return sorted(
+        (name, mapping['mappings'].get('_meta', {}).get('index_version'))
+        for name, mapping in mappings.items()
+    )
+
+
+def check_index_model(index_name=INDEX_NAME):
+    """ Warn when the index was embedded by another model than the query encoder, searches would still run but match poorly """
+    try:
+        mappings = get_es_client().indices.get_mapping(index=index_name)
+    except Exception as e:
+        print(f"Could not read index model: {e}")
+        return
+    for name, mapping in sorted(mappings.items()):
+        # Indices built before the model was recorded have no model_name
+        model_name = mapping['mappings'].get('_meta', {}).get('model_name')
+        if model_name and model_name != QUERY_MODEL_NAME:
+            print(f"WARNING: index '{name}' was embedded with {model_name}, queries are encoded with {QUERY_MODEL_NAME}")
+
+
+def invalidate_caches():
+    search_results_cache.clear()
+
+
+def index_version_check_due():
+    now = time.monotonic()
+    if now - _index_version['checked_at'] < CACHE_INDEX_CHECK_INTERVAL:
+        return False
+    _index_version['checked_at'] = now
+    return True
+
+
+def check_index_version(index_name=INDEX_NAME):
+    """ Drop cached search results once prep.py has rebuilt the index """
+    if not index_version_check_due():
+        return
+    try:
+        version = get_index_version(index_name)
+    except Exception as e:
+        print(f"Could not read index version: {e}")
+        invalidate_caches()
+        return
+    apply_index_version(version, index_name)
+
+
+def apply_index_version(version, index_name=INDEX_NAME):
+    if version != _index_version['value']:
+        if _index_version['value'] is not None:
+            print(f"Index {index_name} changed, clearing search cache")
+        invalidate_caches()
+        _index_version['value'] = version
+
+
+def encode_query(query):
+    def encode():
+        with span("encode"):
+            return get_model().encode(query)
+    return query_vector_cache.get_or_compute(normalize_query(query), encode)
+
+
+def encode_queries(queries):
+    """ Vectors for many queries, the ones not cached are encoded in one model call """
+    keys = [normalize_query(query) for query in queries]
+    vectors = {key: query_vector_cache.get(key) for key in keys}
+    missing = {key: query for key, query in zip(keys, queries) if vectors[key] is None}
+    if missing:
+        with span("encode"):
+            encoded = get_model().encode(list(missing.values()))
+        for key, vector in zip(missing, encoded):
+            query_vector_cache.set(key, vector)
+            vectors[key] = vector
+    return [vectors[key] for key in keys]
+
+
+def search_size():
+    # With reranking, retrieve a wider candidate set and let the cross-encoder pick the best few
+    return RERANK_CANDIDATES if RERANK_ENABLED else 5
+
+
+def search(query, group, search_type, field='question_vector'):
+    if search_type != 'Vector' or VECTOR_BACKEND != "numpy":
+        check_index_version()
+
+    size = search_size()
+
+    def run_search():
+        vector = encode_query(query)
+        if search_type == 'Vector':
+            with span("knn"):
+                return get_knn_search()(field, vector, group, k=size)
+        with span("hybrid"):
+            return elastic_search_hybrid_rrf(field, query, vector, group, top_n=size, size=max(10, size))
+
+    with span("search"):
+        key = (normalize_query(query), group, search_type, field, size)
+        search_results = search_results_cache.get_or_compute(key, run_search)
+        if RERANK_ENABLED:
+            with span("rerank"):
+                search_results = rerank(query, search_results)
+    return search_results
+
+
+def search_batch(queries, groups, search_type, field='question_vector', index_name=None):
+    """ search() for many queries with one encode call and one multi-search request
+
+    Returns one result list per query, or the exception that query's search raised.
+    """
+    if search_type != 'Vector' or VECTOR_BACKEND != "numpy":
+        check_index_version()
+
+    size = search_size()
+    keys = [(normalize_query(query), group, search_type, field, size) for query, group in zip(queries, groups)]
+    results = [search_results_cache.get(key) for key in keys]
+    todo = [i for i, found in enumerate(results) if found is None]
+
+    with span("search"):
+        if todo:
+            try:
+                # An encoder failure also becomes every query's error, not the whole batch's
+                vectors = encode_queries([queries[i] for i in todo])
+                found = run_search_batch(
+                    [queries[i] for i in todo], vectors, [groups[i] for i in todo], search_type, field, index_name, size
+                )
+            except Exception as e:
+                found = [e] * len(todo)
+            for i, search_results in zip(todo, found):
+                results[i] = search_results
+                if not isinstance(search_results, Exception):
+                    search_results_cache.set(keys[i], search_results)
+
+        if RERANK_ENABLED:
+            with span("rerank"):
+                results = [
+                    found if isinstance(found, Exception) else rerank(query, found)
+                    for query, found in zip(queries, results)
+                ]
+    return results
+
+
+def run_search_batch(queries, vectors, groups, search_type, field, index_name, size):
+    if search_type == 'Vector' and VECTOR_BACKEND == "numpy":
+        from vector_search import get_numpy_index
+        with span("knn"):
+            return get_numpy_index(field).search_batch(vectors, groups, size)
+
+    searches = []
+    for query, vector, group in zip(queries, vectors, groups):
+        # Each search names its index, with partitioning the groups live in different ones
+        header = {"index": search_index(group, index_name)}
+        if search_type == 'Vector':
+            searches += [header, knn_search_body(field, vector, group, size)]
+        else:
+            # Same bodies and fusion as elastic_search_hybrid_rrf in search()
+            knn_body, keyword_body = hybrid_search_bodies(field, query, vector, group, max(10, size))
+            searches += [header, knn_body, header, keyword_body]
+    with span("msearch"):
+        responses = get_es_client().msearch(searches=searches)['responses']
+
+    per_query = 1 if search_type == 'Vector' else 2
+    found = []
+    for n in range(len(queries)):
+        query_responses = responses[n * per_query:(n + 1) * per_query]
+        try:
+            if search_type == 'Vector':
+                check_responses(query_responses)
+                found.append([hit["_source"] for hit in query_responses[0]["hits"]["hits"]])
+            else:
+                found.append(hybrid_results(
+                    query_responses[0], query_responses[1], search_index(groups[n], index_name), top_n=size
+                ))
+        except Exception as e:
+            found.append(e)
+    return found
+
+
+def cache_stats():
+    return {
+        'query_vectors': query_vector_cache.stats(),
+        'search_results': search_results_cache.stats(),
+    }
+
+
+def build_answer_data(query, answer, tokens, response_time, model_choice, evaluate_async, time_to_first_token=None, tokens_per_second=None, verdict=None):
+    """ verdict is a (relevance, explanation, eval_tokens) already known, e.g. from the answer cache """
+    if verdict is not None:
+        relevance, explanation, eval_tokens = verdict
+    elif evaluate_async:
+        # The judge runs later in relevance_worker and fills these in
+        relevance, explanation, eval_tokens = "PENDING", "Relevance evaluation in progress", EMPTY_TOKENS
     else:
-        vector = model.encode(query)
-        search_results = elastic_search_hybrid_rrf('question_vector', query, vector, group)
-    prompt = build_prompt(query, search_results)
-    answer, tokens, response_time = llm(prompt, model_choice)
-    
-    relevance, explanation, eval_tokens = evaluate_relevance(query, answer)
+        with span("judge"):
+            relevance, explanation, eval_tokens = evaluate_relevance(query, answer)
     if relevance is None or explanation is None or eval_tokens is None:
-        relevance, explanation, eval_tokens = "UNKNOWN", "Failed to evaluate relevance", {'prompt_tokens': 0, 'completion_tokens': 0, 'total_tokens': 0}
+        relevance, explanation, eval_tokens = "UNKNOWN", "Failed to evaluate relevance", EMPTY_TOKENS
 
     groq_cost = calculate_groq_cost(model_choice, tokens)
- 
+
     return {
         'answer': answer,
         'response_time': response_time,
+        'time_to_first_token': time_to_first_token,
+        'tokens_per_second': tokens_per_second,
         'relevance': relevance,
         'relevance_explanation': explanation,
         'model_used': model_choice,
@@ -230,4 +684,160 @@ def get_answer(query, group, model_choice, search_type):
         'eval_completion_tokens': eval_tokens['completion_tokens'],
         'eval_total_tokens': eval_tokens['total_tokens'],
         'groq_cost': groq_cost
-    }
\ No newline at end of file
+    }
+
+
+def cached_answer(query, search_results, model_choice, evaluate_async):
+    """ Returns (ref, answer_data), answer_data is None unless the answer cache had the answer
+
+    A hit costs no LLM tokens. Its verdict is reused when the judge already gave one,
+    otherwise the answer is judged like a fresh one. ref is where store_answer caches
+    a fresh answer, None when the cache is off or failed.
+    """
+    if not ANSWER_CACHE_ENABLED or not search_results:
+        return None, None
+    start_time = time.time()
+    with span("answer_cache"):
+        vector = encode_query(query) if answer_cache.near_duplicates_enabled() else None
+        ref = answer_cache.CacheRef(query, search_results, model_choice, PROMPT_VERSION, vector)
+        try:
+            entry = answer_cache.lookup(ref)
+        except Exception as e:
+            print(f"Answer cache lookup failed: {e}")
+            return None, None
+    if entry is None:
+        return ref, None
+
+    verdict = None
+    if entry['relevance'] in FINAL_RELEVANCE:
+        verdict = entry['relevance'], entry['relevance_explanation'], EMPTY_TOKENS
+    response_time = time.time() - start_time
+    answer_data = build_answer_data(
+        query, entry['answer'], EMPTY_TOKENS, response_time, model_choice, evaluate_async, response_time, None, verdict
+    )
+    answer_data['prompt_tokens_saved'] = None
+    answer_data['cache_hit'] = True
+    # A near-duplicate hit points at the entry it came from
+    answer_data['cache_key'] = entry['cache_key']
+    if verdict is None and not evaluate_async:
+        update_cached_relevance(entry['cache_key'], answer_data['relevance'], answer_data['relevance_explanation'])
+    return ref, answer_data
+
+
+def store_answer(ref, answer_data):
+    """ Cache a freshly generated answer under ref, failures only cost the next request a miss """
+    answer_data['cache_hit'] = False
+    if ref is None:
+        return
+    answer_data['cache_key'] = ref.key
+    try:
+        with span("answer_cache_store"):
+            answer_cache.store(ref, answer_data)
+    except Exception as e:
+        print(f"Answer cache store failed: {e}")
+
+
+def update_cached_relevance(cache_key, relevance, explanation):
+    if not cache_key:
+        return
+    try:
+        answer_cache.update_relevance(cache_key, relevance, explanation)
+    except Exception as e:
+        print(f"Answer cache relevance update failed: {e}")
+
+
+def answer_from_results(query, search_results, model_choice, evaluate_async):
+    ref, answer_data = cached_answer(query, search_results, model_choice, evaluate_async)
+    if answer_data is not None:
+        return answer_data
+
+    with span("prompt"):
+        prompt, prompt_stats = build_prompt_with_stats(query, search_results, model_choice)
+    with span("llm"):
+        answer, tokens, response_time = llm(prompt, model_choice)
+
+    # Without streaming nothing is shown before the full completion arrives
+    tokens_per_second = tokens['completion_tokens'] / response_time if response_time > 0 else None
+    answer_data = build_answer_data(query, answer, tokens, response_time, model_choice, evaluate_async, response_time, tokens_per_second)
+    answer_data['prompt_tokens_saved'] = prompt_stats['tokens_saved']
+    store_answer(ref, answer_data)
+    return answer_data
+
+
+def get_answer(query, group, model_choice, search_type, evaluate_async=False):
+    start_time = time.perf_counter()
+    with trace() as current:
+        search_results = search(query, group, search_type)
+        answer_data = answer_from_results(query, search_results, model_choice, evaluate_async)
+        record("total", time.perf_counter() - start_time)
+    answer_data['stage_timings'] = current.timings if current else None
+    return answer_data
+
+
+def get_answers_batch(queries, group, model_choice, search_type, evaluate_async=False, max_workers=BATCH_LLM_WORKERS):
+    """ get_answer for many queries, the answers come back in input order
+
+    group is one group for all queries or a list with one per query. Searches go out
+    together, then the LLM calls run max_workers at a time. A query that fails gets
+    {'error': message} in its slot instead of failing the batch.
+    """
+    groups = [group] * len(queries) if isinstance(group, str) else list(group)
+    start_time = time.perf_counter()
+    with trace() as batch_trace:
+        all_search_results = search_batch(queries, groups, search_type)
+    search_time = time.perf_counter() - start_time
+    # The shared search stages are reported on every answer of the batch
+    search_timings = batch_trace.timings if batch_trace else {}
+
+    def answer_one(i):
+        if isinstance(all_search_results[i], Exception):
+            raise all_search_results[i]
+        answer_start_time = time.perf_counter()
+        with trace() as current:
+            answer_data = answer_from_results(queries[i], all_search_results[i], model_choice, evaluate_async)
+            record("total", search_time + time.perf_counter() - answer_start_time)
+        answer_data['stage_timings'] = {**search_timings, **current.timings} if current else None
+        answer_data['error'] = None
+        return answer_data
+
+    results = [None] * len(queries)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(answer_one, i): i for i in range(len(queries))}
+        for future in as_completed(futures):
+            i = futures[future]
+            try:
+                results[i] = future.result()
+            except Exception as e:
+                print(f"Batch answer {i} failed: {e}")
+                results[i] = {'error': f"{e.__class__.__name__}: {e}"}
+    return results
+
+
+def get_answer_stream(query, group, model_choice, search_type, evaluate_async=True):
+    """ Returns (tokens, answer_data), answer_data is filled in once tokens is exhausted """
+    answer_data = {}
+
+    def generate():
+        start_time = time.perf_counter()
+        with trace() as current:
+            search_results = search(query, group, search_type)
+            ref, cached = cached_answer(query, search_results, model_choice, evaluate_async)
+            if cached is not None:
+                yield cached['answer']
+                answer_data.update(cached)
+            else:
+                with span("prompt"):
+                    prompt, prompt_stats = build_prompt_with_stats(query, search_results, model_choice)
+                stats = {}
+                with span("llm"):
+                    yield from llm_stream(prompt, model_choice, stats)
+                answer_data.update(build_answer_data(
+                    query, stats['answer'], stats['tokens'], stats['response_time'], model_choice, evaluate_async,
+                    stats['time_to_first_token'], stats['tokens_per_second']
+                ))
+                answer_data['prompt_tokens_saved'] = prompt_stats['tokens_saved']
+                store_answer(ref, answer_data)
+            record("total", time.perf_counter() - start_time)
+        answer_data['stage_timings'] = current.timings if current else None
+
+    return generate(), answer_data
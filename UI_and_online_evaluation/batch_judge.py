@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import groq
+
+from assistant import JUDGE_MODEL, evaluate_relevance
+
+
+JUDGE_REQUESTS_PER_MINUTE = int(os.getenv("JUDGE_REQUESTS_PER_MINUTE", "30"))
+JUDGE_TOKENS_PER_MINUTE = int(os.getenv("JUDGE_TOKENS_PER_MINUTE", "30000"))
+JUDGE_MAX_CONCURRENCY = int(os.getenv("JUDGE_MAX_CONCURRENCY", "8"))
+JUDGE_MAX_RETRIES = int(os.getenv("JUDGE_MAX_RETRIES", "6"))
+
+# The judge prompt around question and answer, plus a typical JSON verdict
+PROMPT_OVERHEAD_TOKENS = 200
+EXPECTED_COMPLETION_TOKENS = 120
+
+
+class TokenBucket:
+    """ Refills per_minute units per minute, acquire blocks until enough are available """
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1):
+        amount = min(amount, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                wait = (amount - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def adjust(self, amount):
+        """ Charge (or refund, if negative) the difference between estimated and actual usage """
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens - amount)
+
+    def pause(self, seconds):
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class AdaptiveConcurrency:
+    """ AIMD limit on in-flight calls: +1 per window of successes, halved when throttled """
+
+    def __init__(self, maximum, initial=2, minimum=1):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.limit = float(min(initial, maximum))
+        self.in_flight = 0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit / 2)
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+def estimate_tokens(question, answer):
+    return PROMPT_OVERHEAD_TOKENS + (len(question) + len(answer)) // 4 + EXPECTED_COMPLETION_TOKENS
+
+
+def is_rate_limited(error):
+    return isinstance(error, groq.RateLimitError)
+
+
+def is_retryable(error):
+    if isinstance(error, (groq.RateLimitError, groq.APIConnectionError, groq.APITimeoutError)):
+        return True
+    return isinstance(error, groq.APIStatusError) and error.status_code >= 500
+
+
+def retry_after(error):
+    response = getattr(error, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def load_completed(output_path):
+    completed = set()
+    if os.path.exists(output_path):
+        with open(output_path, 'rt', encoding='utf-8') as f_in:
+            for line in f_in:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    result = json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash can leave a half-written last line
+                    continue
+                if result.get("status") == "ok":
+                    completed.add(result["index"])
+    return completed
+
+
+class BatchJudge:
+    def __init__(self, requests_per_minute=JUDGE_REQUESTS_PER_MINUTE, tokens_per_minute=JUDGE_TOKENS_PER_MINUTE,
+                 max_concurrency=JUDGE_MAX_CONCURRENCY, max_retries=JUDGE_MAX_RETRIES):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self.concurrency = AdaptiveConcurrency(max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+
+    def judge(self, question, answer):
+        estimate = estimate_tokens(question, answer)
+        for attempt in range(self.max_retries + 1):
+            self.concurrency.acquire()
+            throttled = False
+            try:
+                self.requests.acquire()
+                self.tokens.acquire(estimate)
+                relevance, explanation, tokens = evaluate_relevance(question, answer)
+                self.tokens.adjust(tokens['total_tokens'] - estimate)
+                return relevance, explanation, tokens
+            except Exception as e:
+                if not is_retryable(e) or attempt == self.max_retries:
+                    raise
+                throttled = is_rate_limited(e)
+                # Full jitter, but never earlier than the server asked for
+                delay = max(retry_after(e) or 0, random.uniform(0, min(60, 2 ** attempt)))
+                if throttled:
+                    self.requests.pause(delay)
+                    self.tokens.pause(delay)
+                print(f"Judge call failed ({e.__class__.__name__}), retrying in {delay:.1f}s", flush=True)
+            finally:
+                self.concurrency.release(throttled)
+            time.sleep(delay)
+
+    def run(self, pairs, output_path):
+        """ Judge (index, question, answer) pairs, appending one JSON line per result to output_path
+
+        Indices that already have an ok result in output_path are skipped, so a crashed run
+        resumes where it stopped.
+        """
+        completed = load_completed(output_path)
+        todo = [pair for pair in pairs if pair[0] not in completed]
+        print(f"{len(completed)} pairs already judged, {len(todo)} to go", flush=True)
+
+        lock = threading.Lock()
+        stats = {"ok": 0, "error": 0}
+        start_time = time.time()
+
+        def judge_one(pair):
+            index, question, answer = pair
+            try:
+                relevance, explanation, tokens = self.judge(question, answer)
+                result = {"index": index, "status": "ok", "Relevance": relevance, "Explanation": explanation, **tokens}
+            except Exception as e:
+                result = {"index": index, "status": "error", "error": str(e)}
+            with lock:
+                f_out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                f_out.flush()
+                stats[result["status"]] += 1
+                done = stats["ok"] + stats["error"]
+                if done % 10 == 0 or done == len(todo):
+                    rate = stats["ok"] / (time.time() - start_time) * 3600
+                    print(f"{done}/{len(todo)} judged, {stats['error']} errors, {rate:.0f} pairs/hour, concurrency {self.concurrency.limit:.1f}", flush=True)
+
+        with open(output_path, 'at', encoding='utf-8') as f_out:
+            with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+                list(executor.map(judge_one, todo))
+        return stats
+
+
+def read_results(output_path):
+    results = {}
+    with open(output_path, 'rt', encoding='utf-8') as f_in:
+        for line in f_in:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if result.get("status") == "ok":
+                results[result["index"]] = result
+    return pd.DataFrame([results[index] for index in sorted(results)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rate-limited batch LLM-as-a-judge runner")
+    parser.add_argument("input", help="CSV file with question and answer columns")
+    parser.add_argument("--output", help="JSONL results and checkpoint file (default: <input>.judged.jsonl)")
+    parser.add_argument("--question-column", default="question")
+    parser.add_argument("--answer-column", default="answer")
+    parser.add_argument("--requests-per-minute", type=int, default=JUDGE_REQUESTS_PER_MINUTE)
+    parser.add_argument("--tokens-per-minute", type=int, default=JUDGE_TOKENS_PER_MINUTE)
+    parser.add_argument("--max-concurrency", type=int, default=JUDGE_MAX_CONCURRENCY)
+    parser.add_argument("--store-kind", choices=["qa", "aqa"], help="also write the finished run to eval_store")
+    parser.add_argument("--prompt-version", default="v1")
+    args = parser.parse_args()
+
+    output_path = args.output or f"{os.path.splitext(args.input)[0]}.judged.jsonl"
+    df = pd.read_csv(args.input)
+    pairs = [
+        (int(index), str(row[args.question_column]), str(row[args.answer_column]))
+        for index, row in df.iterrows()
+    ]
+
+    judge = BatchJudge(args.requests_per_minute, args.tokens_per_minute, args.max_concurrency)
+    stats = judge.run(pairs, output_path)
+    print(f"Finished: {stats['ok']} judged, {stats['error']} failed. Results in {output_path}")
+
+    if args.store_kind:
+        from eval_store import write_run
+
+        results = read_results(output_path)
+        if len(results) < len(pairs):
+            print(f"Not storing the run, only {len(results)} of {len(pairs)} pairs are judged. Rerun to resume.")
+            return
+        results = results.join(df[[args.question_column, args.answer_column]], on="index")
+        write_run(results.drop(columns=["index", "status"]), args.store_kind, JUDGE_MODEL, args.prompt_version)
+
+
+if __name__ == "__main__":
+    main()
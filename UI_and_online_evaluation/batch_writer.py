@@ -0,0 +1,249 @@
+import os
+import time
+import atexit
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+import psycopg2
+from psycopg2.extras import execute_values
+from psycopg2.pool import PoolError
+
+from db import CONVERSATION_COLUMNS, conversation_row, db_connection, generate_unique_id, tz
+
+
+WRITER_BATCH_SIZE = int(os.getenv("WRITER_BATCH_SIZE", "500"))
+WRITER_FLUSH_INTERVAL = float(os.getenv("WRITER_FLUSH_INTERVAL", "1"))
+WRITER_MAX_QUEUE = int(os.getenv("WRITER_MAX_QUEUE", "10000"))
+# Failed flushes in a row (e.g. the database is down) before the queued rows are dropped
+WRITER_MAX_RETRIES = int(os.getenv("WRITER_MAX_RETRIES", "30"))
+# Duplicate ids remembered with the id their conversation was stored under, for later feedback
+WRITER_RENAMED_IDS = int(os.getenv("WRITER_RENAMED_IDS", "10000"))
+
+# Retried with the whole batch, any other error is blamed on the rows
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError, PoolError)
+
+INSERT_CONVERSATIONS_BATCH_SQL = f"""
+    INSERT INTO conversations ({", ".join(CONVERSATION_COLUMNS)})
+    VALUES %s
+    RETURNING id
+"""
+
+# The feedback FK is gone with partitioning (see partitions.py), the id registry checks
+# the conversation instead, whichever process stored it
+INSERT_FEEDBACK_BATCH_SQL = """
+    INSERT INTO feedback (conversation_id, feedback, timestamp)
+    SELECT v.conversation_id, v.feedback, v.timestamp
+    FROM (VALUES %s) AS v (conversation_id, feedback, timestamp)
+    WHERE EXISTS (SELECT 1 FROM conversation_ids c WHERE c.id = v.conversation_id)
+    RETURNING conversation_id
+"""
+
+
+class BatchWriter:
+    """ Write-behind buffer for conversations and feedback
+
+    Rows are queued in memory and written with multi-row INSERTs when WRITER_BATCH_SIZE
+    rows are waiting or WRITER_FLUSH_INTERVAL seconds have passed. Conversations are
+    always written before feedback so feedback never refers to an unwritten row. A
+    conversation stored under a new id because its id was taken gets its feedback moved
+    along, whether that feedback is in the same batch or comes later.
+
+    A batch that fails on a connection error is retried, up to max_retries flushes in a
+    row. A batch that fails for any other reason is written row by row, and the rows that
+    still fail are logged and dropped, so one bad row cannot block the writer.
+    """
+
+    def __init__(self, batch_size=WRITER_BATCH_SIZE, flush_interval=WRITER_FLUSH_INTERVAL, max_queue=WRITER_MAX_QUEUE,
+                 max_retries=WRITER_MAX_RETRIES):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self._conversations = []
+        self._feedback = []
+        self._failures = 0
+        # Old id -> stored id, only touched by the flush holding _flush_lock
+        self._renamed = OrderedDict()
+        self._condition = threading.Condition()
+        # Only one flush talks to the database at a time
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="batch-writer", daemon=True)
+        self._thread.start()
+
+    def _pending(self):
+        return len(self._conversations) + len(self._feedback)
+
+    def save_conversation(self, conversation_id, question, answer_data, group_name, timestamp=None, on_saved=None):
+        """ Queue a conversation, on_saved(conversation_id) is called with the id that was stored """
+        if timestamp is None:
+            timestamp = datetime.now(tz)
+        if conversation_id is None:
+            conversation_id = generate_unique_id()
+        row = list(conversation_row(conversation_id, question, answer_data, group_name, timestamp))
+        self._enqueue(self._conversations, (row, on_saved))
+        return conversation_id
+
+    def save_feedback(self, conversation_id, feedback, timestamp=None):
+        """ Queue feedback, it is skipped when written if no conversation has its id """
+        if timestamp is None:
+            timestamp = datetime.now(tz)
+        self._enqueue(self._feedback, (conversation_id, feedback, timestamp))
+
+    def _enqueue(self, queue, item):
+        if self._closed:
+            raise RuntimeError("BatchWriter is closed")
+        # Backpressure: writers flush inline rather than letting the buffer grow without bound
+        if self._pending() >= self.max_queue:
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Batch writer flush failed, will retry: {e}", flush=True)
+        with self._condition:
+            queue.append(item)
+            if self._pending() >= self.batch_size:
+                self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                deadline = time.monotonic() + self.flush_interval
+                while not self._closed and self._pending() < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._condition.wait(remaining)
+                if self._closed:
+                    return
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Batch writer flush failed, will retry: {e}", flush=True)
+
+    def flush(self):
+        """ Write everything queued so far, rows stay queued after a connection error """
+        with self._flush_lock:
+            with self._condition:
+                conversations, self._conversations = self._conversations, []
+                feedback, self._feedback = self._feedback, []
+            if not conversations and not feedback:
+                return 0
+
+            try:
+                saved = self._write_batch(conversations, feedback)
+            except CONNECTION_ERRORS:
+                self._retry_later(conversations, feedback)
+                raise
+            except Exception as e:
+                print(f"Batch of {len(conversations) + len(feedback)} rows failed, writing them one by one: {e}", flush=True)
+                saved = self._write_rows(conversations, feedback)
+            self._failures = 0
+            self._notify_saved(saved)
+            return len(conversations) + len(feedback)
+
+    def _write_batch(self, conversations, feedback):
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                saved = self._insert_conversations(cur, conversations)
+                feedback = [(self._renamed.get(conversation_id, conversation_id), value, timestamp)
+                            for conversation_id, value, timestamp in feedback]
+                if feedback:
+                    inserted = execute_values(
+                        cur, INSERT_FEEDBACK_BATCH_SQL, feedback, page_size=len(feedback), fetch=True
+                    )
+                    if len(inserted) < len(feedback):
+                        print(f"Skipped {len(feedback) - len(inserted)} feedback rows for unknown conversations", flush=True)
+            conn.commit()
+        return saved
+
+    def _write_rows(self, conversations, feedback):
+        """ Write each row in its own transaction, dropping the ones that fail """
+        saved = []
+        rows = [([item], []) for item in conversations] + [([], [item]) for item in feedback]
+        for position, (conversation, feedback_row) in enumerate(rows):
+            try:
+                saved += self._write_batch(conversation, feedback_row)
+            except CONNECTION_ERRORS:
+                # The rows not written yet wait for the next flush, the saved ones are reported now
+                self._notify_saved(saved)
+                remaining = rows[position:]
+                self._retry_later([item for c, _ in remaining for item in c], [item for _, f in remaining for item in f])
+                raise
+            except Exception as e:
+                row_id = conversation[0][0][0] if conversation else feedback_row[0][0]
+                kind = "conversation" if conversation else "feedback for conversation"
+                print(f"Dropping {kind} {row_id} that cannot be written: {e}", flush=True)
+        return saved
+
+    def _retry_later(self, conversations, feedback):
+        self._failures += 1
+        if self._failures >= self.max_retries:
+            print(f"Dropping {len(conversations) + len(feedback)} rows after {self._failures} failed flushes", flush=True)
+            self._failures = 0
+            return
+        with self._condition:
+            self._conversations = conversations + self._conversations
+            self._feedback = feedback + self._feedback
+
+    def _notify_saved(self, saved):
+        for conversation_id, on_saved in saved:
+            if on_saved is not None:
+                try:
+                    on_saved(conversation_id)
+                except Exception as e:
+                    print(f"on_saved callback for {conversation_id} failed: {e}", flush=True)
+
+    def _insert_conversations(self, cur, conversations):
+        saved = []
+        pending = conversations
+        while pending:
+            inserted = execute_values(
+                cur, INSERT_CONVERSATIONS_BATCH_SQL, [row for row, _ in pending],
+                page_size=len(pending), fetch=True
+            )
+            inserted = {row[0] for row in inserted}
+            duplicates = []
+            for row, on_saved in pending:
+                if row[0] in inserted:
+                    inserted.discard(row[0])
+                    saved.append((row[0], on_saved))
+                else:
+                    # Same behavior as db.save_conversation: store the row under a new id
+                    print(f"Duplicate ID {row[0]} detected. Generating a new ID.")
+                    old_id, row[0] = row[0], generate_unique_id()
+                    self._rename(old_id, row[0])
+                    duplicates.append((row, on_saved))
+            pending = duplicates
+        return saved
+
+    def _rename(self, old_id, new_id):
+        # A row renamed twice keeps pointing at its final id
+        for key, value in self._renamed.items():
+            if value == old_id:
+                self._renamed[key] = new_id
+        self._renamed[old_id] = new_id
+        self._renamed.move_to_end(old_id)
+        if len(self._renamed) > WRITER_RENAMED_IDS:
+            self._renamed.popitem(last=False)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+        self.flush()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_batch_writer():
+    """ Process-wide writer that is flushed when the interpreter exits """
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = BatchWriter()
+            atexit.register(_writer.close)
+        return _writer
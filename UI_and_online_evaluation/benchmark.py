@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import argparse
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import assistant
+
+
+BASE_PATH = "../data/vietnamese_rag"
+GROUND_TRUTH_PATH = f"{BASE_PATH}/ground_truth_data/ground_truth_data.csv"
+
+VECTOR_FIELDS = ["question_vector", "context_vector", "answer_vector", "question_context_answer_vector"]
+
+SEARCH_FUNCTIONS = {}
+
+
+def register_search(name, needs_elasticsearch=True):
+    """ Register fn(field, question, vector, group) -> list of documents under name """
+    def decorator(fn):
+        SEARCH_FUNCTIONS[name] = (fn, needs_elasticsearch)
+        return fn
+    return decorator
+
+
+@register_search("knn", needs_elasticsearch=False)
+def knn_search(field, question, vector, group):
+    return assistant.get_knn_search()(field, vector, group)
+
+
+@register_search("hybrid")
+def hybrid_search(field, question, vector, group):
+    return assistant.elastic_search_hybrid_rrf(field, question, vector, group)
+
+
+def hit_rate(relevance_total):
+    return sum(1 for line in relevance_total if True in line) / len(relevance_total)
+
+
+def mrr(relevance_total):
+    total_score = 0.0
+    for line in relevance_total:
+        for rank, relevant in enumerate(line):
+            if relevant:
+                total_score += 1 / (rank + 1)
+    return total_score / len(relevance_total)
+
+
+def load_ground_truth(path=GROUND_TRUTH_PATH, limit=None):
+    df_ground_truth = pd.read_csv(path).dropna(subset=["question"])
+    if limit:
+        df_ground_truth = df_ground_truth.head(limit)
+    return df_ground_truth.to_dict(orient="records")
+
+
+def run_benchmark(ground_truth, vectors, search_name, field, concurrency):
+    search_function, _ = SEARCH_FUNCTIONS[search_name]
+
+    def run_one(i):
+        q = ground_truth[i]
+        start_time = time.perf_counter()
+        try:
+            results = search_function(field, q["question"], vectors[i], q["Group"])
+        except Exception as e:
+            return None, time.perf_counter() - start_time, str(e)
+        return [d["id"] == q["document"] for d in results], time.perf_counter() - start_time, None
+
+    start_time = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(run_one, range(len(ground_truth))))
+    wall_time = time.perf_counter() - start_time
+
+    relevance_total = [relevance for relevance, _, error in outcomes if error is None]
+    latencies = np.array([latency for _, latency, _ in outcomes]) * 1000
+    errors = [error for _, _, error in outcomes if error is not None]
+    return {
+        "search": search_name,
+        "field": field,
+        "queries": len(ground_truth),
+        "errors": len(errors),
+        "first_error": errors[0] if errors else None,
+        "hit_rate": hit_rate(relevance_total) if relevance_total else None,
+        "mrr": mrr(relevance_total) if relevance_total else None,
+        "latency_ms": {
+            "mean": float(latencies.mean()),
+            "p50": float(np.percentile(latencies, 50)),
+            "p95": float(np.percentile(latencies, 95)),
+            "p99": float(np.percentile(latencies, 99)),
+        },
+        "throughput_qps": len(ground_truth) / wall_time,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Retrieval benchmark over ground_truth_data.csv")
+    parser.add_argument("--search", nargs="+", default=sorted(SEARCH_FUNCTIONS), choices=sorted(SEARCH_FUNCTIONS))
+    parser.add_argument("--fields", nargs="+", default=["question_vector"], choices=VECTOR_FIELDS)
+    parser.add_argument("--backend", choices=["elasticsearch", "numpy"], default=assistant.VECTOR_BACKEND,
+                        help="numpy serves kNN from the local vector store instead of Elasticsearch")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=64, help="questions per encoder call")
+    parser.add_argument("--limit", type=int, help="only use the first N ground truth rows")
+    parser.add_argument("--ground-truth", default=GROUND_TRUTH_PATH)
+    parser.add_argument("--output", default=f"benchmark-{datetime.now():%Y%m%d-%H%M%S}.json")
+    args = parser.parse_args()
+
+    assistant.VECTOR_BACKEND = args.backend
+    ground_truth = load_ground_truth(args.ground_truth, args.limit)
+    print(f"Loaded {len(ground_truth)} ground truth records")
+
+    start_time = time.perf_counter()
+    vectors = assistant.get_model().encode([q["question"] for q in ground_truth], batch_size=args.batch_size)
+    encode_time = time.perf_counter() - start_time
+    print(f"Encoded {len(ground_truth)} questions in {encode_time:.1f}s")
+
+    results = []
+    for search_name in args.search:
+        if args.backend == "numpy" and SEARCH_FUNCTIONS[search_name][1]:
+            print(f"Skipping {search_name}: it needs Elasticsearch")
+            continue
+        for field in args.fields:
+            result = run_benchmark(ground_truth, vectors, search_name, field, args.concurrency)
+            results.append(result)
+            print(
+                f"{search_name:8} {field:32} hit_rate={result['hit_rate']} mrr={result['mrr']} "
+                f"p50={result['latency_ms']['p50']:.1f}ms p95={result['latency_ms']['p95']:.1f}ms "
+                f"errors={result['errors']}"
+            )
+
+    report = {
+        "timestamp": datetime.now().isoformat(),
+        "backend": args.backend,
+        "concurrency": args.concurrency,
+        "ground_truth": os.path.abspath(args.ground_truth),
+        "encode_seconds": encode_time,
+        "results": results,
+    }
+    with open(args.output, 'wt', encoding='utf-8') as f_out:
+        json.dump(report, f_out, indent=2)
+    print(f"Wrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
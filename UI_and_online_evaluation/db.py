@@ -1,149 +1,303 @@
 import os
+import time
+import threading
+from contextlib import contextmanager
 import psycopg2
-from psycopg2.extras import DictCursor
+from psycopg2.extras import DictCursor, Json
+from psycopg2.pool import ThreadedConnectionPool
 from datetime import datetime
 from zoneinfo import ZoneInfo
 import uuid
 
 tz = ZoneInfo("Europe/Berlin")
 
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_HEALTH_CHECK_INTERVAL = float(os.getenv("DB_HEALTH_CHECK_INTERVAL", "30"))
+
+# Order of the values produced by conversation_row
+CONVERSATION_COLUMNS = [
+    "id", "question", "answer", "group_name", "model_used", "response_time", "time_to_first_token",
+    "tokens_per_second", "prompt_tokens_saved", "stage_timings", "cache_hit", "relevance", "relevance_explanation", "prompt_tokens",
+    "completion_tokens", "total_tokens", "eval_prompt_tokens", "eval_completion_tokens", "eval_total_tokens",
+    "groq_cost", "timestamp",
+]
+
+# Columns added after the first release, init_db adds them to existing tables
+ADDED_CONVERSATION_COLUMNS = [
+    ("time_to_first_token", "FLOAT"),
+    ("tokens_per_second", "FLOAT"),
+    ("prompt_tokens_saved", "INTEGER"),
+    ("stage_timings", "JSONB"),
+    ("cache_hit", "BOOLEAN"),
+]
+
+# No row comes back when the id is taken, see partitions.PARTITIONED_DDL
+INSERT_CONVERSATION_SQL = f"""
+    INSERT INTO conversations ({", ".join(CONVERSATION_COLUMNS)})
+    VALUES ({", ".join(["%s"] * (len(CONVERSATION_COLUMNS) - 1))}, COALESCE(%s, CURRENT_TIMESTAMP))
+    RETURNING id
+"""
+
+INSERT_FEEDBACK_SQL = """
+    INSERT INTO feedback (conversation_id, feedback, timestamp)
+    VALUES (%s, %s, COALESCE(%s, CURRENT_TIMESTAMP))
+"""
+
+UPDATE_RELEVANCE_SQL = """
+    UPDATE conversations
+    SET relevance = %s, relevance_explanation = %s,
+        eval_prompt_tokens = %s, eval_completion_tokens = %s, eval_total_tokens = %s,
+        stage_timings = COALESCE(stage_timings, '{}'::jsonb) || %s::jsonb
+    WHERE id = %s
+"""
+
+RECENT_CONVERSATIONS_SQL = """
+    SELECT c.*, f.feedback
+    FROM conversations c
+    LEFT JOIN feedback f ON c.id = f.conversation_id
+    ORDER BY c.timestamp DESC
+    LIMIT %s
+"""
+
+RECENT_CONVERSATIONS_BY_RELEVANCE_SQL = """
+    SELECT c.*, f.feedback
+    FROM conversations c
+    LEFT JOIN feedback f ON c.id = f.conversation_id
+    WHERE c.relevance = %s
+    ORDER BY c.timestamp DESC
+    LIMIT %s
+"""
+
+FEEDBACK_STATS_SQL = """
+    SELECT
+        SUM(CASE WHEN feedback > 0 THEN 1 ELSE 0 END) as thumbs_up,
+        SUM(CASE WHEN feedback < 0 THEN 1 ELSE 0 END) as thumbs_down
+    FROM feedback
+"""
+
+_pool = None
+_pool_lock = threading.Lock()
+# getconn raises instead of waiting when the pool is exhausted, so callers queue here
+_pool_slots = threading.BoundedSemaphore(DB_POOL_MAX)
+_last_checked = {}
+
 def generate_unique_id():
     return str(uuid.uuid4())
 
-def get_db_connection():
-    return psycopg2.connect(
+def connection_kwargs():
+    return dict(
         host=os.getenv("POSTGRES_HOST", "localhost"),
         database=os.getenv("POSTGRES_DB", "course_assistant"),
         user=os.getenv("POSTGRES_USER", "your_username"),
         password=os.getenv("POSTGRES_PASSWORD", "your_password"),
     )
 
-def init_db():
-    conn = get_db_connection()
+def get_db_connection():
+    return psycopg2.connect(**connection_kwargs())
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadedConnectionPool(DB_POOL_MIN, DB_POOL_MAX, **connection_kwargs())
+        return _pool
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
+            _last_checked.clear()
+
+def _is_healthy(conn):
+    if conn.closed:
+        return False
+    if time.monotonic() - _last_checked.get(id(conn), 0) < DB_HEALTH_CHECK_INTERVAL:
+        return True
     try:
         with conn.cursor() as cur:
-            cur.execute("DROP TABLE IF EXISTS feedback")
-            cur.execute("DROP TABLE IF EXISTS conversations")
+            cur.execute("SELECT 1")
+        conn.rollback()
+    except psycopg2.Error:
+        return False
+    _last_checked[id(conn)] = time.monotonic()
+    return True
 
+@contextmanager
+def db_connection():
+    """ Borrow a health-checked connection from the pool, rolled back if the block raises """
+    pool = get_pool()
+    _pool_slots.acquire()
+    conn = None
+    try:
+        conn = pool.getconn()
+        if not _is_healthy(conn):
+            print("Discarding broken database connection")
+            _last_checked.pop(id(conn), None)
+            pool.putconn(conn, close=True)
+            # Already back in the pool, it must not be returned again if getconn raises
+            conn = None
+            conn = pool.getconn()
+        try:
+            yield conn
+        except Exception:
+            try:
+                if not conn.closed:
+                    conn.rollback()
+            except psycopg2.Error:
+                conn.close()
+            raise
+    finally:
+        try:
+            if conn is not None:
+                if conn.closed:
+                    _last_checked.pop(id(conn), None)
+                # The pool rolls back any transaction left open, e.g. after a plain SELECT
+                pool.putconn(conn, close=bool(conn.closed))
+        finally:
+            _pool_slots.release()
+
+def init_db(reset=False):
+    """ Create missing tables, columns, partitions and rollups, reset=True drops all conversations and feedback first
+
+    An unpartitioned conversations table from an earlier release is renamed, nothing is
+    dropped. Its rows are copied afterwards by `python partitions.py migrate`.
+    """
+    from answer_cache import create_answer_cache
+    from partitions import LEGACY_TABLE, create_partitioned_conversations, table_kind
+    from rollups import ROLLUP_TABLES, backfill_rollups, create_rollups
+
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            if reset:
+                cur.execute("DROP TABLE IF EXISTS feedback")
+                # CASCADE also drops the rollup function that takes a conversations row
+                cur.execute(f"DROP TABLE IF EXISTS conversations, {LEGACY_TABLE}, conversation_ids CASCADE")
+                cur.execute("DROP TABLE IF EXISTS " + ", ".join(ROLLUP_TABLES))
+                cur.execute("DROP TABLE IF EXISTS answer_cache")
+
+            cur.execute("SELECT to_regclass('conversation_rollups')")
+            had_rollups = cur.fetchone()[0] is not None
+
+            if table_kind(cur, "conversations") == "r":
+                # Columns the legacy table may miss before its rows are copied
+                for column, column_type in ADDED_CONVERSATION_COLUMNS:
+                    cur.execute(f"ALTER TABLE conversations ADD COLUMN IF NOT EXISTS {column} {column_type}")
+            create_partitioned_conversations(cur, counted_in_rollups=had_rollups)
+            # Databases created before these columns existed
+            for column, column_type in ADDED_CONVERSATION_COLUMNS:
+                cur.execute(f"ALTER TABLE conversations ADD COLUMN IF NOT EXISTS {column} {column_type}")
             cur.execute("""
-                CREATE TABLE conversations (
-                    id TEXT PRIMARY KEY,
-                    question TEXT NOT NULL,
-                    answer TEXT NOT NULL,
-                    group_name TEXT NOT NULL,
-                    model_used TEXT NOT NULL,
-                    response_time FLOAT NOT NULL,
-                    relevance TEXT NOT NULL,
-                    relevance_explanation TEXT NOT NULL,
-                    prompt_tokens INTEGER NOT NULL,
-                    completion_tokens INTEGER NOT NULL,
-                    total_tokens INTEGER NOT NULL,
-                    eval_prompt_tokens INTEGER NOT NULL,
-                    eval_completion_tokens INTEGER NOT NULL,
-                    eval_total_tokens INTEGER NOT NULL,
-                    groq_cost FLOAT NOT NULL,
-                    timestamp TIMESTAMP WITH TIME ZONE NOT NULL
-                )
-            """)
-            cur.execute("""
-                CREATE TABLE feedback (
+                CREATE TABLE IF NOT EXISTS feedback (
                     id SERIAL PRIMARY KEY,
-                    conversation_id TEXT REFERENCES conversations(id),
+                    conversation_id TEXT,
                     feedback INTEGER NOT NULL,
                     timestamp TIMESTAMP WITH TIME ZONE NOT NULL
                 )
             """)
+            create_answer_cache(cur)
+            create_rollups(cur)
+            if not had_rollups:
+                backfill_rollups(cur)
         conn.commit()
-    finally:
-        conn.close()
+
+def conversation_values(conversation_id, question, answer_data, group_name, timestamp):
+    """ Values in CONVERSATION_COLUMNS order, stage_timings stays a dict """
+    return (
+        conversation_id,
+        question,
+        answer_data["answer"],
+        group_name,
+        answer_data["model_used"],
+        answer_data["response_time"],
+        answer_data.get("time_to_first_token"),
+        answer_data.get("tokens_per_second"),
+        answer_data.get("prompt_tokens_saved"),
+        answer_data.get("stage_timings"),
+        bool(answer_data.get("cache_hit")),
+        answer_data["relevance"],
+        answer_data["relevance_explanation"],
+        answer_data["prompt_tokens"],
+        answer_data["completion_tokens"],
+        answer_data["total_tokens"],
+        answer_data["eval_prompt_tokens"],
+        answer_data["eval_completion_tokens"],
+        answer_data["eval_total_tokens"],
+        answer_data["groq_cost"],
+        timestamp,
+    )
+
+def conversation_row(conversation_id, question, answer_data, group_name, timestamp):
+    row = list(conversation_values(conversation_id, question, answer_data, group_name, timestamp))
+    position = CONVERSATION_COLUMNS.index("stage_timings")
+    if row[position] is not None:
+        row[position] = Json(row[position])
+    return tuple(row)
 
 def save_conversation(conversation_id, question, answer_data, group_name, timestamp=None):
     if timestamp is None:
         timestamp = datetime.now(tz)
-    
+
     if conversation_id is None:
         conversation_id = generate_unique_id()
-    
-    conn = get_db_connection()
-    try:
+
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            while True:
+                cur.execute(
+                    INSERT_CONVERSATION_SQL,
+                    conversation_row(conversation_id, question, answer_data, group_name, timestamp),
+                )
+                if cur.fetchone() is not None:
+                    break
+                print(f"Duplicate ID {conversation_id} detected. Generating a new ID.")
+                conversation_id = generate_unique_id()
+        conn.commit()
+
+    return conversation_id
+
+def update_relevance(conversation_id, relevance, explanation, eval_tokens, stage_timings=None):
+    """ Fill in the judge's verdict, stage_timings are merged into the ones saved with the answer """
+    with db_connection() as conn:
         with conn.cursor() as cur:
             cur.execute(
-                """
-                INSERT INTO conversations 
-                (id, question, answer, group_name, model_used, response_time, relevance, 
-                relevance_explanation, prompt_tokens, completion_tokens, total_tokens, 
-                eval_prompt_tokens, eval_completion_tokens, eval_total_tokens, groq_cost, timestamp)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, COALESCE(%s, CURRENT_TIMESTAMP))
-            """,
+                UPDATE_RELEVANCE_SQL,
                 (
+                    relevance,
+                    explanation,
+                    eval_tokens["prompt_tokens"],
+                    eval_tokens["completion_tokens"],
+                    eval_tokens["total_tokens"],
+                    Json(stage_timings or {}),
                     conversation_id,
-                    question,
-                    answer_data["answer"],
-                    group_name,
-                    answer_data["model_used"],
-                    answer_data["response_time"],
-                    answer_data["relevance"],
-                    answer_data["relevance_explanation"],
-                    answer_data["prompt_tokens"],
-                    answer_data["completion_tokens"],
-                    answer_data["total_tokens"],
-                    answer_data["eval_prompt_tokens"],
-                    answer_data["eval_completion_tokens"],
-                    answer_data["eval_total_tokens"],
-                    answer_data["groq_cost"],
-                    timestamp,
                 ),
             )
+            updated = cur.rowcount
         conn.commit()
-    except psycopg2.errors.UniqueViolation:
-        print(f"Duplicate ID {conversation_id} detected. Generating a new ID.")
-        save_conversation(None, question, answer_data, group_name, timestamp)
-    finally:
-        conn.close()
+        return updated
 
 def save_feedback(conversation_id, feedback, timestamp=None):
     if timestamp is None:
         timestamp = datetime.now(tz)
 
-    conn = get_db_connection()
-    try:
+    with db_connection() as conn:
         with conn.cursor() as cur:
-            cur.execute(
-                "INSERT INTO feedback (conversation_id, feedback, timestamp) VALUES (%s, %s, COALESCE(%s, CURRENT_TIMESTAMP))",
-                (conversation_id, feedback, timestamp),
-            )
+            cur.execute(INSERT_FEEDBACK_SQL, (conversation_id, feedback, timestamp))
         conn.commit()
-    finally:
-        conn.close()
 
 def get_recent_conversations(limit=5, relevance=None):
-    conn = get_db_connection()
-    try:
+    with db_connection() as conn:
         with conn.cursor(cursor_factory=DictCursor) as cur:
-            query = """
-                SELECT c.*, f.feedback
-                FROM conversations c
-                LEFT JOIN feedback f ON c.id = f.conversation_id
-            """
             if relevance:
-                query += f" WHERE c.relevance = '{relevance}'"
-            query += " ORDER BY c.timestamp DESC LIMIT %s"
-
-            cur.execute(query, (limit,))
+                cur.execute(RECENT_CONVERSATIONS_BY_RELEVANCE_SQL, (relevance, limit))
+            else:
+                cur.execute(RECENT_CONVERSATIONS_SQL, (limit,))
             return cur.fetchall()
-    finally:
-        conn.close()
 
 def get_feedback_stats():
-    conn = get_db_connection()
-    try:
+    with db_connection() as conn:
         with conn.cursor(cursor_factory=DictCursor) as cur:
-            cur.execute("""
-                SELECT 
-                    SUM(CASE WHEN feedback > 0 THEN 1 ELSE 0 END) as thumbs_up,
-                    SUM(CASE WHEN feedback < 0 THEN 1 ELSE 0 END) as thumbs_down
-                FROM feedback
-            """)
+            cur.execute(FEEDBACK_STATS_SQL)
             return cur.fetchone()
-    finally:
-        conn.close()
\ No newline at end of file
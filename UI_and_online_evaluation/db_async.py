@@ -0,0 +1,101 @@
+import re
+import json
+from datetime import datetime
+
+import asyncpg
+
+from db import (
+    CONVERSATION_COLUMNS, DB_POOL_MAX, DB_POOL_MIN, FEEDBACK_STATS_SQL, INSERT_CONVERSATION_SQL, INSERT_FEEDBACK_SQL,
+    RECENT_CONVERSATIONS_BY_RELEVANCE_SQL, RECENT_CONVERSATIONS_SQL, UPDATE_RELEVANCE_SQL, connection_kwargs,
+    conversation_values, generate_unique_id, tz,
+)
+
+
+def numbered(sql):
+    """ psycopg2 %s placeholders to asyncpg's $1, $2, ... """
+    counter = iter(range(1, sql.count("%s") + 1))
+    return re.sub(r"%s", lambda _: f"${next(counter)}", sql)
+
+
+# Same statements as db.py, so both clients write identical rows
+INSERT_CONVERSATION_SQL_ASYNC = numbered(INSERT_CONVERSATION_SQL)
+INSERT_FEEDBACK_SQL_ASYNC = numbered(INSERT_FEEDBACK_SQL)
+UPDATE_RELEVANCE_SQL_ASYNC = numbered(UPDATE_RELEVANCE_SQL)
+RECENT_CONVERSATIONS_SQL_ASYNC = numbered(RECENT_CONVERSATIONS_SQL)
+RECENT_CONVERSATIONS_BY_RELEVANCE_SQL_ASYNC = numbered(RECENT_CONVERSATIONS_BY_RELEVANCE_SQL)
+
+_pool = None
+
+
+async def get_pool():
+    global _pool
+    if _pool is None:
+        pool = await asyncpg.create_pool(min_size=DB_POOL_MIN, max_size=DB_POOL_MAX, **connection_kwargs())
+        # Another request may have created one while this one was connecting
+        if _pool is None:
+            _pool = pool
+        else:
+            await pool.close()
+    return _pool
+
+
+async def close_pool():
+    global _pool
+    pool, _pool = _pool, None
+    if pool is not None:
+        await pool.close()
+
+
+async def save_conversation(conversation_id, question, answer_data, group_name, timestamp=None):
+    """ Returns the id the conversation was stored under, a new one if conversation_id was taken """
+    if timestamp is None:
+        timestamp = datetime.now(tz)
+    pool = await get_pool()
+    position = CONVERSATION_COLUMNS.index("stage_timings")
+    while True:
+        if conversation_id is None:
+            conversation_id = generate_unique_id()
+        values = list(conversation_values(conversation_id, question, answer_data, group_name, timestamp))
+        if values[position] is not None:
+            values[position] = json.dumps(values[position])
+        if await pool.fetchval(INSERT_CONVERSATION_SQL_ASYNC, *values) is not None:
+            return conversation_id
+        print(f"Duplicate ID {conversation_id} detected. Generating a new ID.")
+        conversation_id = None
+
+
+async def update_relevance(conversation_id, relevance, explanation, eval_tokens, stage_timings=None):
+    pool = await get_pool()
+    status = await pool.execute(
+        UPDATE_RELEVANCE_SQL_ASYNC,
+        relevance,
+        explanation,
+        eval_tokens["prompt_tokens"],
+        eval_tokens["completion_tokens"],
+        eval_tokens["total_tokens"],
+        json.dumps(stage_timings or {}),
+        conversation_id,
+    )
+    # Status is "UPDATE <rows>"
+    return int(status.split()[-1])
+
+
+async def save_feedback(conversation_id, feedback, timestamp=None):
+    if timestamp is None:
+        timestamp = datetime.now(tz)
+    pool = await get_pool()
+    await pool.execute(INSERT_FEEDBACK_SQL_ASYNC, conversation_id, feedback, timestamp)
+
+
+async def get_recent_conversations(limit=5, relevance=None):
+    pool = await get_pool()
+    if relevance:
+        rows = await pool.fetch(RECENT_CONVERSATIONS_BY_RELEVANCE_SQL_ASYNC, relevance, limit)
+    else:
+        rows = await pool.fetch(RECENT_CONVERSATIONS_SQL_ASYNC, limit)
+    return [dict(row) for row in rows]
+
+
+async def get_feedback_stats():
+    pool = await get_pool()
+    return dict(await pool.fetchrow(FEEDBACK_STATS_SQL))
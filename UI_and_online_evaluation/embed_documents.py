@@ -0,0 +1,188 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import argparse
+
+import numpy as np
+
+from vector_store import FIELDS, VECTOR_DATA_PATH, VECTOR_STORE_PATH, VectorStore
+
+
+# Vectors must come from the model the assistant encodes queries with
+EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL_NAME", os.getenv("QUERY_MODEL_NAME", "paraphrase-multilingual-MiniLM-L12-v2"))
+EMBEDDING_PROCESSES = int(os.getenv("EMBEDDING_PROCESSES", str(os.cpu_count() or 1)))
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+# Unique texts encoded per resumable chunk file
+EMBEDDING_CHUNK_SIZE = int(os.getenv("EMBEDDING_CHUNK_SIZE", "5000"))
+
+# Same texts as create_vector_embeddings.ipynb
+FIELD_TEXTS = {
+    "question_vector": lambda doc: doc["question"],
+    "context_vector": lambda doc: doc["context"],
+    "answer_vector": lambda doc: doc["answer"],
+    "question_context_answer_vector": lambda doc: doc["question"] + " " + doc["context"] + " " + doc["answer"],
+}
+
+
+def text_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def unique_texts(documents, fields):
+    """ Every distinct text once, longest first, and for each field the position of each document's text
+
+    Several questions share one context, so contexts are only encoded once. Sorting by
+    length keeps the padding in a batch small, and the longest batches run first.
+    """
+    texts = {}
+    for doc in documents:
+        for field in fields:
+            text = FIELD_TEXTS[field](doc)
+            texts.setdefault(text_hash(text), text)
+    order = sorted(texts, key=lambda key: (-len(texts[key]), key))
+    position = {key: i for i, key in enumerate(order)}
+    positions = {
+        field: np.array([position[text_hash(FIELD_TEXTS[field](doc))] for doc in documents])
+        for field in fields
+    }
+    return [texts[key] for key in order], order, positions
+
+
+class ChunkDir:
+    """ Encoded chunks of the sorted unique texts, kept until the vector store is written
+
+    job.json ties the chunks to the model, the chunk size and the exact texts, so a run
+    with different inputs starts over instead of mixing vectors.
+    """
+
+    def __init__(self, path, model_name, chunk_size, hashes):
+        self.path = path
+        self.job = {
+            "model_name": model_name,
+            "chunk_size": chunk_size,
+            "texts": len(hashes),
+            "texts_hash": hashlib.sha256("".join(hashes).encode("utf-8")).hexdigest(),
+        }
+        os.makedirs(path, exist_ok=True)
+        job_path = f"{path}/job.json"
+        if os.path.exists(job_path):
+            with open(job_path, 'rt', encoding='utf-8') as f_in:
+                if json.load(f_in) != self.job:
+                    print(f"{path} holds chunks of another job, starting over")
+                    self.clear()
+        with open(job_path, 'wt', encoding='utf-8') as f_out:
+            json.dump(self.job, f_out, indent=2)
+
+    def chunk_path(self, number):
+        return f"{self.path}/chunk-{number:05d}.npy"
+
+    def done(self, number):
+        return os.path.exists(self.chunk_path(number))
+
+    def save(self, number, vectors):
+        # Write then rename, so an interrupted run never leaves a partial chunk behind
+        tmp_path = f"{self.chunk_path(number)}.tmp"
+        with open(tmp_path, 'wb') as f_out:
+            np.save(f_out, np.asarray(vectors, dtype=np.float32))
+        os.replace(tmp_path, self.chunk_path(number))
+
+    def load(self, number):
+        return np.load(self.chunk_path(number))
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            os.remove(f"{self.path}/{name}")
+
+
+def encode_chunks(texts, chunks, model_name, chunk_size, processes, batch_size):
+    """ Encode the chunks that are not on disk yet, across a pool of CPU processes """
+    numbers = range((len(texts) + chunk_size - 1) // chunk_size)
+    missing = [number for number in numbers if not chunks.done(number)]
+    print(f"{len(texts)} unique texts in {len(numbers)} chunks, {len(numbers) - len(missing)} already encoded")
+    if not missing:
+        return
+
+    if processes > 1:
+        # Each worker gets its share of the cores instead of every worker using all of them
+        os.environ.setdefault("OMP_NUM_THREADS", str(max(1, (os.cpu_count() or 1) // processes)))
+    from sentence_transformers import SentenceTransformer
+    model = SentenceTransformer(model_name, device="cpu")
+    pool = model.start_multi_process_pool(["cpu"] * processes) if processes > 1 else None
+
+    try:
+        start_time = time.time()
+        encoded = 0
+        for number in missing:
+            batch = texts[number * chunk_size:(number + 1) * chunk_size]
+            if pool is not None:
+                vectors = model.encode_multi_process(batch, pool, batch_size=batch_size)
+            else:
+                vectors = model.encode(batch, batch_size=batch_size, convert_to_numpy=True)
+            chunks.save(number, vectors)
+            encoded += len(batch)
+            print(f"Chunk {number + 1}/{len(numbers)} encoded ({encoded / (time.time() - start_time):.1f} texts/sec)")
+    finally:
+        if pool is not None:
+            model.stop_multi_process_pool(pool)
+
+
+def replace_store(tmp_path, out_path):
+    old_path = f"{out_path}.old"
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+    if os.path.exists(out_path):
+        os.rename(out_path, old_path)
+    os.rename(tmp_path, out_path)
+    if os.path.exists(old_path):
+        shutil.rmtree(old_path)
+
+
+def embed_documents(documents, out_path, model_name=EMBEDDING_MODEL_NAME, fields=FIELDS, dtype="float32",
+                    processes=EMBEDDING_PROCESSES, batch_size=EMBEDDING_BATCH_SIZE, chunk_size=EMBEDDING_CHUNK_SIZE,
+                    keep_chunks=False):
+    """ Encode every field of every document in one pass and write them as a vector store """
+    texts, hashes, positions = unique_texts(documents, fields)
+    print(f"{len(documents)} documents x {len(fields)} fields = {len(documents) * len(fields)} texts, {len(texts)} unique")
+
+    chunks = ChunkDir(f"{out_path}.chunks", model_name, chunk_size, hashes)
+    encode_chunks(texts, chunks, model_name, chunk_size, processes, batch_size)
+    vectors = np.concatenate([chunks.load(number) for number in range((len(texts) + chunk_size - 1) // chunk_size)])
+
+    # The store is written next to the old one and swapped in, readers never see it half written
+    tmp_path = f"{out_path}.tmp"
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    store = VectorStore.create(tmp_path, model_name, vectors.shape[1], fields, dtype)
+    store.append([doc["id"] for doc in documents], {field: vectors[positions[field]] for field in fields})
+    replace_store(tmp_path, out_path)
+    if not keep_chunks:
+        shutil.rmtree(chunks.path)
+    print(f"Wrote {len(documents)} rows of {', '.join(fields)} from {model_name} to {out_path}")
+    return VectorStore(out_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Encode all vector fields of the documents into a vector store")
+    parser.add_argument("--documents", default=f"{VECTOR_DATA_PATH}/documents-with-ids.json")
+    parser.add_argument("--out", default=VECTOR_STORE_PATH)
+    parser.add_argument("--model", default=EMBEDDING_MODEL_NAME)
+    parser.add_argument("--fields", nargs="+", default=FIELDS, choices=FIELDS)
+    parser.add_argument("--processes", type=int, default=EMBEDDING_PROCESSES, help="CPU encoding processes")
+    parser.add_argument("--batch-size", type=int, default=EMBEDDING_BATCH_SIZE)
+    parser.add_argument("--chunk-size", type=int, default=EMBEDDING_CHUNK_SIZE, help="unique texts per resumable chunk")
+    parser.add_argument("--float16", action="store_true", help="store vectors as float16")
+    parser.add_argument("--keep-chunks", action="store_true", help="keep the encoded chunks after writing the store")
+    args = parser.parse_args()
+
+    with open(args.documents, 'rt', encoding='utf-8') as f_in:
+        documents = json.load(f_in)
+    embed_documents(
+        documents, args.out, args.model, args.fields, "float16" if args.float16 else "float32",
+        args.processes, args.batch_size, args.chunk_size, args.keep_chunks
+    )
+
+
+if __name__ == "__main__":
+    main()
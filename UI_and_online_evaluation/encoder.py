@@ -0,0 +1,148 @@
+import os
+import json
+import argparse
+
+import numpy as np
+
+
+QUERY_MODEL_NAME = os.getenv("QUERY_MODEL_NAME", "paraphrase-multilingual-MiniLM-L12-v2")
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", f"models/onnx-{QUERY_MODEL_NAME.split('/')[-1]}")
+PARITY_THRESHOLD = float(os.getenv("ONNX_PARITY_THRESHOLD", "0.98"))
+
+PARITY_SENTENCES = [
+    "Minh Tú đã gặp khó khăn gì trong thử thách đi catwalk?",
+    "Người lao động được nghỉ phép bao nhiêu ngày mỗi năm?",
+    "Quy định về thuế thu nhập cá nhân đối với người nước ngoài là gì?",
+    "Quang hợp là quá trình gì ở thực vật?",
+    "Hà Nội là thủ đô của nước nào?",
+    "What is the capital of Vietnam?",
+]
+
+
+class OnnxQueryEncoder:
+    """ int8 ONNX Runtime export of a mean-pooling SentenceTransformer, with the same encode() call
+
+    model_name is the model the export must come from, vectors of another model would not
+    match the indexed ones.
+    """
+
+    def __init__(self, model_dir=ONNX_MODEL_DIR, threads=None, model_name=QUERY_MODEL_NAME):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        with open(f"{model_dir}/encoder.json", 'rt', encoding='utf-8') as f_in:
+            self.meta = json.load(f_in)
+        if self.meta["model_name"] != model_name:
+            raise ValueError(
+                f"ONNX encoder in {model_dir} was exported from {self.meta['model_name']}, not {model_name}, "
+                f"run `python encoder.py export --model {model_name}`"
+            )
+        parity = self.meta.get("parity", {})
+        if parity.get("min_cosine", 0) < PARITY_THRESHOLD:
+            print(f"Warning: ONNX encoder in {model_dir} has min cosine {parity.get('min_cosine')} against torch")
+
+        self.model_name = self.meta["model_name"]
+        self.max_seq_length = self.meta["max_seq_length"]
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(f"{model_dir}/{self.meta['file']}", options, providers=["CPUExecutionProvider"])
+        self.input_names = {node.name for node in self.session.get_inputs()}
+
+    def encode(self, sentences, batch_size=32, **kwargs):
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+
+        embeddings = []
+        for start in range(0, len(sentences), batch_size):
+            features = self.tokenizer(
+                sentences[start:start + batch_size], padding=True, truncation=True,
+                max_length=self.max_seq_length, return_tensors="np"
+            )
+            inputs = {name: value.astype(np.int64) for name, value in features.items() if name in self.input_names}
+            token_embeddings = self.session.run(None, inputs)[0]
+            mask = features["attention_mask"][..., None].astype(np.float32)
+            embeddings.append((token_embeddings * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9))
+
+        embeddings = np.concatenate(embeddings).astype(np.float32)
+        return embeddings[0] if single else embeddings
+
+
+def cosine_similarities(a, b):
+    a = a / np.linalg.norm(a, axis=1, keepdims=True)
+    b = b / np.linalg.norm(b, axis=1, keepdims=True)
+    return (a * b).sum(axis=1)
+
+
+def parity_check(torch_model, onnx_encoder, sentences=PARITY_SENTENCES):
+    similarities = cosine_similarities(torch_model.encode(sentences), onnx_encoder.encode(sentences))
+    return {"min_cosine": float(similarities.min()), "mean_cosine": float(similarities.mean()), "sentences": len(sentences)}
+
+
+def export_onnx(model_name=QUERY_MODEL_NAME, out_dir=ONNX_MODEL_DIR, quantize=True):
+    """ Export the transformer of a SentenceTransformer to ONNX, quantize it to int8 and check parity """
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    os.makedirs(out_dir, exist_ok=True)
+    model = SentenceTransformer(model_name, device="cpu")
+    transformer = model[0].auto_model.eval()
+    tokenizer = model.tokenizer
+    tokenizer.save_pretrained(out_dir)
+
+    sample = tokenizer(["xin chào"], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["token_embeddings"] = {0: "batch", 1: "sequence"}
+
+    class TokenEmbeddings(torch.nn.Module):
+        def __init__(self, transformer):
+            super().__init__()
+            self.transformer = transformer
+
+        def forward(self, *inputs):
+            return self.transformer(**dict(zip(input_names, inputs)))[0]
+
+    fp32_path = f"{out_dir}/model.onnx"
+    torch.onnx.export(
+        TokenEmbeddings(transformer), tuple(sample[name] for name in input_names), fp32_path,
+        input_names=input_names, output_names=["token_embeddings"], dynamic_axes=dynamic_axes, opset_version=14
+    )
+    file_name = "model.onnx"
+    if quantize:
+        quantize_dynamic(fp32_path, f"{out_dir}/model.int8.onnx", weight_type=QuantType.QInt8)
+        file_name = "model.int8.onnx"
+
+    meta = {"model_name": model_name, "max_seq_length": model.max_seq_length, "file": file_name, "quantized": quantize}
+    with open(f"{out_dir}/encoder.json", 'wt', encoding='utf-8') as f_out:
+        json.dump(meta, f_out, indent=2)
+
+    meta["parity"] = parity_check(model, OnnxQueryEncoder(out_dir, model_name=model_name))
+    with open(f"{out_dir}/encoder.json", 'wt', encoding='utf-8') as f_out:
+        json.dump(meta, f_out, indent=2)
+    print(f"Exported {model_name} to {out_dir}/{file_name}, parity {meta['parity']}")
+    if meta["parity"]["min_cosine"] < PARITY_THRESHOLD:
+        print(f"Warning: min cosine is below {PARITY_THRESHOLD}, keep QUERY_ENCODER=torch for this model")
+    return meta
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export and check the ONNX query encoder")
+    parser.add_argument("command", choices=["export", "check"])
+    parser.add_argument("--model", default=QUERY_MODEL_NAME)
+    parser.add_argument("--out", default=ONNX_MODEL_DIR)
+    parser.add_argument("--no-quantize", action="store_true")
+    args = parser.parse_args()
+
+    if args.command == "export":
+        export_onnx(args.model, args.out, quantize=not args.no_quantize)
+    else:
+        from sentence_transformers import SentenceTransformer
+        print(parity_check(SentenceTransformer(args.model, device="cpu"), OnnxQueryEncoder(args.out, model_name=args.model)))
+
+
+if __name__ == "__main__":
+    main()
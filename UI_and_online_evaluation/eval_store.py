@@ -0,0 +1,132 @@
+import os
+import re
+import uuid
+import argparse
+from datetime import datetime, timezone
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+
+BASE_PATH = "../data/vietnamese_rag"
+EVAL_STORE_PATH = os.getenv("EVAL_STORE_PATH", f"{BASE_PATH}/evaluations_store")
+
+RELEVANCE_LABELS = ("RELEVANT", "PARTLY_RELEVANT", "NON_RELEVANT")
+
+# Misspellings the judge has produced so far, collected from the evaluation notebooks
+LABEL_MAPPING = {
+    'ROLELVENT': 'RELEVANT',
+    'PARITALY_RELEVANT': 'PARTLY_RELEVANT',
+    'NONE_RELEVANT': 'NON_RELEVANT',
+    '_Partly_Relevant': 'PARTLY_RELEVANT',
+    'PARTELY_RELEVANT': 'PARTLY_RELEVANT',
+    ' части_relevant': 'PARTLY_RELEVANT',
+    '_NON_RELEVANT': 'NON_RELEVANT',
+    'FURTHER_MORE_RELEVANT': 'NON_RELEVANT',
+}
+
+METADATA_COLUMNS = ["kind", "run_id", "model", "prompt_version", "created_at"]
+
+
+def normalize_relevance(label):
+    if not isinstance(label, str):
+        return "UNKNOWN"
+    if label in LABEL_MAPPING:
+        return LABEL_MAPPING[label]
+    key = re.sub(r"[\s-]+", "_", label.strip()).strip("_").upper()
+    if key in RELEVANCE_LABELS:
+        return key
+    if key.startswith("PART"):
+        return "PARTLY_RELEVANT"
+    if key.startswith("NON") or key.startswith("NOT"):
+        return "NON_RELEVANT"
+    return "UNKNOWN"
+
+
+def write_run(df, kind, model, prompt_version, run_id=None, path=EVAL_STORE_PATH):
+    """ Append one evaluation run (Relevance, Explanation and any extra columns) to the store """
+    run_id = run_id or f"{datetime.now(timezone.utc):%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+    df = df.rename(columns={"Relevance": "relevance_raw", "Explanation": "explanation"}).copy()
+    df.insert(0, "record", range(len(df)))
+    df["relevance"] = df["relevance_raw"].map(normalize_relevance)
+    df["kind"] = kind
+    df["run_id"] = run_id
+    df["model"] = model
+    df["prompt_version"] = prompt_version
+    df["created_at"] = pd.Timestamp.now(tz="UTC")
+
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pq.write_to_dataset(
+        table, path, partition_cols=["kind", "run_id"],
+        basename_template=f"{run_id}-{{i}}.parquet"
+    )
+    print(f"Wrote {len(df)} {kind} evaluations as run {run_id}")
+    return run_id
+
+
+def open_dataset(path=EVAL_STORE_PATH):
+    return ds.dataset(path, format="parquet", partitioning="hive")
+
+
+def load_results(kind=None, run_ids=None, columns=None, path=EVAL_STORE_PATH):
+    """ Read evaluations, the kind/run_id filters prune whole partitions """
+    dataset = open_dataset(path)
+    expression = None
+    if kind is not None:
+        expression = ds.field("kind") == kind
+    if run_ids is not None:
+        run_filter = ds.field("run_id").isin(list(run_ids))
+        expression = run_filter if expression is None else expression & run_filter
+    return dataset.to_table(columns=columns, filter=expression).to_pandas()
+
+
+def list_runs(path=EVAL_STORE_PATH):
+    df = load_results(columns=METADATA_COLUMNS, path=path)
+    runs = df.groupby(METADATA_COLUMNS, observed=True).size().rename("records").reset_index()
+    return runs.sort_values("created_at").reset_index(drop=True)
+
+
+def import_legacy_csvs(kind, model, prompt_version, path=EVAL_STORE_PATH):
+    """ Import the one-record-per-file evaluations_{kind}/evaluations-{kind}{i}.csv files as one run """
+    directory = f"{BASE_PATH}/evaluations_{kind}"
+    pattern = re.compile(rf"evaluations-{kind}(\d+)\.csv$")
+    files = sorted(
+        (int(match.group(1)), name)
+        for name in os.listdir(directory)
+        if (match := pattern.match(name))
+    )
+    df = pd.concat(
+        [pd.read_csv(f"{directory}/{name}").assign(source_file=number) for number, name in files],
+        ignore_index=True
+    )
+    return write_run(df, kind, model, prompt_version, path=path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLM-as-a-judge evaluation results store")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    import_parser = subparsers.add_parser("import", help="import the legacy per-record CSV files")
+    import_parser.add_argument("--kind", choices=["qa", "aqa"], required=True)
+    import_parser.add_argument("--model", default="unknown")
+    import_parser.add_argument("--prompt-version", default="v1")
+
+    subparsers.add_parser("runs", help="list the stored runs")
+
+    summary_parser = subparsers.add_parser("summary", help="relevance distribution per run")
+    summary_parser.add_argument("--kind", choices=["qa", "aqa"])
+
+    args = parser.parse_args()
+    if args.command == "import":
+        import_legacy_csvs(args.kind, args.model, args.prompt_version)
+    elif args.command == "runs":
+        print(list_runs().to_string())
+    else:
+        df = load_results(kind=args.kind, columns=["kind", "run_id", "relevance"])
+        print(df.groupby(["kind", "run_id"], observed=True)["relevance"].value_counts(normalize=True).to_string())
+
+
+if __name__ == "__main__":
+    main()
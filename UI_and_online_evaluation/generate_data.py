@@ -1,9 +1,20 @@
+import os
+import csv
+import json
 import time
 import random
 import uuid
+import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
+
+import numpy as np
+
 from db import save_conversation, save_feedback, get_db_connection
+from batch_writer import BatchWriter, get_batch_writer
 
 # Set the timezone to CET (Europe/Berlin)
 tz = ZoneInfo("Europe/Berlin")
@@ -29,10 +40,14 @@ GROUPS = ["General", "Legal", "Expert"]
 MODELS = ['groq/llama3-8b-8192','groq/gemma2-9b-it', 'groq/gemma-7b-it']
 RELEVANCE = ["RELEVANT", "PARTLY_RELEVANT", "NON_RELEVANT", "UNKNOWN"]
 
+GROUND_TRUTH_PATH = "../data/vietnamese_rag/ground_truth_data/ground_truth_data.csv"
+
 
 def generate_synthetic_data(start_time, end_time):
     current_time = start_time
     conversation_count = 0
+    # Historical rows are buffered and written with multi-row INSERTs
+    writer = BatchWriter()
     print(f"Starting historical data generation from {start_time} to {end_time}")
     while current_time < end_time:
         conversation_id = str(uuid.uuid4())
@@ -62,16 +77,16 @@ def generate_synthetic_data(start_time, end_time):
             "groq_cost": groq_cost,
         }
 
-        save_conversation(conversation_id, question, answer_data, group, current_time)
+        writer.save_conversation(conversation_id, question, answer_data, group, current_time)
         print(
-            f"Saved conversation: ID={conversation_id}, Time={current_time}, Group ={group}, Model={model}"
+            f"Queued conversation: ID={conversation_id}, Time={current_time}, Group ={group}, Model={model}"
         )
 
         if random.random() < 0.7:
             feedback = 1 if random.random() < 0.8 else -1
-            save_feedback(conversation_id, feedback, current_time)
+            writer.save_feedback(conversation_id, feedback, current_time)
             print(
-                f"Saved feedback for conversation {conversation_id}: {'Positive' if feedback > 0 else 'Negative'}"
+                f"Queued feedback for conversation {conversation_id}: {'Positive' if feedback > 0 else 'Negative'}"
             )
 
         current_time += timedelta(minutes=random.randint(1, 15))
@@ -79,6 +94,7 @@ def generate_synthetic_data(start_time, end_time):
         if conversation_count % 10 == 0:
             print(f"Generated {conversation_count} conversations so far...")
 
+    writer.close()
     print(
         f"Historical data generation complete. Total conversations: {conversation_count}"
     )
@@ -136,7 +152,189 @@ def generate_live_data():
         time.sleep(1)
 
 
-if __name__ == "__main__":
+def load_questions(path=GROUND_TRUTH_PATH):
+    with open(path, 'rt', encoding='utf-8') as f_in:
+        return [(row["question"], row["Group"]) for row in csv.DictReader(f_in) if row["question"]]
+
+
+def latency_summary(seconds):
+    values = np.array(seconds) * 1000
+    if not len(values):
+        return None
+    return {
+        "count": len(values),
+        "mean": float(values.mean()),
+        "p50": float(np.percentile(values, 50)),
+        "p95": float(np.percentile(values, 95)),
+        "p99": float(np.percentile(values, 99)),
+        "max": float(values.max()),
+    }
+
+
+def run_load_test(questions, rate, duration, concurrency, model_choice, search_type, stream=False, skip_judge=False, save=False, seed=None):
+    """ Drive get_answer with Poisson arrivals at rate requests/sec for duration seconds
+
+    Arrivals do not wait for earlier requests, so once all concurrency workers are busy
+    requests queue up and the queue wait shows the pipeline is saturated. With skip_judge,
+    saved conversations are stored as UNKNOWN, as no judge is queued for them.
+    """
+    from assistant import get_answer, get_answer_stream
+    from tracing import failed_stage
+
+    rng = random.Random(seed)
+    writer = get_batch_writer() if save else None
+    outcomes = []
+    lock = threading.Lock()
+
+    def run_one(question, group, arrived_at):
+        outcome = {"queue_wait": time.perf_counter() - arrived_at}
+        try:
+            if stream:
+                tokens, answer_data = get_answer_stream(question, group, model_choice, search_type, evaluate_async=skip_judge)
+                for _ in tokens:
+                    pass
+            else:
+                answer_data = get_answer(question, group, model_choice, search_type, evaluate_async=skip_judge)
+            outcome["stage_timings"] = answer_data.get("stage_timings") or {}
+            outcome["cache_hit"] = bool(answer_data.get("cache_hit"))
+            if writer is not None:
+                if answer_data.get("relevance") == "PENDING":
+                    # Nobody judges load test rows, they must not sit in PENDING forever
+                    answer_data = dict(
+                        answer_data, relevance="UNKNOWN", relevance_explanation="Not judged, load test run with --skip-judge"
+                    )
+                writer.save_conversation(None, question, answer_data, group)
+        except Exception as e:
+            outcome["error"] = e.__class__.__name__
+            outcome["failed_stage"] = failed_stage(e) or "unknown"
+        outcome["latency"] = time.perf_counter() - arrived_at
+        with lock:
+            outcomes.append(outcome)
+
+    print(f"Load test: {rate} req/s for {duration}s, concurrency {concurrency}, {model_choice}, {search_type} search")
+    start_time = time.perf_counter()
+    arrival = start_time
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while True:
+            arrival += rng.expovariate(rate)
+            if arrival - start_time > duration:
+                break
+            delay = arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            question, group = rng.choice(questions)
+            executor.submit(run_one, question, group, arrival)
+    wall_time = time.perf_counter() - start_time
+
+    completed = [outcome for outcome in outcomes if "error" not in outcome]
+    failed = [outcome for outcome in outcomes if "error" in outcome]
+    stages = {}
+    for outcome in completed:
+        for stage, seconds in outcome["stage_timings"].items():
+            stages.setdefault(stage, []).append(seconds)
+    return {
+        "offered_rate": rate,
+        "concurrency": concurrency,
+        "duration": duration,
+        "requests": len(outcomes),
+        "completed": len(completed),
+        "errors": len(failed),
+        "error_rate": len(failed) / len(outcomes) if outcomes else 0.0,
+        "throughput_rps": len(completed) / wall_time,
+        "latency_ms": latency_summary([outcome["latency"] for outcome in completed]),
+        "queue_wait_ms": latency_summary([outcome["queue_wait"] for outcome in outcomes]),
+        "stages_ms": {stage: latency_summary(values) for stage, values in sorted(stages.items())},
+        "cache_hits": sum(outcome["cache_hit"] for outcome in completed),
+        "errors_by_stage": dict(Counter(outcome["failed_stage"] for outcome in failed)),
+        "errors_by_type": dict(Counter(outcome["error"] for outcome in failed)),
+    }
+
+
+def print_report(report):
+    print(f"Offered {report['offered_rate']} req/s, completed {report['throughput_rps']:.2f} req/s, "
+          f"{report['requests']} requests, {report['errors']} errors ({report['error_rate']:.1%}), "
+          f"{report['cache_hits']} cached answers")
+    rows = [("end to end", report["latency_ms"]), ("queue wait", report["queue_wait_ms"])]
+    rows += list(report["stages_ms"].items())
+    print(f"{'stage':<28}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for stage, summary in rows:
+        if summary:
+            print(f"{stage:<28}{summary['count']:>7}{summary['p50']:>10.1f}{summary['p95']:>10.1f}{summary['p99']:>10.1f}")
+    for stage, count in report["errors_by_stage"].items():
+        print(f"Errors in {stage}: {count}")
+
+
+def load_test(args):
+    # The backend and answer cache settings are read when assistant is imported
+    os.environ["VECTOR_BACKEND"] = args.search_backend
+    os.environ["ANSWER_CACHE_ENABLED"] = "true" if args.answer_cache else "false"
+    import assistant
+    from stubs import StubGroq
+
+    if args.search_backend == "numpy" and args.search_type != "Vector":
+        raise SystemExit("The numpy backend only serves Vector search, use --search-type Vector")
+    if args.llm == "stub":
+        stub_options = {
+            "time_to_first_token": args.stub_ttft,
+            "tokens_per_second": args.stub_tokens_per_second,
+            "completion_tokens": args.stub_completion_tokens,
+            "error_rate": args.stub_error_rate,
+        }
+        # Unset options keep the STUB_* environment defaults
+        assistant.set_groq_client(StubGroq(**{name: value for name, value in stub_options.items() if value is not None}))
+
+    # Model and index loading should not count as latency
+    assistant.warm_up()
+    if args.search_backend == "numpy":
+        from vector_search import get_numpy_index
+        get_numpy_index("question_vector")
+
+    questions = load_questions(args.ground_truth)
+    reports = []
+    for rate in args.rate:
+        report = run_load_test(
+            questions, rate, args.duration, args.concurrency, args.model, args.search_type,
+            stream=args.stream, skip_judge=args.skip_judge, save=args.save, seed=args.seed
+        )
+        print_report(report)
+        reports.append(report)
+
+    if args.output:
+        with open(args.output, 'wt', encoding='utf-8') as f_out:
+            json.dump(reports, f_out, indent=2)
+        print(f"Wrote {args.output}")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Synthetic monitoring data or a load test of the answer pipeline")
+    parser.add_argument("--mode", choices=["synthetic", "load"], default="synthetic")
+
+    load = parser.add_argument_group("load test")
+    load.add_argument("--rate", type=float, nargs="+", default=[1.0], help="arrivals per second, several values are run one after another")
+    load.add_argument("--duration", type=float, default=60, help="seconds per rate")
+    load.add_argument("--concurrency", type=int, default=8)
+    load.add_argument("--model", default=MODELS[0], choices=MODELS)
+    load.add_argument("--search-type", default="Hybrid", choices=["Vector", "Hybrid"])
+    load.add_argument("--search-backend", default=os.getenv("VECTOR_BACKEND", "elasticsearch"), choices=["elasticsearch", "numpy"],
+                      help="numpy serves Vector search from the local vector store instead of Elasticsearch, "
+                           "so it only exercises --search-type Vector")
+    load.add_argument("--llm", default="stub", choices=["stub", "groq"])
+    load.add_argument("--stub-ttft", type=float, default=None)
+    load.add_argument("--stub-tokens-per-second", type=float, default=None)
+    load.add_argument("--stub-completion-tokens", type=int, default=None)
+    load.add_argument("--stub-error-rate", type=float, default=None)
+    load.add_argument("--stream", action="store_true", help="use get_answer_stream like the app")
+    load.add_argument("--skip-judge", action="store_true",
+                      help="do not call the judge, conversations written with --save are stored as UNKNOWN")
+    load.add_argument("--save", action="store_true", help="write the conversations through the batch writer")
+    load.add_argument("--answer-cache", action="store_true", help="serve repeated questions from the answer cache in Postgres")
+    load.add_argument("--ground-truth", default=GROUND_TRUTH_PATH)
+    load.add_argument("--seed", type=int)
+    load.add_argument("--output", help="write the reports as JSON")
+    return parser.parse_args()
+
+
+def generate_monitoring_data():
     print(f"Script started at {datetime.now(tz)}")
     end_time = datetime.now(tz)
     start_time = end_time - timedelta(hours=6)
@@ -150,4 +348,12 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         print(f"Live data generation stopped at {datetime.now(tz)}.")
     finally:
-        print(f"Script ended at {datetime.now(tz)}")
\ No newline at end of file
+        print(f"Script ended at {datetime.now(tz)}")
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.mode == "load":
+        load_test(args)
+    else:
+        generate_monitoring_data()
@@ -0,0 +1,126 @@
+import json
+import argparse
+from datetime import datetime
+
+import numpy as np
+
+import assistant
+from benchmark import GROUND_TRUTH_PATH, load_ground_truth
+
+
+CANDIDATES = [10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000]
+# Search sizes the assistant asks for: Vector, Hybrid and the rerank candidates
+K_VALUES = sorted({5, 10, assistant.RERANK_CANDIDATES})
+MSEARCH_CHUNK = 50
+
+
+def exact_search_body(field, vector, group, k):
+    """ Brute-force cosine over every document of the group, the reference for recall """
+    query = {"bool": {"filter": [assistant.group_filter(group)]}} if assistant.group_filter(group) else {"match_all": {}}
+    return {
+        "size": k,
+        "query": {
+            "script_score": {
+                "query": query,
+                "script": {
+                    "source": f"cosineSimilarity(params.query_vector, '{field}') + 1.0",
+                    "params": {"query_vector": vector},
+                },
+            }
+        },
+        "_source": False,
+    }
+
+
+def run_searches(index_name, bodies):
+    """ (hit ids, took ms) per body, sent as multi-search requests """
+    es_client = assistant.get_es_client()
+    results = []
+    for start in range(0, len(bodies), MSEARCH_CHUNK):
+        searches = []
+        for body in bodies[start:start + MSEARCH_CHUNK]:
+            searches += [{"index": index_name}, body]
+        for response in es_client.msearch(searches=searches)['responses']:
+            assistant.check_responses([response])
+            results.append(([hit['_id'] for hit in response['hits']['hits']], response['took']))
+    return results
+
+
+def profile_group(group, questions, vectors, field, k_values, candidates, target_recall):
+    index_name = assistant.search_index(group)
+    vectors = [vector.tolist() for vector in vectors]
+    k_max = max(k_values)
+    exact = [ids for ids, _ in run_searches(index_name, [exact_search_body(field, v, group, k_max) for v in vectors])]
+
+    measurements = []
+    chosen = {}
+    for k in k_values:
+        for size in candidates:
+            if size < k:
+                continue
+            found = run_searches(index_name, [assistant.knn_search_body(field, v, group, k, size) for v in vectors])
+            recall = np.mean([len(set(ids) & set(reference[:k])) / k for (ids, _), reference in zip(found, exact)])
+            hit_rate = np.mean([str(q["document"]) in ids for (ids, _), q in zip(found, questions)])
+            took = np.array([took for _, took in found])
+            measurements.append({
+                "k": k,
+                "num_candidates": size,
+                "recall": float(recall),
+                "hit_rate": float(hit_rate),
+                "took_ms": {"p50": float(np.percentile(took, 50)), "p95": float(np.percentile(took, 95))},
+            })
+            print(f"{group:10} k={k:<3} num_candidates={size:<6} recall={recall:.3f} hit_rate={hit_rate:.3f} "
+                  f"p50={np.percentile(took, 50):.0f}ms p95={np.percentile(took, 95):.0f}ms")
+            if recall >= target_recall:
+                chosen[str(k)] = size
+                break
+        else:
+            # Never reached the target, the largest size measured is the best there is
+            chosen[str(k)] = max(size for size in candidates if size >= k)
+    return {"num_candidates": chosen, "questions": len(questions), "measurements": measurements}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure recall and latency of kNN num_candidates per group")
+    parser.add_argument("--field", default="question_vector")
+    parser.add_argument("--k", type=int, nargs="+", default=K_VALUES)
+    parser.add_argument("--candidates", type=int, nargs="+", default=CANDIDATES)
+    parser.add_argument("--target-recall", type=float, default=0.99, help="recall against exact search to reach")
+    parser.add_argument("--per-group", type=int, default=200, help="ground truth questions sampled per group")
+    parser.add_argument("--ground-truth", default=GROUND_TRUTH_PATH)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default=assistant.KNN_PROFILE_PATH)
+    args = parser.parse_args()
+
+    ground_truth = load_ground_truth(args.ground_truth)
+    by_group = {}
+    for q in ground_truth:
+        by_group.setdefault(q["Group"], []).append(q)
+
+    rng = np.random.default_rng(args.seed)
+    groups = {}
+    for group, questions in sorted(by_group.items()):
+        sample = [questions[i] for i in rng.permutation(len(questions))[:args.per_group]]
+        vectors = assistant.get_model().encode([q["question"] for q in sample], batch_size=64)
+        groups[group] = profile_group(
+            group, sample, vectors, args.field, sorted(args.k), sorted(args.candidates), args.target_recall
+        )
+
+    profile = {
+        "timestamp": datetime.now().isoformat(),
+        "model": assistant.QUERY_MODEL_NAME,
+        "index": assistant.INDEX_NAME,
+        "partitioning": assistant.INDEX_PARTITIONING,
+        "field": args.field,
+        "target_recall": args.target_recall,
+        "groups": groups,
+    }
+    with open(args.output, 'wt', encoding='utf-8') as f_out:
+        json.dump(profile, f_out, indent=2, ensure_ascii=False)
+    print(f"Wrote {args.output}")
+    for group, result in groups.items():
+        print(f"{group}: {result['num_candidates']}")
+
+
+if __name__ == "__main__":
+    main()
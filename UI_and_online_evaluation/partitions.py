@@ -0,0 +1,371 @@
+import os
+import re
+import gzip
+import argparse
+from datetime import datetime, timezone
+
+from db import CONVERSATION_COLUMNS, db_connection
+
+
+# Monthly partitions created ahead of time, so inserts never wait for a CREATE TABLE
+PARTITION_MONTHS_AHEAD = int(os.getenv("PARTITION_MONTHS_AHEAD", "3"))
+# Full months of conversations kept in the database, older partitions are archived, 0 keeps everything
+CONVERSATION_RETENTION_MONTHS = int(os.getenv("CONVERSATION_RETENTION_MONTHS", "12"))
+CONVERSATION_ARCHIVE_PATH = os.getenv("CONVERSATION_ARCHIVE_PATH", "../data/conversation_archive")
+
+# The unpartitioned table of earlier releases, its rows are copied by `partitions.py migrate`
+LEGACY_TABLE = "conversations_unpartitioned"
+# Comment on LEGACY_TABLE when the rollups already counted its rows before the rename
+LEGACY_COUNTED = "counted in rollups"
+DEFAULT_PARTITION = "conversations_default"
+PARTITION_NAME = re.compile(r"conversations_p(\d{4})_(\d{2})")
+
+# A partitioned table's primary key must contain the partition key, so ids are kept
+# unique across partitions by conversation_ids. The trigger skips an insert whose id is
+# taken: the INSERT ... RETURNING id returns no row and the writers retry with a new id.
+PARTITIONED_DDL = f"""
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT NOT NULL,
+    question TEXT NOT NULL,
+    answer TEXT NOT NULL,
+    group_name TEXT NOT NULL,
+    model_used TEXT NOT NULL,
+    response_time FLOAT NOT NULL,
+    time_to_first_token FLOAT,
+    tokens_per_second FLOAT,
+    prompt_tokens_saved INTEGER,
+    stage_timings JSONB,
+    cache_hit BOOLEAN,
+    relevance TEXT NOT NULL,
+    relevance_explanation TEXT NOT NULL,
+    prompt_tokens INTEGER NOT NULL,
+    completion_tokens INTEGER NOT NULL,
+    total_tokens INTEGER NOT NULL,
+    eval_prompt_tokens INTEGER NOT NULL,
+    eval_completion_tokens INTEGER NOT NULL,
+    eval_total_tokens INTEGER NOT NULL,
+    groq_cost FLOAT NOT NULL,
+    timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+    PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+-- Rows outside every monthly partition, moved out by ensure_partitions
+CREATE TABLE IF NOT EXISTS {DEFAULT_PARTITION} PARTITION OF conversations DEFAULT;
+
+CREATE TABLE IF NOT EXISTS conversation_ids (
+    id TEXT PRIMARY KEY,
+    timestamp TIMESTAMP WITH TIME ZONE NOT NULL
+);
+CREATE INDEX IF NOT EXISTS conversation_ids_timestamp_idx ON conversation_ids (timestamp);
+
+CREATE OR REPLACE FUNCTION conversation_ids_register() RETURNS TRIGGER AS $$
+BEGIN
+    INSERT INTO conversation_ids (id, timestamp) VALUES (NEW.id, NEW.timestamp)
+    ON CONFLICT (id) DO NOTHING;
+    IF NOT FOUND THEN
+        RETURN NULL;
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS conversations_register_id ON conversations;
+CREATE TRIGGER conversations_register_id
+    BEFORE INSERT ON conversations
+    FOR EACH ROW EXECUTE FUNCTION conversation_ids_register();
+"""
+
+COLUMNS = ", ".join(CONVERSATION_COLUMNS)
+
+# feedback has no FK to conversations on purpose: a partitioned table can only be referenced
+# on its whole primary key (id, timestamp). Writers check conversation_ids instead, and a
+# partition's feedback is archived and deleted together with it.
+ARCHIVED_FEEDBACK_SQL = "SELECT f.* FROM feedback f JOIN {name} c ON c.id = f.conversation_id"
+
+# Deleting fires the rollup trigger, the counts are added back so the dashboards keep their history
+DELETE_ARCHIVED_FEEDBACK_SQL = """
+    WITH archived AS (
+        DELETE FROM feedback f USING {name} c WHERE f.conversation_id = c.id
+        RETURNING f.timestamp, f.feedback
+    )
+    INSERT INTO feedback_rollups AS r (bucket, thumbs_up, thumbs_down)
+    SELECT date_trunc('minute', timestamp),
+           COUNT(*) FILTER (WHERE feedback > 0),
+           COUNT(*) FILTER (WHERE feedback < 0)
+    FROM archived
+    GROUP BY 1
+    ON CONFLICT (bucket) DO UPDATE SET
+        thumbs_up = r.thumbs_up + EXCLUDED.thumbs_up,
+        thumbs_down = r.thumbs_down + EXCLUDED.thumbs_down
+"""
+
+
+def month_start(moment):
+    moment = moment.astimezone(timezone.utc)
+    return datetime(moment.year, moment.month, 1, tzinfo=timezone.utc)
+
+
+def add_months(moment, months):
+    month = moment.month - 1 + months
+    return moment.replace(year=moment.year + month // 12, month=month % 12 + 1)
+
+
+def partition_name(start):
+    return f"conversations_p{start.year:04d}_{start.month:02d}"
+
+
+def partition_bounds(name):
+    match = PARTITION_NAME.fullmatch(name)
+    start = datetime(int(match.group(1)), int(match.group(2)), 1, tzinfo=timezone.utc)
+    return start, add_months(start, 1)
+
+
+def table_kind(cur, table):
+    """ 'r' for a plain table, 'p' for a partitioned one, None when it does not exist """
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def rename_legacy_table(cur, counted_in_rollups):
+    """ Move the unpartitioned conversations table out of the way, its rows are copied by migrate_legacy_rows """
+    cur.execute(f"ALTER TABLE conversations RENAME TO {LEGACY_TABLE}")
+    # Index names are unique per schema, the partitioned table reuses conversations_*
+    cur.execute("SELECT indexname FROM pg_indexes WHERE tablename = %s AND indexname LIKE 'conversations%%'", (LEGACY_TABLE,))
+    for (index_name,) in cur.fetchall():
+        cur.execute(f"ALTER INDEX {index_name} RENAME TO {LEGACY_TABLE}{index_name[len('conversations'):]}")
+    # The rollup function's argument type followed the rename, the triggers are recreated for the new table
+    cur.execute(f"DROP TRIGGER IF EXISTS conversations_rollup ON {LEGACY_TABLE}")
+    cur.execute(f"DROP FUNCTION IF EXISTS rollup_apply_conversation({LEGACY_TABLE}, INTEGER)")
+    cur.execute("ALTER TABLE feedback DROP CONSTRAINT IF EXISTS feedback_conversation_id_fkey")
+    if counted_in_rollups:
+        cur.execute(f"COMMENT ON TABLE {LEGACY_TABLE} IS %s", (LEGACY_COUNTED,))
+
+
+def create_partitioned_conversations(cur, counted_in_rollups=False):
+    """ Create the partitioned conversations table, renaming an unpartitioned one out of the way
+
+    counted_in_rollups tells whether the rollups already hold the rows of that table.
+    """
+    legacy = table_kind(cur, "conversations") == "r"
+    if legacy:
+        rename_legacy_table(cur, counted_in_rollups)
+    cur.execute(PARTITIONED_DDL)
+    ensure_partitions(cur)
+    if legacy:
+        print(f"Renamed the unpartitioned table to {LEGACY_TABLE}, copy its rows with `python partitions.py migrate`")
+
+
+def migrate_legacy_rows():
+    """ Copy the rows of LEGACY_TABLE into the partitioned table, one month per transaction
+
+    Rows whose id is already registered are skipped, so a run that stopped halfway is
+    simply started again. The copy is taken back out of the rollups when they counted the
+    legacy rows before the rename, so nothing is counted twice.
+    """
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            if table_kind(cur, LEGACY_TABLE) is None:
+                print(f"No {LEGACY_TABLE} table, nothing to migrate")
+                return 0
+            cur.execute(f"SELECT MIN(timestamp), MAX(timestamp), obj_description(%s::regclass) FROM {LEGACY_TABLE}",
+                        (LEGACY_TABLE,))
+            oldest, newest, comment = cur.fetchone()
+            if oldest is not None:
+                ensure_partitions(cur, start=oldest)
+        conn.commit()
+    if oldest is None:
+        print(f"{LEGACY_TABLE} is empty, it can be dropped")
+        return 0
+
+    counted = comment == LEGACY_COUNTED
+    copied = 0
+    month = month_start(oldest)
+    while month <= newest:
+        end = add_months(month, 1)
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("CREATE TEMP TABLE migrated_ids (id TEXT, timestamp TIMESTAMP WITH TIME ZONE) ON COMMIT DROP")
+                cur.execute(f"""
+                    WITH copied AS (
+                        INSERT INTO conversations ({COLUMNS})
+                        SELECT {COLUMNS} FROM {LEGACY_TABLE} WHERE timestamp >= %s AND timestamp < %s
+                        RETURNING id, timestamp
+                    )
+                    INSERT INTO migrated_ids SELECT id, timestamp FROM copied
+                """, (month, end))
+                rows = cur.rowcount
+                if counted:
+                    cur.execute("""
+                        SELECT rollup_apply_conversation(c, -1)
+                        FROM conversations c JOIN migrated_ids m ON c.id = m.id AND c.timestamp = m.timestamp
+                    """)
+            conn.commit()
+        copied += rows
+        print(f"Copied {rows} conversations of {month:%Y-%m}")
+        month = end
+    print(f"Copied {copied} conversations into the partitioned table, {LEGACY_TABLE} can be dropped once checked")
+    return copied
+
+
+def attached_partitions(cur):
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'conversations'::regclass
+    """)
+    return sorted(name for (name,) in cur.fetchall() if PARTITION_NAME.fullmatch(name))
+
+
+def detached_partitions(cur):
+    """ Monthly tables detached by an archive run that did not finish """
+    cur.execute("""
+        SELECT relname FROM pg_class
+        WHERE relkind = 'r' AND NOT relispartition AND relname ~ '^conversations_p[0-9]{4}_[0-9]{2}$'
+    """)
+    return sorted(name for (name,) in cur.fetchall())
+
+
+def create_partition(cur, start):
+    """ Create the month starting at start, moving rows that landed in the default partition into it """
+    name = partition_name(start)
+    end = add_months(start, 1)
+    cur.execute(
+        f"SELECT EXISTS (SELECT 1 FROM {DEFAULT_PARTITION} WHERE timestamp >= %s AND timestamp < %s)", (start, end)
+    )
+    if not cur.fetchone()[0]:
+        cur.execute(f"CREATE TABLE {name} PARTITION OF conversations FOR VALUES FROM (%s) TO (%s)", (start, end))
+        return name
+
+    # A partition cannot be created over rows in the default one, they are moved first. Deleting
+    # them takes them out of the rollups, so they are added back once the partition is attached.
+    cur.execute(f"CREATE TABLE {name} (LIKE conversations INCLUDING DEFAULTS INCLUDING CONSTRAINTS)")
+    cur.execute(f"""
+        WITH moved AS (
+            DELETE FROM {DEFAULT_PARTITION} WHERE timestamp >= %s AND timestamp < %s RETURNING {COLUMNS}
+        )
+        INSERT INTO {name} ({COLUMNS}) SELECT {COLUMNS} FROM moved
+    """, (start, end))
+    moved = cur.rowcount
+    cur.execute(f"ALTER TABLE conversations ATTACH PARTITION {name} FOR VALUES FROM (%s) TO (%s)", (start, end))
+    cur.execute("SELECT to_regproc('rollup_apply_conversation') IS NOT NULL")
+    if cur.fetchone()[0]:
+        cur.execute(
+            "SELECT rollup_apply_conversation(c, 1) FROM conversations c WHERE timestamp >= %s AND timestamp < %s",
+            (start, end)
+        )
+    print(f"Moved {moved} conversations from {DEFAULT_PARTITION} into {name}")
+    return name
+
+
+def ensure_partitions(cur, start=None, months_ahead=PARTITION_MONTHS_AHEAD):
+    """ Create the missing monthly partitions from start (default: this month) to months_ahead months from now """
+    now = month_start(datetime.now(timezone.utc))
+    month = month_start(start) if start is not None else now
+    created = []
+    while month <= add_months(now, months_ahead):
+        if table_kind(cur, partition_name(month)) is None:
+            created.append(create_partition(cur, month))
+        month = add_months(month, 1)
+    if created:
+        print(f"Created partitions {', '.join(created)}")
+    return created
+
+
+def expired_partitions(cur, retention_months=CONVERSATION_RETENTION_MONTHS):
+    """ Attached or half-archived partitions that ended before the retention window """
+    if retention_months <= 0:
+        return []
+    cutoff = add_months(month_start(datetime.now(timezone.utc)), -retention_months)
+    names = set(attached_partitions(cur)) | set(detached_partitions(cur))
+    return sorted(name for name in names if partition_bounds(name)[1] <= cutoff)
+
+
+def archive_partition(name, path=CONVERSATION_ARCHIVE_PATH):
+    """ Detach a partition, write it to path/<name>.csv.gz and drop it
+
+    The feedback on its conversations goes to path/<name>-feedback.csv.gz and is deleted
+    in the same transaction as the drop. Each step commits on its own, so the ACCESS
+    EXCLUSIVE lock of the detach is not held while the rows are written out, and a failed
+    run is picked up again by the next one. The rollups keep counting the archived
+    conversations and feedback.
+    """
+    start, end = partition_bounds(name)
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            if name in attached_partitions(cur):
+                cur.execute(f"ALTER TABLE conversations DETACH PARTITION {name}")
+        conn.commit()
+
+    os.makedirs(path, exist_ok=True)
+    archive_path = f"{path}/{name}.csv.gz"
+    feedback_path = f"{path}/{name}-feedback.csv.gz"
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            copy_to_archive(cur, f"{name} ({COLUMNS})", archive_path)
+            copy_to_archive(cur, f"({ARCHIVED_FEEDBACK_SQL.format(name=name)})", feedback_path)
+            cur.execute(DELETE_ARCHIVED_FEEDBACK_SQL.format(name=name))
+            cur.execute("DELETE FROM conversation_ids WHERE timestamp >= %s AND timestamp < %s", (start, end))
+            cur.execute(f"DROP TABLE {name}")
+        conn.commit()
+    print(f"Archived {name} to {archive_path} and its feedback to {feedback_path}")
+    return archive_path
+
+
+def copy_to_archive(cur, source, archive_path):
+    # Written next to the archive and renamed, a failed run never leaves a partial file behind
+    with gzip.open(f"{archive_path}.tmp", 'wb') as f_out:
+        cur.copy_expert(f"COPY {source} TO STDOUT WITH (FORMAT csv, HEADER)", f_out)
+    os.replace(f"{archive_path}.tmp", archive_path)
+
+
+def apply_retention(retention_months=CONVERSATION_RETENTION_MONTHS, path=CONVERSATION_ARCHIVE_PATH, dry_run=False):
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            names = expired_partitions(cur, retention_months)
+    if dry_run:
+        print(f"Would archive {', '.join(names) or 'nothing'}")
+        return names
+    for name in names:
+        archive_partition(name, path)
+    return names
+
+
+def list_partitions():
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            for name in attached_partitions(cur) + [DEFAULT_PARTITION]:
+                cur.execute(f"SELECT COUNT(*), pg_total_relation_size(%s) FROM {name}", (name,))
+                rows, size = cur.fetchone()
+                print(f"{name:28} {rows:>10} rows {size / 2**20:>10.1f} MB")
+            for name in detached_partitions(cur):
+                print(f"{name:28} detached, not archived yet")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Monthly partitions of the conversations table")
+    parser.add_argument("command", choices=["list", "ensure", "archive", "maintain", "migrate"],
+                        help="maintain runs ensure and archive, e.g. from a daily cron job, "
+                             f"migrate copies the rows of {LEGACY_TABLE} month by month")
+    parser.add_argument("--months-ahead", type=int, default=PARTITION_MONTHS_AHEAD)
+    parser.add_argument("--retention-months", type=int, default=CONVERSATION_RETENTION_MONTHS)
+    parser.add_argument("--archive-path", default=CONVERSATION_ARCHIVE_PATH)
+    parser.add_argument("--dry-run", action="store_true", help="only print the partitions that would be archived")
+    args = parser.parse_args()
+
+    if args.command == "list":
+        list_partitions()
+        return
+    if args.command == "migrate":
+        migrate_legacy_rows()
+        return
+    if args.command in ("ensure", "maintain"):
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                ensure_partitions(cur, months_ahead=args.months_ahead)
+            conn.commit()
+    if args.command in ("archive", "maintain"):
+        apply_retention(args.retention_months, args.archive_path, args.dry_run)
+
+
+if __name__ == "__main__":
+    main()
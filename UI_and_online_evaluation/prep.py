@@ -1,4 +1,5 @@
 import os
+import re
 import requests
 import pandas as pd
 from sentence_transformers import SentenceTransformer
@@ -7,14 +8,34 @@ from tqdm.auto import tqdm
 from dotenv import load_dotenv
 import pickle
 import json
+import time
+import hashlib
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from elasticsearch import helpers
 
+from assistant import QUERY_MODEL_NAME, group_index_name
 from db import init_db
+from vector_store import VECTOR_STORE_PATH, VectorStore
 
 load_dotenv()
 
 ELASTIC_URL = os.getenv("ELASTIC_URL_LOCAL")
 MODEL_NAME = os.getenv("MODEL_NAME")
 INDEX_NAME = os.getenv("INDEX_NAME")
+INDEX_MODE = os.getenv("INDEX_MODE", "bulk")
+INDEX_BATCH_SIZE = int(os.getenv("INDEX_BATCH_SIZE", "256"))
+INDEX_WORKERS = int(os.getenv("INDEX_WORKERS", "4"))
+INDEX_MAX_PENDING = int(os.getenv("INDEX_MAX_PENDING", "8"))
+INDEX_SYNC_MODE = os.getenv("INDEX_SYNC_MODE", "sync")
+# Previous index versions kept after an alias swap, for rolling back
+INDEX_KEEP_VERSIONS = int(os.getenv("INDEX_KEEP_VERSIONS", "1"))
+# "group" gives every group its own index behind an INDEX_NAME-group-<group> alias
+INDEX_PARTITIONING = os.getenv("INDEX_PARTITIONING", "none")
+
+# A document is re-embedded and reindexed when any of these change
+HASH_FIELDS = ["id", "group", "context", "question", "answer"]
 
 BASE_PATH = "../data/vietnamese_rag"
 BASE_URL = "https://github.com/vucongtuanduong/vietnamese-rag-project/tree/add_files_dev"
@@ -27,6 +48,51 @@ def load_documents_json_local(relative_path):
             return (json.load(f_in))
 
 
+def stream_documents_json_local(relative_path, chunk_size=1 << 20):
+    """ Yield the objects of a top-level JSON array without loading the whole file """
+    file_path = f"{BASE_PATH}/{relative_path}"
+    decoder = json.JSONDecoder()
+    whitespace = " \t\r\n"
+    with open(file_path, 'rt', encoding='utf-8') as f_in:
+        buffer = f_in.read(chunk_size)
+        pos = 0
+        eof = not buffer
+        started = False
+        while True:
+            while pos < len(buffer) and buffer[pos] in whitespace:
+                pos += 1
+            if pos == len(buffer):
+                if eof:
+                    raise ValueError(f"Unexpected end of {file_path}")
+                buffer = f_in.read(chunk_size)
+                pos = 0
+                eof = not buffer
+                continue
+            char = buffer[pos]
+            if not started:
+                if char != "[":
+                    raise ValueError(f"{file_path} is not a JSON array")
+                started = True
+                pos += 1
+                continue
+            if char == ",":
+                pos += 1
+                continue
+            if char == "]":
+                return
+            try:
+                obj, pos = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                chunk = f_in.read(chunk_size)
+                eof = not chunk
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                continue
+            yield obj
+
+
 def fetch_documents():
     print("Fetching documents...")
     relative_path = "documents-with-ids.json"
@@ -35,6 +101,26 @@ def fetch_documents():
     return documents
 
 
+def duplicate_ids(documents):
+    """ {id: count} of the ids used by more than one document, streamed so only the ids are kept """
+    counts = {}
+    for doc in documents:
+        doc_id = str(doc["id"])
+        counts[doc_id] = counts.get(doc_id, 0) + 1
+    return {doc_id: count for doc_id, count in counts.items() if count > 1}
+
+
+def check_unique_ids(documents):
+    # Documents are indexed under _id = id, a duplicate would silently overwrite another one
+    duplicates = duplicate_ids(documents)
+    if duplicates:
+        examples = ", ".join(f"{doc_id} ({count}x)" for doc_id, count in list(duplicates.items())[:5])
+        raise ValueError(
+            f"{sum(duplicates.values()) - len(duplicates)} documents reuse the ids of others, "
+            f"{len(duplicates)} ids affected, e.g. {examples}"
+        )
+
+
 def fetch_ground_truth():
     print("Fetching ground truth data...")
     relative_path = "ground_truth_data/ground_truth_data.csv"
@@ -49,22 +135,48 @@ def load_model():
     print(f"Loading model: {MODEL_NAME}")
     return SentenceTransformer(MODEL_NAME)
 
-def setup_elasticsearch():
-    print("Setting up Elasticsearch...")
-    es_client = Elasticsearch(ELASTIC_URL)
+def check_embedding_models():
+    """ Warn when documents and queries would be encoded by different models, their vectors do not compare """
+    if MODEL_NAME != QUERY_MODEL_NAME:
+        print(f"WARNING: MODEL_NAME={MODEL_NAME} indexes the documents but QUERY_MODEL_NAME={QUERY_MODEL_NAME} encodes the queries")
+    if os.path.exists(f"{VECTOR_STORE_PATH}/manifest.json"):
+        store_model = VectorStore(VECTOR_STORE_PATH).manifest["model_name"]
+        if store_model != QUERY_MODEL_NAME:
+            print(f"WARNING: the vector store at {VECTOR_STORE_PATH} was encoded with {store_model}, not {QUERY_MODEL_NAME}")
+
+def content_hash(doc):
+    content = json.dumps({field: doc.get(field) for field in HASH_FIELDS}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def index_meta():
+    # assistant.py clears its search cache when index_version changes and compares
+    # model_name with its query encoder. put_mapping replaces _meta, so both are always written.
+    return {"index_version": str(time.time_ns()), "model_name": MODEL_NAME}
+
+
+def index_model(es_client, index_name):
+    """ The model the index was embedded with, None for indices built before it was recorded """
+    mappings = es_client.indices.get_mapping(index=index_name)
+    return mappings[index_name]['mappings'].get('_meta', {}).get('model_name')
 
-    index_settings = {
+
+def index_settings():
+    return {
         "settings": {
             "number_of_shards": 1,
             "number_of_replicas": 0
         },
         "mappings": {
+            # assistant.py clears its search cache when this changes
+            "_meta": index_meta(),
             "properties": {
                 "group": {"type": "keyword"},
                 "context": {"type": "text"},
                 "question": {"type": "text"},
                 "answer": {"type": "text"},
                 "id": {"type": "keyword"},
+                "content_hash": {"type": "keyword"},
                 "question_vector": {
                     "type": "dense_vector",
                     "dims": 384,
@@ -75,10 +187,57 @@ def setup_elasticsearch():
         }
     }
 
-    es_client.indices.delete(index=INDEX_NAME, ignore_unavailable=True)
-    es_client.indices.create(index=INDEX_NAME, body=index_settings)
-    print(f"Elasticsearch index '{INDEX_NAME}' created")
-    return es_client
+
+def setup_elasticsearch():
+    print("Setting up Elasticsearch...")
+    return Elasticsearch(ELASTIC_URL)
+
+
+def alias_targets(es_client, alias=INDEX_NAME):
+    """ Indices behind alias, and whether alias is a plain index from before aliases were used """
+    if es_client.indices.exists_alias(name=alias):
+        return sorted(es_client.indices.get_alias(name=alias)), False
+    if es_client.indices.exists(index=alias):
+        return [alias], True
+    return [], False
+
+
+def create_versioned_index(es_client, alias=INDEX_NAME):
+    index_name = f"{alias}-v{time.strftime('%Y%m%d%H%M%S')}"
+    es_client.indices.create(index=index_name, body=index_settings())
+    print(f"Elasticsearch index '{index_name}' created")
+    return index_name
+
+
+def alias_actions(es_client, alias, new_indices):
+    """ update_aliases actions that make alias point at exactly new_indices """
+    old_indices, legacy = alias_targets(es_client, alias)
+    actions = [{"add": {"index": index, "alias": alias}} for index in new_indices]
+    if legacy:
+        # The old plain index holds the alias' name, it is removed in the same request
+        actions.append({"remove_index": {"index": alias}})
+    else:
+        actions += [{"remove": {"index": index, "alias": alias}} for index in old_indices if index not in new_indices]
+    return actions
+
+
+def swap_alias(es_client, new_index, alias=INDEX_NAME):
+    """ Point alias at new_index in one atomic request """
+    es_client.indices.update_aliases(actions=alias_actions(es_client, alias, [new_index]))
+    print(f"Alias '{alias}' now points to '{new_index}'")
+
+
+def delete_old_versions(es_client, keep=INDEX_KEEP_VERSIONS, alias=INDEX_NAME):
+    current, _ = alias_targets(es_client, alias)
+    # The wildcard can also match another alias' versions, e.g. those of groups "x" and "x-vn"
+    version_pattern = re.compile(rf"{re.escape(alias)}-v\d{{14}}")
+    versions = sorted(
+        name for name in es_client.indices.get(index=f"{alias}-v*", expand_wildcards="open")
+        if version_pattern.fullmatch(name) and name not in current
+    )
+    for name in versions[:max(0, len(versions) - keep)]:
+        es_client.indices.delete(index=name)
+        print(f"Deleted old index '{name}'")
 
 
 def load_documents_json(relative_url):
@@ -91,46 +250,275 @@ def load_vectors(file_path):
     with open(file_path, 'rb') as file:
         return pickle.load(file)
 
-def process_documents_new(es_client, documents, model):
+def load_store_vectors(field, documents):
+    store = VectorStore(VECTOR_STORE_PATH)
+    vectors = store.open_field(field)
+    return [vectors[store.row_of(str(doc["id"]))] for doc in documents]
+
+def process_documents_new(es_client, documents, model, index_name=None):
     # json_path = f"{BASE_PATH}/documents-with-ids{i}.json"
+    index_name = index_name or INDEX_NAME
     for doc in tqdm(documents):
         question = doc["question"]
+        doc["content_hash"] = content_hash(doc)
         doc["question_vector"] = model.encode(question).tolist()
-        es_client.index(index=INDEX_NAME, document=doc)
+        es_client.index(index=index_name, id=str(doc["id"]), document=doc)
 
 def process_documents(es_client):
     # json_path = f"{BASE_PATH}/documents-with-ids{i}.json"
     pickle_path = f"{BASE_PATH}/question_vector_pickle/question_vector.pkl"
     json_relative_path = "documents-with-ids.json"
     data = load_documents_json_local(json_relative_path)
-    document_question_vector_list = load_vectors(pickle_path)
-
-    for j in range(len(data)):
-        data[j]['question_vector'] = document_question_vector_list[j]['question_vector']
+    if os.path.exists(f"{VECTOR_STORE_PATH}/manifest.json"):
+        question_vectors = load_store_vectors("question_vector", data)
+        for j in range(len(data)):
+            data[j]['question_vector'] = question_vectors[j].astype('float32').tolist()
+    else:
+        document_question_vector_list = load_vectors(pickle_path)
+        for j in range(len(data)):
+            data[j]['question_vector'] = document_question_vector_list[j]['question_vector']
     
     for doc in tqdm(data):
         es_client.index(index=INDEX_NAME, document=doc)
 
-def index_documents(es_client, documents, model):
+def iter_batches(documents, batch_size):
+    batch = []
+    for doc in documents:
+        batch.append(doc)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def bulk_index_batch(es_client, batch, index_name):
+    actions = [{"_index": index_name, "_id": str(doc["id"]), "_source": doc} for doc in batch]
+    success, errors = helpers.bulk(es_client, actions, chunk_size=len(actions), raise_on_error=False, raise_on_exception=False)
+    return success, errors
+
+
+def process_documents_bulk(es_client, documents, model, batch_size=INDEX_BATCH_SIZE, workers=INDEX_WORKERS, max_pending=INDEX_MAX_PENDING, index_name=None):
+    """ Encode questions in batches and ship them with parallel bulk requests """
+    index_name = index_name or INDEX_NAME
+    # Backpressure: encoding blocks once max_pending batches are waiting on Elasticsearch
+    pending = threading.BoundedSemaphore(max_pending)
+    lock = threading.Lock()
+    stats = {"indexed": 0, "failed": 0, "failed_batches": 0}
+    start_time = time.time()
+
+    def report(batch_number, batch_size, future):
+        try:
+            success, errors = future.result()
+        except Exception as e:
+            success, errors = 0, [str(e)]
+        finally:
+            pending.release()
+        failed = batch_size - success
+        with lock:
+            stats["indexed"] += success
+            stats["failed"] += failed
+            if failed:
+                stats["failed_batches"] += 1
+                print(f"Batch {batch_number}: {failed}/{batch_size} documents failed, first error: {errors[0] if errors else 'unknown'}")
+            elapsed = time.time() - start_time
+            print(f"Indexed {stats['indexed']} documents ({stats['indexed'] / elapsed:.1f} docs/sec)", end="\r", flush=True)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for batch_number, batch in enumerate(iter_batches(documents, batch_size), start=1):
+            questions = [doc["question"] for doc in batch]
+            vectors = model.encode(questions, batch_size=batch_size)
+            for doc, vector in zip(batch, vectors):
+                doc["content_hash"] = content_hash(doc)
+                doc["question_vector"] = vector.tolist()
+            pending.acquire()
+            future = executor.submit(bulk_index_batch, es_client, batch, index_name)
+            future.add_done_callback(lambda f, n=batch_number, size=len(batch): report(n, size, f))
+
+    elapsed = time.time() - start_time
+    print()
+    print(f"Bulk indexing finished in {elapsed:.1f}s: {stats['indexed']} indexed, {stats['failed']} failed in {stats['failed_batches']} batches")
+    return stats
+
+
+def index_documents(es_client, documents, model, index_name=None):
     print("Indexing documents...")
     # process_documents(es_client)
-    process_documents_new(es_client, documents, model)
-    print(f"Indexed {len(documents)} documents")
+    if INDEX_MODE == "bulk":
+        stats = process_documents_bulk(es_client, documents, model, index_name=index_name)
+    else:
+        documents = list(documents)
+        process_documents_new(es_client, documents, model, index_name)
+        stats = {"indexed": len(documents), "failed": 0}
+    print(f"Indexed {stats['indexed']} documents")
+    return stats
+
+
+def rebuild_index(es_client, documents, model):
+    """ Index everything into a new versioned index, then swap the alias over to it """
+    if INDEX_PARTITIONING == "group":
+        return rebuild_partitioned(es_client, documents, model)
+    index_name = create_versioned_index(es_client)
+    stats = index_documents(es_client, documents, model, index_name)
+    if stats["failed"]:
+        es_client.indices.delete(index=index_name)
+        raise RuntimeError(f"{stats['failed']} documents failed to index, keeping the current index")
+    es_client.indices.refresh(index=index_name)
+    swap_alias(es_client, index_name)
+    delete_old_versions(es_client)
+    return stats
+
+
+def delete_documents(es_client, doc_ids, index_name):
+    actions = [{"_op_type": "delete", "_index": index_name, "_id": doc_id} for doc_id in doc_ids]
+    success, errors = helpers.bulk(es_client, actions, raise_on_error=False, raise_on_exception=False)
+    return success, errors
+
+
+def partition_documents(documents):
+    groups = {}
+    for doc in documents:
+        groups.setdefault(doc["group"], []).append(doc)
+    return groups
+
+
+def rebuild_partitioned(es_client, documents, model):
+    """ rebuild_index with one new index per group, every alias is swapped in the same request
+
+    INDEX_NAME points at all group indices, for the assistant's index version check.
+    """
+    groups = partition_documents(documents)
+    new_indices = {}
+    stats = {"indexed": 0, "failed": 0}
+    try:
+        for group, group_documents in groups.items():
+            alias = group_index_name(INDEX_NAME, group)
+            new_indices[alias] = create_versioned_index(es_client, alias)
+            group_stats = index_documents(es_client, group_documents, model, new_indices[alias])
+            stats["indexed"] += group_stats["indexed"]
+            stats["failed"] += group_stats["failed"]
+        if stats["failed"]:
+            raise RuntimeError(f"{stats['failed']} documents failed to index, keeping the current indices")
+    except Exception:
+        for index_name in new_indices.values():
+            es_client.indices.delete(index=index_name)
+        raise
+    es_client.indices.refresh(index=",".join(new_indices.values()))
+
+    actions = []
+    for alias, index_name in new_indices.items():
+        actions += alias_actions(es_client, alias, [index_name])
+    actions += alias_actions(es_client, INDEX_NAME, list(new_indices.values()))
+    es_client.indices.update_aliases(actions=actions)
+    print(f"Alias '{INDEX_NAME}' now points to {len(new_indices)} group indices")
+    for alias in new_indices:
+        delete_old_versions(es_client, alias=alias)
+    delete_old_versions(es_client)
+    return stats
+
+
+def sync_partitioned(es_client, documents, model):
+    """ sync_index for every group's index, a document whose group changed moves between them """
+    groups = partition_documents(documents)
+    targets = {}
+    for group in groups:
+        alias = group_index_name(INDEX_NAME, group)
+        indices, legacy = alias_targets(es_client, alias)
+        if legacy or len(indices) != 1:
+            print(f"'{alias}' is not an alias to a single index, doing a full rebuild")
+            return rebuild_partitioned(es_client, documents, model)
+        targets[group] = indices[0]
+        if index_model(es_client, indices[0]) != MODEL_NAME:
+            print(f"'{alias}' was not embedded with {MODEL_NAME}, doing a full rebuild")
+            return rebuild_partitioned(es_client, documents, model)
+    combined, legacy = alias_targets(es_client)
+    if legacy:
+        return rebuild_partitioned(es_client, documents, model)
+    if combined != sorted(targets.values()):
+        es_client.indices.update_aliases(actions=alias_actions(es_client, INDEX_NAME, sorted(targets.values())))
+
+    stats = {"indexed": 0, "failed": 0, "deleted": 0}
+    for group, group_documents in groups.items():
+        print(f"Group {group}:")
+        group_stats = sync_documents(es_client, group_documents, model, targets[group])
+        for key in stats:
+            stats[key] += group_stats.get(key, 0)
+    return stats
+
+
+def sync_index(es_client, documents, model):
+    """ Re-embed and upsert new or changed documents and delete removed ones, in place """
+    if INDEX_PARTITIONING == "group":
+        return sync_partitioned(es_client, documents, model)
+    targets, legacy = alias_targets(es_client)
+    if legacy or len(targets) != 1:
+        print(f"'{INDEX_NAME}' is not an alias to a single index, doing a full rebuild")
+        return rebuild_index(es_client, documents, model)
+    if index_model(es_client, targets[0]) != MODEL_NAME:
+        # Re-embedding only the changed documents would mix vectors of two models
+        print(f"'{INDEX_NAME}' was not embedded with {MODEL_NAME}, doing a full rebuild")
+        return rebuild_index(es_client, documents, model)
+    return sync_documents(es_client, documents, model, targets[0])
+
+
+def sync_documents(es_client, documents, model, index_name):
+    existing = {
+        hit["_id"]: hit["_source"].get("content_hash")
+        for hit in helpers.scan(es_client, index=index_name, query={"_source": ["content_hash"]})
+    }
+    changed = []
+    seen = set()
+    for doc in documents:
+        doc_id = str(doc["id"])
+        seen.add(doc_id)
+        if existing.get(doc_id) != content_hash(doc):
+            changed.append(doc)
+    removed = [doc_id for doc_id in existing if doc_id not in seen]
+    print(f"{len(seen)} documents: {len(changed)} new or changed, {len(removed)} removed, {len(seen) - len(changed)} unchanged")
+
+    stats = {"indexed": 0, "failed": 0, "deleted": 0}
+    if changed:
+        stats.update(process_documents_bulk(es_client, changed, model, index_name=index_name))
+    if removed:
+        stats["deleted"], errors = delete_documents(es_client, removed, index_name)
+        if errors:
+            print(f"{len(errors)} deletes failed, first error: {errors[0]}")
+    if changed or removed:
+        es_client.indices.refresh(index=index_name)
+        es_client.indices.put_mapping(index=index_name, meta=index_meta())
+    return stats
+
 
 def main():
+    parser = argparse.ArgumentParser(description="Index the documents into Elasticsearch and prepare the database")
+    parser.add_argument("--mode", choices=["sync", "rebuild"], default=INDEX_SYNC_MODE,
+                        help="sync updates the live index in place, rebuild swaps in a new one")
+    parser.add_argument("--reset-db", action="store_true", help="drop all conversations and feedback")
+    args = parser.parse_args()
+
     print("Starting the indexing process...")
 
-    documents = fetch_documents()
+    if INDEX_MODE == "bulk":
+        # One streaming pass over the ids first, nothing is indexed when they are not unique
+        check_unique_ids(stream_documents_json_local("documents-with-ids.json"))
+        documents = stream_documents_json_local("documents-with-ids.json")
+    else:
+        documents = fetch_documents()
+        check_unique_ids(documents)
     ground_truth = fetch_ground_truth()
+    check_embedding_models()
     model = load_model()
     es_client = setup_elasticsearch()
-    index_documents(es_client, documents, model)
+    if args.mode == "sync":
+        sync_index(es_client, documents, model)
+    else:
+        rebuild_index(es_client, documents, model)
 
     print("Initializing database...")
     # create_database()
-    init_db()
+    init_db(reset=args.reset_db)
 
     print("Indexing process completed successfully!")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,103 @@
+import re
+
+
+# Rough Vietnamese average for the Groq model tokenizers, no tokenizer is needed at runtime
+CHARS_PER_TOKEN = 3
+
+_SENTENCE_SPLIT = re.compile(r"(?<=[.!?…])\s+|\n+")
+_WORD = re.compile(r"\w+")
+
+
+def count_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+def truncate_to_tokens(text, max_tokens):
+    """ Cut text at a word boundary so it fits in max_tokens """
+    if count_tokens(text) <= max_tokens:
+        return text
+    cut = text[:max(0, max_tokens * CHARS_PER_TOKEN - 3)]
+    if " " in cut:
+        cut = cut[:cut.rindex(" ")]
+    return cut + "..." if cut else ""
+
+
+def split_sentences(text):
+    return [sentence for sentence in _SENTENCE_SPLIT.split(text) if sentence.strip()]
+
+
+def select_relevant_sentences(query, text, max_tokens):
+    """ Keep the sentences sharing most words with the query, in their original order """
+    sentences = split_sentences(text)
+    if count_tokens(text) <= max_tokens or len(sentences) <= 1:
+        return text
+
+    query_words = set(_WORD.findall(query.lower()))
+    scored = sorted(
+        range(len(sentences)),
+        key=lambda i: (-len(query_words & set(_WORD.findall(sentences[i].lower()))), i)
+    )
+    kept = set()
+    used = 0
+    for i in scored:
+        tokens = count_tokens(sentences[i]) + 1
+        if used + tokens > max_tokens:
+            continue
+        kept.add(i)
+        used += tokens
+    return " ".join(sentences[i] for i in sorted(kept))
+
+
+def format_document(doc, context):
+    text = f"group: {doc['group']}\nquestion: {doc['question']}\nanswer: {doc['answer']}"
+    if context:
+        text += f"\ncontext: {context}"
+    return text
+
+
+def assemble_context(query, search_results, token_budget, select_sentences=False, max_context_tokens=None):
+    """ Build the CONTEXT block within token_budget
+
+    Documents are taken in rank order, so the lowest-ranked ones are truncated or dropped
+    first. A context shared by several hits is only included with the best-ranked one.
+    Returns (context, stats).
+    """
+    full_context = "\n\n".join(format_document(doc, doc['context']) for doc in search_results)
+
+    parts = []
+    seen_contexts = set()
+    used = 0
+    duplicates = 0
+    truncated = 0
+    for doc in search_results:
+        context = doc['context'] or ""
+        if context in seen_contexts:
+            duplicates += 1
+            context = ""
+        else:
+            seen_contexts.add(context)
+            if select_sentences and max_context_tokens:
+                context = select_relevant_sentences(query, context, max_context_tokens)
+
+        remaining = token_budget - used - (2 if parts else 0)
+        text = format_document(doc, context)
+        if count_tokens(text) > remaining:
+            header = format_document(doc, "")
+            # Only worth including if the question and answer fit with a little context
+            context_room = remaining - count_tokens(header) - count_tokens("\ncontext: ")
+            if context_room <= 0:
+                break
+            text = format_document(doc, truncate_to_tokens(context, context_room))
+            truncated += 1
+        parts.append(text)
+        used += count_tokens(text) + (2 if len(parts) > 1 else 0)
+
+    context = "\n\n".join(parts)
+    return context, {
+        'documents_used': len(parts),
+        'documents_dropped': len(search_results) - len(parts),
+        'documents_truncated': truncated,
+        'duplicate_contexts': duplicates,
+        'context_tokens': count_tokens(context),
+        'tokens_saved': count_tokens(full_context) - count_tokens(context),
+    }
@@ -0,0 +1,77 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from assistant import EMPTY_TOKENS, evaluate_relevance, update_cached_relevance
+from db import update_relevance
+from tracing import span, trace
+
+
+RELEVANCE_WORKERS = int(os.getenv("RELEVANCE_WORKERS", "2"))
+RELEVANCE_MAX_QUEUE = int(os.getenv("RELEVANCE_MAX_QUEUE", "100"))
+RELEVANCE_MAX_RETRIES = int(os.getenv("RELEVANCE_MAX_RETRIES", "3"))
+RELEVANCE_RETRY_DELAY = float(os.getenv("RELEVANCE_RETRY_DELAY", "2"))
+
+_executor = ThreadPoolExecutor(max_workers=RELEVANCE_WORKERS, thread_name_prefix="relevance")
+# Bounds the jobs that are queued or running so a slow judge cannot pile up work
+_slots = threading.BoundedSemaphore(RELEVANCE_MAX_QUEUE)
+# Marks skipped conversations UNKNOWN off the request thread, without waiting behind the judge calls
+_status_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="relevance-status")
+
+
+def print_log(message):
+    print(message, flush=True)
+
+
+def evaluate_and_store(conversation_id, question, answer, cache_key=None):
+    result = None
+    stage_timings = None
+    for attempt in range(1, RELEVANCE_MAX_RETRIES + 1):
+        try:
+            if result is None:
+                with trace() as current, span("judge"):
+                    result = evaluate_relevance(question, answer)
+                stage_timings = current.timings if current else None
+            relevance, explanation, eval_tokens = result
+            # The row may not be committed yet when the judge is quick, so 0 rows is retried too
+            if update_relevance(conversation_id, relevance, explanation, eval_tokens, stage_timings):
+                print_log(f"Relevance for conversation {conversation_id}: {relevance}")
+                # Later hits on the cached answer reuse this verdict
+                update_cached_relevance(cache_key, relevance, explanation)
+                return relevance
+            print_log(f"Conversation {conversation_id} not found yet (attempt {attempt})")
+        except Exception as e:
+            print_log(f"Relevance evaluation for {conversation_id} failed (attempt {attempt}): {e}")
+        if attempt < RELEVANCE_MAX_RETRIES:
+            time.sleep(RELEVANCE_RETRY_DELAY * 2 ** (attempt - 1))
+
+    mark_unknown(conversation_id, "Failed to evaluate relevance")
+    return "UNKNOWN"
+
+
+def mark_unknown(conversation_id, explanation):
+    try:
+        update_relevance(conversation_id, "UNKNOWN", explanation, EMPTY_TOKENS)
+    except Exception as e:
+        print_log(f"Could not mark conversation {conversation_id} as UNKNOWN: {e}")
+
+
+def _run(conversation_id, question, answer, cache_key):
+    try:
+        return evaluate_and_store(conversation_id, question, answer, cache_key)
+    finally:
+        _slots.release()
+
+
+def submit_relevance_evaluation(conversation_id, question, answer, cache_key=None):
+    """ Queue the LLM-as-judge call for a saved conversation, returns False when the queue is full
+
+    cache_key is the answer cache entry the verdict is also stored on.
+    """
+    if not _slots.acquire(blocking=False):
+        print_log(f"Relevance queue full, skipping evaluation for {conversation_id}")
+        _status_executor.submit(mark_unknown, conversation_id, "Relevance evaluation queue was full")
+        return False
+    _executor.submit(_run, conversation_id, question, answer, cache_key)
+    return True
@@ -0,0 +1,90 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+from cache import TTLCache, normalize_query
+
+
+RERANK_MODEL = os.getenv("RERANK_MODEL", "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1")
+RERANK_TOP_K = int(os.getenv("RERANK_TOP_K", "3"))
+RERANK_LATENCY_BUDGET = float(os.getenv("RERANK_LATENCY_BUDGET", "0.5"))
+RERANK_BATCH_SIZE = int(os.getenv("RERANK_BATCH_SIZE", "32"))
+# Scoring jobs queued or running, further requests keep the fused order instead of waiting
+RERANK_MAX_PENDING = int(os.getenv("RERANK_MAX_PENDING", "2"))
+
+_score_cache = TTLCache(int(os.getenv("RERANK_CACHE_ENTRIES", "10000")), float(os.getenv("CACHE_TTL", "3600")))
+# Scoring runs here so a call that blows the budget can finish and still fill the cache
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="rerank")
+_model = None
+_model_lock = threading.Lock()
+_pending = {'count': 0}
+_pending_lock = threading.Lock()
+
+
+def get_cross_encoder():
+    global _model
+    with _model_lock:
+        if _model is None:
+            from sentence_transformers import CrossEncoder
+            print(f"Loading rerank model: {RERANK_MODEL}")
+            _model = CrossEncoder(RERANK_MODEL, device="cpu")
+        return _model
+
+
+def score_documents(query, documents):
+    """ Score all (query, document) pairs in one batched forward pass and cache the scores """
+    pairs = [(query, f"{doc['question']} {doc['answer']} {doc['context']}") for doc in documents]
+    scores = get_cross_encoder().predict(pairs, batch_size=RERANK_BATCH_SIZE)
+    key = normalize_query(query)
+    for doc, score in zip(documents, scores):
+        _score_cache.set((key, doc['id']), float(score))
+    return [float(score) for score in scores]
+
+
+def score_before(deadline, query, documents):
+    """ score_documents, skipped when the job only starts after its request has given up waiting """
+    try:
+        if time.monotonic() > deadline:
+            return None
+        return score_documents(query, documents)
+    finally:
+        with _pending_lock:
+            _pending['count'] -= 1
+
+
+def rerank(query, documents, top_k=RERANK_TOP_K, latency_budget=RERANK_LATENCY_BUDGET):
+    """ Best top_k documents by cross-encoder score, or the incoming order if scoring is too slow """
+    key = normalize_query(query)
+    scores = [_score_cache.get((key, doc['id'])) for doc in documents]
+    missing = [i for i, score in enumerate(scores) if score is None]
+
+    if missing:
+        with _pending_lock:
+            busy = _pending['count'] >= RERANK_MAX_PENDING
+            if not busy:
+                _pending['count'] += 1
+        if busy:
+            print("Reranker busy, keeping fused order")
+            return documents[:top_k]
+        deadline = time.monotonic() + latency_budget
+        future = _executor.submit(score_before, deadline, query, [documents[i] for i in missing])
+        try:
+            missing_scores = future.result(timeout=latency_budget)
+            if missing_scores is None:
+                raise TimeoutError()
+            for i, score in zip(missing, missing_scores):
+                scores[i] = score
+        except TimeoutError:
+            print(f"Rerank exceeded {latency_budget:.2f}s, keeping fused order")
+            return documents[:top_k]
+        except Exception as e:
+            print(f"Rerank failed, keeping fused order: {e}")
+            return documents[:top_k]
+
+    order = sorted(range(len(documents)), key=lambda i: -scores[i])
+    return [documents[i] for i in order[:top_k]]
+
+
+def warm_up():
+    score_documents("warm up", [{'id': '__warm_up__', 'question': '', 'answer': '', 'context': 'warm up'}])
@@ -0,0 +1,256 @@
+import argparse
+
+from db import db_connection
+
+
+# Per-minute aggregates kept up to date by triggers on conversations and feedback, so
+# dashboard queries read a few rows per minute instead of scanning the raw tables.
+# Latencies are counted in histogram buckets: bucket i holds values below LATENCY_BOUNDS[i],
+# the last one everything above the largest bound.
+LATENCY_BOUNDS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60]
+
+ROLLUP_TABLES = ["conversation_rollups", "stage_rollups", "feedback_rollups"]
+
+ROLLUP_DDL = f"""
+CREATE OR REPLACE FUNCTION rollup_latency_bounds() RETURNS FLOAT8[] AS $$
+    SELECT ARRAY{LATENCY_BOUNDS}::FLOAT8[]
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION rollup_empty_histogram() RETURNS INTEGER[] AS $$
+    SELECT array_fill(0, ARRAY[array_length(rollup_latency_bounds(), 1) + 1])
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION rollup_latency_bucket(seconds FLOAT8) RETURNS INTEGER AS $$
+    SELECT width_bucket(seconds, rollup_latency_bounds()) + 1
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE FUNCTION rollup_histogram_add(a INTEGER[], b INTEGER[]) RETURNS INTEGER[] AS $$
+    SELECT CASE
+        WHEN a IS NULL THEN b
+        ELSE ARRAY(SELECT x + y FROM unnest(a, b) WITH ORDINALITY AS t(x, y, i) ORDER BY i)
+    END
+$$ LANGUAGE sql IMMUTABLE;
+
+CREATE OR REPLACE AGGREGATE rollup_histogram_merge(INTEGER[]) (
+    SFUNC = rollup_histogram_add,
+    STYPE = INTEGER[]
+);
+
+-- Upper bound of the bucket holding the q-th quantile, the largest bound for the overflow bucket
+CREATE OR REPLACE FUNCTION rollup_percentile(histogram INTEGER[], q FLOAT8) RETURNS FLOAT8 AS $$
+DECLARE
+    bounds FLOAT8[] := rollup_latency_bounds();
+    total BIGINT;
+    seen BIGINT := 0;
+BEGIN
+    SELECT COALESCE(SUM(n), 0) INTO total FROM unnest(histogram) AS n;
+    IF total = 0 THEN
+        RETURN NULL;
+    END IF;
+    FOR i IN 1 .. array_length(histogram, 1) LOOP
+        seen := seen + histogram[i];
+        IF seen >= q * total THEN
+            RETURN bounds[LEAST(i, array_length(bounds, 1))];
+        END IF;
+    END LOOP;
+    RETURN bounds[array_length(bounds, 1)];
+END
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+CREATE TABLE IF NOT EXISTS conversation_rollups (
+    bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+    model_used TEXT NOT NULL,
+    group_name TEXT NOT NULL,
+    conversations INTEGER NOT NULL DEFAULT 0,
+    response_time_sum FLOAT8 NOT NULL DEFAULT 0,
+    latency_histogram INTEGER[] NOT NULL DEFAULT rollup_empty_histogram(),
+    time_to_first_token_sum FLOAT8 NOT NULL DEFAULT 0,
+    time_to_first_token_count INTEGER NOT NULL DEFAULT 0,
+    tokens_per_second_sum FLOAT8 NOT NULL DEFAULT 0,
+    tokens_per_second_count INTEGER NOT NULL DEFAULT 0,
+    prompt_tokens BIGINT NOT NULL DEFAULT 0,
+    completion_tokens BIGINT NOT NULL DEFAULT 0,
+    total_tokens BIGINT NOT NULL DEFAULT 0,
+    eval_total_tokens BIGINT NOT NULL DEFAULT 0,
+    groq_cost FLOAT8 NOT NULL DEFAULT 0,
+    relevant INTEGER NOT NULL DEFAULT 0,
+    partly_relevant INTEGER NOT NULL DEFAULT 0,
+    non_relevant INTEGER NOT NULL DEFAULT 0,
+    pending INTEGER NOT NULL DEFAULT 0,
+    unknown INTEGER NOT NULL DEFAULT 0,
+    cache_hits INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (bucket, model_used, group_name)
+);
+
+-- Rollups created before answers were cached
+ALTER TABLE conversation_rollups ADD COLUMN IF NOT EXISTS cache_hits INTEGER NOT NULL DEFAULT 0;
+
+CREATE TABLE IF NOT EXISTS stage_rollups (
+    bucket TIMESTAMP WITH TIME ZONE NOT NULL,
+    stage TEXT NOT NULL,
+    samples INTEGER NOT NULL DEFAULT 0,
+    seconds_sum FLOAT8 NOT NULL DEFAULT 0,
+    latency_histogram INTEGER[] NOT NULL DEFAULT rollup_empty_histogram(),
+    PRIMARY KEY (bucket, stage)
+);
+
+CREATE TABLE IF NOT EXISTS feedback_rollups (
+    bucket TIMESTAMP WITH TIME ZONE PRIMARY KEY,
+    thumbs_up INTEGER NOT NULL DEFAULT 0,
+    thumbs_down INTEGER NOT NULL DEFAULT 0
+);
+
+-- Adds (sign = 1) or removes (sign = -1) one conversation from its rollups
+CREATE OR REPLACE FUNCTION rollup_apply_conversation(c conversations, sign INTEGER) RETURNS VOID AS $$
+DECLARE
+    minute TIMESTAMP WITH TIME ZONE := date_trunc('minute', c.timestamp);
+    latency_bucket INTEGER := rollup_latency_bucket(c.response_time);
+    timing RECORD;
+BEGIN
+    INSERT INTO conversation_rollups (bucket, model_used, group_name)
+    VALUES (minute, c.model_used, c.group_name)
+    ON CONFLICT (bucket, model_used, group_name) DO NOTHING;
+
+    UPDATE conversation_rollups AS r SET
+        conversations = r.conversations + sign,
+        response_time_sum = r.response_time_sum + sign * c.response_time,
+        latency_histogram[latency_bucket] = r.latency_histogram[latency_bucket] + sign,
+        time_to_first_token_sum = r.time_to_first_token_sum + sign * COALESCE(c.time_to_first_token, 0),
+        time_to_first_token_count = r.time_to_first_token_count + sign * (c.time_to_first_token IS NOT NULL)::INTEGER,
+        tokens_per_second_sum = r.tokens_per_second_sum + sign * COALESCE(c.tokens_per_second, 0),
+        tokens_per_second_count = r.tokens_per_second_count + sign * (c.tokens_per_second IS NOT NULL)::INTEGER,
+        prompt_tokens = r.prompt_tokens + sign * c.prompt_tokens,
+        completion_tokens = r.completion_tokens + sign * c.completion_tokens,
+        total_tokens = r.total_tokens + sign * c.total_tokens,
+        eval_total_tokens = r.eval_total_tokens + sign * c.eval_total_tokens,
+        groq_cost = r.groq_cost + sign * c.groq_cost,
+        relevant = r.relevant + sign * (c.relevance = 'RELEVANT')::INTEGER,
+        partly_relevant = r.partly_relevant + sign * (c.relevance = 'PARTLY_RELEVANT')::INTEGER,
+        non_relevant = r.non_relevant + sign * (c.relevance = 'NON_RELEVANT')::INTEGER,
+        pending = r.pending + sign * (c.relevance = 'PENDING')::INTEGER,
+        unknown = r.unknown + sign * (c.relevance NOT IN ('RELEVANT', 'PARTLY_RELEVANT', 'NON_RELEVANT', 'PENDING'))::INTEGER,
+        cache_hits = r.cache_hits + sign * COALESCE(c.cache_hit, FALSE)::INTEGER
+    WHERE r.bucket = minute AND r.model_used = c.model_used AND r.group_name = c.group_name;
+
+    IF c.stage_timings IS NOT NULL THEN
+        FOR timing IN SELECT key, value::FLOAT8 AS seconds FROM jsonb_each_text(c.stage_timings) LOOP
+            latency_bucket := rollup_latency_bucket(timing.seconds);
+            INSERT INTO stage_rollups (bucket, stage)
+            VALUES (minute, timing.key)
+            ON CONFLICT (bucket, stage) DO NOTHING;
+
+            UPDATE stage_rollups AS r SET
+                samples = r.samples + sign,
+                seconds_sum = r.seconds_sum + sign * timing.seconds,
+                latency_histogram[latency_bucket] = r.latency_histogram[latency_bucket] + sign
+            WHERE r.bucket = minute AND r.stage = timing.key;
+        END LOOP;
+    END IF;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION rollup_conversations_trigger() RETURNS TRIGGER AS $$
+BEGIN
+    -- An update (e.g. the async judge filling in relevance) moves the row between counters
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM rollup_apply_conversation(OLD, -1);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        PERFORM rollup_apply_conversation(NEW, 1);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION rollup_feedback_trigger() RETURNS TRIGGER AS $$
+DECLARE
+    sign INTEGER := 1;
+    f feedback := NEW;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        sign := -1;
+        f := OLD;
+    END IF;
+    INSERT INTO feedback_rollups AS r (bucket, thumbs_up, thumbs_down)
+    VALUES (
+        date_trunc('minute', f.timestamp),
+        sign * (f.feedback > 0)::INTEGER,
+        sign * (f.feedback < 0)::INTEGER
+    )
+    ON CONFLICT (bucket) DO UPDATE SET
+        thumbs_up = r.thumbs_up + EXCLUDED.thumbs_up,
+        thumbs_down = r.thumbs_down + EXCLUDED.thumbs_down;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS conversations_rollup ON conversations;
+CREATE TRIGGER conversations_rollup
+    AFTER INSERT OR UPDATE OR DELETE ON conversations
+    FOR EACH ROW EXECUTE FUNCTION rollup_conversations_trigger();
+
+DROP TRIGGER IF EXISTS feedback_rollup ON feedback;
+CREATE TRIGGER feedback_rollup
+    AFTER INSERT OR DELETE ON feedback
+    FOR EACH ROW EXECUTE FUNCTION rollup_feedback_trigger();
+"""
+
+INDEX_DDL = """
+CREATE INDEX IF NOT EXISTS conversations_timestamp_idx ON conversations (timestamp);
+CREATE INDEX IF NOT EXISTS conversations_relevance_timestamp_idx ON conversations (relevance, timestamp);
+CREATE INDEX IF NOT EXISTS feedback_conversation_id_idx ON feedback (conversation_id);
+CREATE INDEX IF NOT EXISTS feedback_timestamp_idx ON feedback (timestamp);
+"""
+
+
+def create_rollups(cur):
+    """ Create the indexes, rollup tables, functions and triggers, safe to run again """
+    cur.execute(INDEX_DDL)
+    cur.execute(ROLLUP_DDL)
+
+
+def backfill_rollups(cur):
+    """ Add every raw row to the (empty) rollups, returns the number of conversations """
+    cur.execute("SELECT rollup_apply_conversation(c, 1) FROM conversations c")
+    conversations = cur.rowcount
+    cur.execute("""
+        INSERT INTO feedback_rollups (bucket, thumbs_up, thumbs_down)
+        SELECT date_trunc('minute', timestamp),
+               COUNT(*) FILTER (WHERE feedback > 0),
+               COUNT(*) FILTER (WHERE feedback < 0)
+        FROM feedback
+        GROUP BY 1
+    """)
+    return conversations
+
+
+def rebuild_rollups():
+    """ Recompute every rollup from the raw tables, e.g. after changing LATENCY_BOUNDS """
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            # Blocks writers so no row is counted twice or missed while rebuilding
+            cur.execute("LOCK TABLE conversations, feedback IN SHARE MODE")
+            cur.execute("DROP TABLE IF EXISTS " + ", ".join(ROLLUP_TABLES))
+            create_rollups(cur)
+            conversations = backfill_rollups(cur)
+        conn.commit()
+    print(f"Rebuilt rollups from {conversations} conversations")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Dashboard rollup tables")
+    parser.add_argument("command", choices=["create", "rebuild"])
+    args = parser.parse_args()
+
+    if args.command == "create":
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                create_rollups(cur)
+            conn.commit()
+        print("Rollups created")
+    else:
+        rebuild_rollups()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,541 @@
+import os
+import json
+import time
+import asyncio
+import argparse
+
+from aiohttp import web
+from elasticsearch import AsyncElasticsearch
+from groq import AsyncGroq
+
+import db_async
+from assistant import (
+    ELASTIC_URL, GROQ_API_KEY, INDEX_NAME, JUDGE_MODEL, RERANK_ENABLED, SOURCE_FIELDS, VECTOR_BACKEND,
+    EMPTY_TOKENS, apply_index_version, build_answer_data, build_prompt_with_stats, cached_answer, check_responses,
+    encode_query, fuse_rrf,
+    get_knn_search, hybrid_search_bodies, index_version_check_due, index_version_from_mappings, invalidate_caches,
+    knn_search_body, model_loaded, parse_relevance, relevance_prompt, search_index, search_results_cache, search_size,
+    store_answer, stream_stats, tokens_from_usage, update_cached_relevance, warm_up,
+)
+from cache import normalize_query
+from relevance_worker import RELEVANCE_MAX_QUEUE, RELEVANCE_MAX_RETRIES, RELEVANCE_RETRY_DELAY, RELEVANCE_WORKERS
+from rerank import rerank
+from tracing import failed_stage, record, span, start_exporter, trace
+
+
+SERVICE_HOST = os.getenv("SERVICE_HOST", "0.0.0.0")
+SERVICE_PORT = int(os.getenv("SERVICE_PORT", "8000"))
+# Requests answered at once by this worker, the rest get 503 so the load balancer tries another one
+SERVICE_MAX_IN_FLIGHT = int(os.getenv("SERVICE_MAX_IN_FLIGHT", "32"))
+SERVICE_REQUEST_TIMEOUT = float(os.getenv("SERVICE_REQUEST_TIMEOUT", "60"))
+SERVICE_RETRY_AFTER = int(os.getenv("SERVICE_RETRY_AFTER", "1"))
+# Whole budget of a stopping worker: in-flight requests, then queued judge calls, then
+# cancelled judge calls marking their rows UNKNOWN. Keep it below the container's
+# stop_grace_period (40s in docker-compose.yaml), or the worker is killed halfway.
+SERVICE_SHUTDOWN_TIMEOUT = float(os.getenv("SERVICE_SHUTDOWN_TIMEOUT", "30"))
+# Part of that budget kept for the cancelled judge calls
+SERVICE_CANCEL_TIMEOUT = float(os.getenv("SERVICE_CANCEL_TIMEOUT", "5"))
+# A failed warm up (ES or the model store not reachable yet) is tried again after this many seconds
+SERVICE_WARM_UP_RETRY_DELAY = float(os.getenv("SERVICE_WARM_UP_RETRY_DELAY", "10"))
+
+DEFAULT_GROUP = "General"
+DEFAULT_MODEL = 'groq/llama3-8b-8192'
+SEARCH_TYPES = ("Vector", "Hybrid")
+
+
+def print_log(message):
+    print(message, flush=True)
+
+
+class ServiceState:
+    def __init__(self):
+        self.es = None
+        self.groq = None
+        self.model_task = None
+        self.model_error = None
+        self.in_flight = 0
+        self.shutting_down = False
+        self.shutdown_deadline = None
+        self.judge_tasks = set()
+        # Created on startup, inside the event loop it belongs to
+        self.judge_slots = None
+
+
+state_key = web.AppKey("state", ServiceState)
+
+
+class BadRequest(ValueError):
+    pass
+
+
+def json_response(data, status=200, headers=None):
+    # Timestamps from Postgres are not JSON serializable
+    return web.json_response(data, status=status, headers=headers, dumps=lambda value: json.dumps(value, default=str))
+
+
+def error_response(status, message, **extra):
+    headers = {"Retry-After": str(SERVICE_RETRY_AFTER)} if status == 503 else None
+    return json_response({"error": message, **extra}, status=status, headers=headers)
+
+
+# Search, the same steps as assistant.search with non-blocking Elasticsearch calls
+
+async def check_index_version_async(es, index_name=INDEX_NAME):
+    if not index_version_check_due():
+        return
+    try:
+        version = index_version_from_mappings(await es.indices.get_mapping(index=index_name))
+    except Exception as e:
+        print_log(f"Could not read index version: {e}")
+        invalidate_caches()
+        return
+    apply_index_version(version, index_name)
+
+
+async def fetch_missing_sources_async(es, fused, index_name):
+    missing = [doc_id for doc_id, _, source in fused if source is None]
+    fetched = {}
+    if missing:
+        with span("fetch_sources"):
+            docs = (await es.mget(index=index_name, ids=missing, _source=SOURCE_FIELDS))['docs']
+        fetched = {doc['_id']: doc['_source'] for doc in docs if doc.get('found')}
+
+    final_results = []
+    for doc_id, _, source in fused:
+        if source is None:
+            source = fetched.get(doc_id)
+        if source is not None:
+            final_results.append(source)
+    return final_results
+
+
+async def hybrid_search_async(es, field, query, vector, group, top_n, size, index_name=None):
+    index_name = search_index(group, index_name)
+    knn_body, keyword_body = hybrid_search_bodies(field, query, vector, group, size)
+    with span("msearch"):
+        responses = (await es.msearch(index=index_name, searches=[{}, knn_body, {}, keyword_body]))['responses']
+    check_responses(responses)
+    with span("fuse"):
+        fused = fuse_rrf([responses[0]['hits']['hits'], responses[1]['hits']['hits']], [1.0, 1.0], 60, top_n)
+    return await fetch_missing_sources_async(es, fused, index_name)
+
+
+async def knn_search_async(es, field, vector, group, k, index_name=None):
+    if VECTOR_BACKEND == "numpy":
+        return await asyncio.to_thread(get_knn_search(), field, vector, group, k=k)
+    response = await es.search(index=search_index(group, index_name), body=knn_search_body(field, vector, group, k))
+    return [hit["_source"] for hit in response["hits"]["hits"]]
+
+
+async def search_async(es, query, group, search_type, field='question_vector'):
+    if search_type != 'Vector' or VECTOR_BACKEND != "numpy":
+        await check_index_version_async(es)
+
+    size = search_size()
+    with span("search"):
+        key = (normalize_query(query), group, search_type, field, size)
+        search_results = search_results_cache.get(key)
+        if search_results is None:
+            # The encoder and reranker are CPU bound, they run off the event loop
+            vector = await asyncio.to_thread(encode_query, query)
+            if search_type == 'Vector':
+                with span("knn"):
+                    search_results = await knn_search_async(es, field, vector, group, size)
+            else:
+                with span("hybrid"):
+                    search_results = await hybrid_search_async(es, field, query, vector, group, size, max(10, size))
+            search_results_cache.set(key, search_results)
+        if RERANK_ENABLED:
+            with span("rerank"):
+                search_results = await asyncio.to_thread(rerank, query, search_results)
+    return search_results
+
+
+# LLM calls
+
+def groq_model(model_choice):
+    if not model_choice.startswith('groq/'):
+        raise BadRequest(f"Unknown model choice: {model_choice}")
+    return model_choice.split('/')[-1]
+
+
+async def llm_async(groq, prompt, model_choice):
+    start_time = time.time()
+    response = await groq.chat.completions.create(
+        model=groq_model(model_choice),
+        messages=[{"role": "user", "content": prompt}]
+    )
+    return response.choices[0].message.content, tokens_from_usage(response.usage), time.time() - start_time
+
+
+async def llm_stream_async(groq, prompt, model_choice, stats):
+    """ Async llm_stream, stats is filled in once the stream is exhausted """
+    start_time = time.time()
+    stream = await groq.chat.completions.create(
+        model=groq_model(model_choice),
+        messages=[{"role": "user", "content": prompt}],
+        stream=True
+    )
+
+    first_token_time = None
+    parts = []
+    usage = None
+    async for chunk in stream:
+        if chunk.choices and chunk.choices[0].delta.content:
+            if first_token_time is None:
+                first_token_time = time.time()
+            parts.append(chunk.choices[0].delta.content)
+            yield chunk.choices[0].delta.content
+        x_groq = getattr(chunk, 'x_groq', None)
+        if x_groq is not None and getattr(x_groq, 'usage', None) is not None:
+            usage = x_groq.usage
+
+    stats.update(stream_stats(prompt, parts, usage, start_time, first_token_time, time.time()))
+
+
+async def evaluate_relevance_async(groq, question, answer):
+    evaluation, tokens, _ = await llm_async(groq, relevance_prompt(question, answer), JUDGE_MODEL)
+    return parse_relevance(evaluation, tokens)
+
+
+# Answers
+
+async def get_answer_async(state, query, group, model_choice, search_type):
+    start_time = time.perf_counter()
+    with trace() as current:
+        search_results = await search_async(state.es, query, group, search_type)
+        # The answer cache lives in Postgres behind psycopg2, so it is used from a worker thread
+        ref, answer_data = await asyncio.to_thread(cached_answer, query, search_results, model_choice, True)
+        if answer_data is None:
+            with span("prompt"):
+                prompt, prompt_stats = build_prompt_with_stats(query, search_results, model_choice)
+            with span("llm"):
+                answer, tokens, response_time = await llm_async(state.groq, prompt, model_choice)
+            tokens_per_second = tokens['completion_tokens'] / response_time if response_time > 0 else None
+            answer_data = build_answer_data(query, answer, tokens, response_time, model_choice, True, response_time, tokens_per_second)
+            answer_data['prompt_tokens_saved'] = prompt_stats['tokens_saved']
+            await asyncio.to_thread(store_answer, ref, answer_data)
+        record("total", time.perf_counter() - start_time)
+    answer_data['stage_timings'] = current.timings if current else None
+    return answer_data
+
+
+async def get_answer_stream_async(state, query, group, model_choice, search_type, answer_data):
+    """ Yields answer tokens, answer_data is filled in once the stream is exhausted """
+    start_time = time.perf_counter()
+    with trace() as current:
+        search_results = await search_async(state.es, query, group, search_type)
+        ref, cached = await asyncio.to_thread(cached_answer, query, search_results, model_choice, True)
+        if cached is not None:
+            yield cached['answer']
+            answer_data.update(cached)
+        else:
+            with span("prompt"):
+                prompt, prompt_stats = build_prompt_with_stats(query, search_results, model_choice)
+            stats = {}
+            with span("llm"):
+                async for token in llm_stream_async(state.groq, prompt, model_choice, stats):
+                    yield token
+            answer_data.update(build_answer_data(
+                query, stats['answer'], stats['tokens'], stats['response_time'], model_choice, True,
+                stats['time_to_first_token'], stats['tokens_per_second']
+            ))
+            answer_data['prompt_tokens_saved'] = prompt_stats['tokens_saved']
+            await asyncio.to_thread(store_answer, ref, answer_data)
+        record("total", time.perf_counter() - start_time)
+    answer_data['stage_timings'] = current.timings if current else None
+
+
+async def mark_unknown(conversation_id, explanation):
+    try:
+        await db_async.update_relevance(conversation_id, "UNKNOWN", explanation, EMPTY_TOKENS)
+    except Exception as e:
+        print_log(f"Could not mark conversation {conversation_id} as UNKNOWN: {e}")
+
+
+async def judge_and_store(state, conversation_id, question, answer, cache_key=None):
+    """ relevance_worker.evaluate_and_store for the async clients, the row is already saved
+
+    At most RELEVANCE_WORKERS judge calls run at once per worker, like the threaded pool.
+    The judge is called once, a failed write is retried with the verdict it already has.
+    """
+    result = None
+    stage_timings = None
+    stored = False
+    try:
+        for attempt in range(1, RELEVANCE_MAX_RETRIES + 1):
+            try:
+                if result is None:
+                    async with state.judge_slots:
+                        with trace() as current, span("judge"):
+                            result = await evaluate_relevance_async(state.groq, question, answer)
+                    stage_timings = current.timings if current else None
+                relevance, explanation, eval_tokens = result
+                if not stored:
+                    await db_async.update_relevance(conversation_id, relevance, explanation, eval_tokens, stage_timings)
+                    stored = True
+                    print_log(f"Relevance for conversation {conversation_id}: {relevance}")
+                await asyncio.to_thread(update_cached_relevance, cache_key, relevance, explanation)
+                return relevance
+            except Exception as e:
+                print_log(f"Relevance evaluation for {conversation_id} failed (attempt {attempt}): {e}")
+            if attempt < RELEVANCE_MAX_RETRIES:
+                await asyncio.sleep(RELEVANCE_RETRY_DELAY * 2 ** (attempt - 1))
+    except asyncio.CancelledError:
+        # Cancelled at shutdown, the row would otherwise stay PENDING for good
+        if not stored:
+            await mark_unknown(conversation_id, "Relevance evaluation was cancelled at shutdown")
+        raise
+
+    if stored:
+        # Only the answer cache missed the verdict, the conversation has it
+        return result[0]
+    await mark_unknown(conversation_id, "Failed to evaluate relevance")
+    return "UNKNOWN"
+
+
+async def save_and_judge(state, conversation_id, question, answer_data, group):
+    conversation_id = await db_async.save_conversation(conversation_id, question, answer_data, group)
+    # A cached answer that was already judged keeps its verdict
+    if answer_data['relevance'] != "PENDING":
+        return conversation_id
+    if len(state.judge_tasks) >= RELEVANCE_MAX_QUEUE:
+        print_log(f"Relevance queue full, skipping evaluation for {conversation_id}")
+        await mark_unknown(conversation_id, "Relevance evaluation queue was full")
+        return conversation_id
+    task = asyncio.create_task(
+        judge_and_store(state, conversation_id, question, answer_data['answer'], answer_data.get('cache_key'))
+    )
+    state.judge_tasks.add(task)
+    task.add_done_callback(state.judge_tasks.discard)
+    return conversation_id
+
+
+async def answer_request(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        raise BadRequest("Body must be JSON")
+    question = (body.get("question") or "").strip()
+    if not question:
+        raise BadRequest("question is required")
+    search_type = body.get("search_type", "Vector")
+    if search_type not in SEARCH_TYPES:
+        raise BadRequest(f"search_type must be one of {', '.join(SEARCH_TYPES)}")
+    model_choice = body.get("model_choice", DEFAULT_MODEL)
+    groq_model(model_choice)
+    return question, body.get("group", DEFAULT_GROUP), model_choice, search_type, body.get("conversation_id")
+
+
+# Handlers
+
+@web.middleware
+async def limit_in_flight(request, handler):
+    """ Bound the answers in progress and refuse new ones while loading or stopping """
+    if not request.path.startswith("/answer"):
+        return await handler(request)
+    state = request.app[state_key]
+    if state.shutting_down:
+        return error_response(503, "Shutting down")
+    if not model_loaded():
+        return error_response(503, "Model is still loading")
+    if state.in_flight >= SERVICE_MAX_IN_FLIGHT:
+        return error_response(503, "Too many requests in flight")
+    state.in_flight += 1
+    try:
+        return await handler(request)
+    finally:
+        state.in_flight -= 1
+
+
+async def answer(request):
+    state = request.app[state_key]
+    try:
+        question, group, model_choice, search_type, conversation_id = await answer_request(request)
+        answer_data = await asyncio.wait_for(
+            get_answer_async(state, question, group, model_choice, search_type), SERVICE_REQUEST_TIMEOUT
+        )
+        conversation_id = await save_and_judge(state, conversation_id, question, answer_data, group)
+    except BadRequest as e:
+        return error_response(400, str(e))
+    except asyncio.TimeoutError:
+        return error_response(504, f"No answer within {SERVICE_REQUEST_TIMEOUT:.0f} seconds")
+    except Exception as e:
+        print_log(f"Answer failed in stage {failed_stage(e)}: {e}")
+        return error_response(500, f"{e.__class__.__name__}: {e}", stage=failed_stage(e))
+    return json_response({"conversation_id": conversation_id, "answer_data": answer_data})
+
+
+async def answer_stream(request):
+    """ Newline-delimited JSON: {"token": ...} lines, then {"answer_data": ..., "conversation_id": ...} or {"error": ...} """
+    state = request.app[state_key]
+    try:
+        question, group, model_choice, search_type, conversation_id = await answer_request(request)
+    except BadRequest as e:
+        return error_response(400, str(e))
+
+    response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+    await response.prepare(request)
+
+    async def send(data):
+        await response.write((json.dumps(data, ensure_ascii=False, default=str) + "\n").encode("utf-8"))
+
+    answer_data = {}
+    tokens = get_answer_stream_async(state, question, group, model_choice, search_type, answer_data)
+
+    async def send_tokens():
+        # One task for the whole stream, so the trace's context variables survive between tokens
+        async for token in tokens:
+            await send({"token": token})
+
+    try:
+        await asyncio.wait_for(send_tokens(), SERVICE_REQUEST_TIMEOUT)
+        conversation_id = await save_and_judge(state, conversation_id, question, answer_data, group)
+        await send({"answer_data": answer_data, "conversation_id": conversation_id})
+    except asyncio.TimeoutError:
+        await send({"error": f"No answer within {SERVICE_REQUEST_TIMEOUT:.0f} seconds"})
+    except ConnectionResetError:
+        print_log("Client disconnected during streaming")
+    except Exception as e:
+        print_log(f"Streaming answer failed in stage {failed_stage(e)}: {e}")
+        await send({"error": f"{e.__class__.__name__}: {e}", "stage": failed_stage(e)})
+    finally:
+        await tokens.aclose()
+    await response.write_eof()
+    return response
+
+
+async def feedback(request):
+    try:
+        body = await request.json()
+        conversation_id = body["conversation_id"]
+        value = int(body["feedback"])
+    except (ValueError, KeyError, TypeError):
+        return error_response(400, "conversation_id and feedback are required")
+    if value not in (1, -1):
+        return error_response(400, "feedback must be 1 or -1")
+    await db_async.save_feedback(conversation_id, value)
+    return json_response({"status": "ok"})
+
+
+async def recent_conversations(request):
+    try:
+        limit = int(request.query.get("limit", "5"))
+    except ValueError:
+        return error_response(400, "limit must be an integer")
+    return json_response(await db_async.get_recent_conversations(limit, request.query.get("relevance")))
+
+
+async def feedback_stats(request):
+    return json_response(await db_async.get_feedback_stats())
+
+
+async def healthz(request):
+    return json_response({"status": "ok"})
+
+
+async def readyz(request):
+    """ Ready once the query encoder is loaded, not ready again while shutting down """
+    state = request.app[state_key]
+    ready = model_loaded() and not state.shutting_down
+    return json_response({
+        "ready": ready,
+        "model_loaded": model_loaded(),
+        "model_error": state.model_error,
+        "shutting_down": state.shutting_down,
+        "in_flight": state.in_flight,
+        "max_in_flight": SERVICE_MAX_IN_FLIGHT,
+        "judge_queue": len(state.judge_tasks),
+    }, status=200 if ready else 503)
+
+
+# Lifecycle
+
+async def keep_warming_up(state):
+    """ Warm up until it succeeds, a worker that never loads its encoder would stay unready forever """
+    attempt = 1
+    while not state.shutting_down:
+        try:
+            await asyncio.to_thread(warm_up)
+            state.model_error = None
+            return
+        except Exception as e:
+            state.model_error = str(e)
+            print_log(f"Warm up failed (attempt {attempt}), retrying in {SERVICE_WARM_UP_RETRY_DELAY}s: {e}")
+        attempt += 1
+        await asyncio.sleep(SERVICE_WARM_UP_RETRY_DELAY)
+
+
+async def on_startup(app):
+    state = app[state_key]
+    state.es = AsyncElasticsearch(ELASTIC_URL)
+    state.groq = AsyncGroq(api_key=GROQ_API_KEY)
+    state.judge_slots = asyncio.Semaphore(RELEVANCE_WORKERS)
+    await db_async.get_pool()
+    # Liveness answers while the encoder loads, readiness waits for it
+    state.model_task = asyncio.create_task(keep_warming_up(state))
+    start_exporter()
+
+
+async def on_shutdown(app):
+    app[state_key].shutting_down = True
+    app[state_key].shutdown_deadline = time.monotonic() + SERVICE_SHUTDOWN_TIMEOUT
+    print_log("Shutting down, no new answers are accepted")
+
+
+async def on_cleanup(app):
+    state = app[state_key]
+    deadline = state.shutdown_deadline or time.monotonic() + SERVICE_SHUTDOWN_TIMEOUT
+    if state.model_task is not None and not state.model_task.done():
+        # Stops the retry loop, a load already running in its thread is left to finish
+        state.model_task.cancel()
+    if state.judge_tasks:
+        # Whatever the in-flight requests left of the budget, minus the time kept for cancelling
+        judge_timeout = max(0.0, deadline - SERVICE_CANCEL_TIMEOUT - time.monotonic())
+        print_log(f"Waiting up to {judge_timeout:.1f}s for {len(state.judge_tasks)} relevance evaluations")
+        pending = set(state.judge_tasks)
+        if judge_timeout > 0:
+            _, pending = await asyncio.wait(pending, timeout=judge_timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            # Let the cancelled evaluations mark their rows UNKNOWN before the pool closes
+            _, unfinished = await asyncio.wait(pending, timeout=max(0.1, deadline - time.monotonic()))
+            if unfinished:
+                print_log(f"{len(unfinished)} cancelled evaluations did not finish, their rows stay PENDING")
+    await state.es.close()
+    await state.groq.close()
+    await db_async.close_pool()
+
+
+def create_app():
+    app = web.Application(middlewares=[limit_in_flight])
+    app[state_key] = ServiceState()
+    app.add_routes([
+        web.post("/answer", answer),
+        web.post("/answer/stream", answer_stream),
+        web.post("/feedback", feedback),
+        web.get("/conversations/recent", recent_conversations),
+        web.get("/feedback/stats", feedback_stats),
+        web.get("/healthz", healthz),
+        web.get("/readyz", readyz),
+    ])
+    app.on_startup.append(on_startup)
+    app.on_shutdown.append(on_shutdown)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Async HTTP answer service")
+    parser.add_argument("--host", default=SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    # In-flight requests get the budget minus the time kept for cancelling judge calls
+    web.run_app(
+        create_app(), host=args.host, port=args.port, shutdown_timeout=SERVICE_SHUTDOWN_TIMEOUT - SERVICE_CANCEL_TIMEOUT
+    )
@@ -0,0 +1,73 @@
+import os
+import json
+import time
+import random
+from types import SimpleNamespace
+
+from prompt_budget import count_tokens
+
+
+STUB_TIME_TO_FIRST_TOKEN = float(os.getenv("STUB_TIME_TO_FIRST_TOKEN", "0.3"))
+STUB_TOKENS_PER_SECOND = float(os.getenv("STUB_TOKENS_PER_SECOND", "400"))
+STUB_COMPLETION_TOKENS = int(os.getenv("STUB_COMPLETION_TOKENS", "200"))
+STUB_JITTER = float(os.getenv("STUB_JITTER", "0.2"))
+STUB_ERROR_RATE = float(os.getenv("STUB_ERROR_RATE", "0"))
+
+STUB_VERDICT = json.dumps({"Relevance": "RELEVANT", "Explanation": "Stub judge verdict"})
+
+
+class StubLLMError(RuntimeError):
+    pass
+
+
+class StubGroq:
+    """ Stand-in for groq.Groq with the same chat.completions.create call and a configurable speed
+
+    Each call sleeps for the time to first token plus completion_tokens / tokens_per_second,
+    both scaled by up to +-jitter, and fails with probability error_rate. Judge prompts get
+    a parsable verdict, everything else filler text of completion_tokens tokens.
+    """
+
+    def __init__(self, time_to_first_token=STUB_TIME_TO_FIRST_TOKEN, tokens_per_second=STUB_TOKENS_PER_SECOND,
+                 completion_tokens=STUB_COMPLETION_TOKENS, jitter=STUB_JITTER, error_rate=STUB_ERROR_RATE):
+        self.time_to_first_token = time_to_first_token
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def _scale(self):
+        return max(0.0, 1 + random.uniform(-self.jitter, self.jitter))
+
+    def create(self, model, messages, stream=False, **kwargs):
+        prompt = "".join(message["content"] for message in messages)
+        if random.random() < self.error_rate:
+            time.sleep(self.time_to_first_token * self._scale())
+            raise StubLLMError(f"Stub {model} call failed")
+
+        if "Generated Answer:" in prompt:
+            parts = [STUB_VERDICT]
+        else:
+            parts = ["lorem "] * self.completion_tokens
+        usage = SimpleNamespace(
+            prompt_tokens=count_tokens(prompt),
+            completion_tokens=len(parts),
+            total_tokens=count_tokens(prompt) + len(parts),
+        )
+        if stream:
+            return self._stream(parts, usage)
+
+        time.sleep((self.time_to_first_token + len(parts) / self.tokens_per_second) * self._scale())
+        message = SimpleNamespace(content="".join(parts))
+        return SimpleNamespace(choices=[SimpleNamespace(message=message)], usage=usage)
+
+    def _stream(self, parts, usage):
+        time.sleep(self.time_to_first_token * self._scale())
+        token_time = self._scale() / self.tokens_per_second
+        for i, part in enumerate(parts):
+            if i:
+                time.sleep(token_time)
+            yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=part))], x_groq=None)
+        # Groq reports usage on the last chunk
+        yield SimpleNamespace(choices=[], x_groq=SimpleNamespace(usage=usage))
@@ -0,0 +1,115 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "true").lower() == "true"
+# Serve per-stage histograms on this port, 0 disables the exporter
+PROMETHEUS_PORT = int(os.getenv("PROMETHEUS_PORT", "0"))
+
+_current_trace = ContextVar("current_trace", default=None)
+_current_span = ContextVar("current_span", default=None)
+
+_exporter = {'histogram': None}
+_exporter_lock = threading.Lock()
+
+
+class Trace:
+    """ Seconds spent per stage, nested stages are named parent.child """
+
+    def __init__(self):
+        self.timings = {}
+
+    def record(self, name, seconds):
+        # A stage entered more than once (e.g. several searches) adds up
+        self.timings[name] = round(self.timings.get(name, 0.0) + seconds, 6)
+
+
+@contextmanager
+def trace():
+    """ Collect the spans of one request, yields None when tracing is disabled """
+    if not TRACING_ENABLED:
+        yield None
+        return
+    current = Trace()
+    # set() rather than reset(tokens), a streaming generator may be closed from another context
+    previous_trace, previous_span = _current_trace.get(), _current_span.get()
+    _current_trace.set(current)
+    _current_span.set(None)
+    try:
+        yield current
+    finally:
+        _current_trace.set(previous_trace)
+        _current_span.set(previous_span)
+        export(current)
+
+
+@contextmanager
+def span(name):
+    """ Time a stage of the current trace, a no-op outside of one """
+    current = _current_trace.get()
+    if current is None:
+        yield
+        return
+    parent = _current_span.get()
+    path = f"{parent}.{name}" if parent else name
+    _current_span.set(path)
+    start_time = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        # The innermost span an error passed through, see failed_stage
+        if not hasattr(e, "trace_stage"):
+            try:
+                e.trace_stage = path
+            except AttributeError:
+                pass
+        raise
+    finally:
+        current.record(path, time.perf_counter() - start_time)
+        _current_span.set(parent)
+
+
+def record(name, seconds):
+    """ Add a duration measured elsewhere (e.g. time to first token) to the current trace """
+    current = _current_trace.get()
+    if current is not None:
+        parent = _current_span.get()
+        current.record(f"{parent}.{name}" if parent else name, seconds)
+
+
+def failed_stage(error):
+    """ Stage in which a traced call raised error, None if it was raised outside any span """
+    return getattr(error, "trace_stage", None)
+
+
+def start_exporter(port=PROMETHEUS_PORT):
+    """ Expose rag_stage_duration_seconds{stage} for Prometheus, once per process """
+    if not port:
+        return False
+    with _exporter_lock:
+        if _exporter['histogram'] is not None:
+            return True
+        try:
+            from prometheus_client import Histogram, start_http_server
+        except ImportError:
+            print("prometheus_client is not installed, stage metrics are not exported")
+            return False
+        histogram = Histogram(
+            "rag_stage_duration_seconds", "Time spent per RAG pipeline stage", ["stage"],
+            buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+        )
+        start_http_server(port)
+        _exporter['histogram'] = histogram
+        print(f"Exporting stage metrics on port {port}")
+        return True
+
+
+def export(current):
+    histogram = _exporter['histogram']
+    if histogram is None:
+        return
+    for stage, seconds in current.timings.items():
+        histogram.labels(stage=stage).observe(seconds)
@@ -0,0 +1,87 @@
+import os
+import json
+import threading
+
+import numpy as np
+
+from vector_store import VECTOR_DATA_PATH, VECTOR_STORE_PATH, VectorStore, load_pickled_vectors
+
+
+SOURCE_FIELDS = ["group", "context", "question", "answer", "id"]
+
+
+class NumpyVectorIndex:
+    """ Exact cosine search over one L2-normalized float32 matrix per group """
+
+    def __init__(self, documents, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if len(documents) != len(vectors):
+            raise ValueError(f"Got {len(documents)} documents but {len(vectors)} vectors")
+
+        self.documents = [{field: doc.get(field) for field in SOURCE_FIELDS} for doc in documents]
+        groups = np.array([doc["group"] for doc in documents])
+        self.partitions = {}
+        for group in np.unique(groups):
+            rows = np.flatnonzero(groups == group)
+            matrix = np.ascontiguousarray(vectors[rows])
+            matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+            self.partitions[str(group)] = (rows, matrix)
+
+    def search_batch(self, vectors, groups, k=5):
+        queries = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+        groups = np.asarray(groups)
+        results = [[] for _ in range(len(queries))]
+
+        # One matmul per group for all queries that target it
+        for group in np.unique(groups):
+            if str(group) not in self.partitions:
+                continue
+            rows, matrix = self.partitions[str(group)]
+            query_rows = np.flatnonzero(groups == group)
+            scores = queries[query_rows] @ matrix.T
+            top_k = min(k, matrix.shape[0])
+            top = np.argpartition(-scores, top_k - 1, axis=1)[:, :top_k]
+            top_scores = np.take_along_axis(scores, top, axis=1)
+            top = np.take_along_axis(top, np.argsort(-top_scores, axis=1), axis=1)
+            for query_row, doc_rows in zip(query_rows, top):
+                results[query_row] = [self.documents[rows[i]] for i in doc_rows]
+        return results
+
+    def search(self, vector, group, k=5):
+        return self.search_batch([vector], [group], k)[0]
+
+
+_indexes = {}
+_lock = threading.Lock()
+
+
+def load_documents(path=VECTOR_DATA_PATH):
+    with open(f"{path}/documents-with-ids.json", 'rt', encoding='utf-8') as f_in:
+        return json.load(f_in)
+
+
+def load_field_vectors(field, documents, path=VECTOR_DATA_PATH):
+    if not os.path.exists(f"{VECTOR_STORE_PATH}/manifest.json"):
+        print(f"No vector store at {VECTOR_STORE_PATH}, falling back to pickles")
+        return load_pickled_vectors(field, path)
+
+    store = VectorStore(VECTOR_STORE_PATH)
+    vectors = store.open_field(field)
+    if store.ids == [str(doc["id"]) for doc in documents]:
+        return vectors
+    return vectors[[store.row_of(str(doc["id"])) for doc in documents]]
+
+
+def get_numpy_index(field):
+    with _lock:
+        if field not in _indexes:
+            print(f"Loading {field} vectors into memory...")
+            documents = load_documents()
+            _indexes[field] = NumpyVectorIndex(documents, load_field_vectors(field, documents))
+        return _indexes[field]
+
+
+def numpy_search_knn(field, vector, group, index_name=None, k=5):
+    """ Drop-in replacement for assistant.elastic_search_knn, index_name is ignored """
+    return get_numpy_index(field).search(vector, group, k)
@@ -0,0 +1,160 @@
+import os
+import json
+import pickle
+import struct
+import argparse
+
+import numpy as np
+
+
+VECTOR_DATA_PATH = os.getenv("VECTOR_DATA_PATH", "../data/vietnamese_rag")
+VECTOR_STORE_PATH = os.getenv("VECTOR_STORE_PATH", f"{VECTOR_DATA_PATH}/vector_store")
+
+FIELDS = ["question_vector", "context_vector", "answer_vector", "question_context_answer_vector"]
+
+# Fixed-size .npy header so the shape can be rewritten in place when rows are appended
+HEADER_SIZE = 128
+
+
+def _write_npy_header(f_out, dtype, shape):
+    header = repr({
+        "descr": np.lib.format.dtype_to_descr(np.dtype(dtype)),
+        "fortran_order": False,
+        "shape": tuple(shape),
+    })
+    prefix = b"\x93NUMPY\x01\x00"
+    header = header + " " * (HEADER_SIZE - len(prefix) - 2 - len(header) - 1) + "\n"
+    f_out.seek(0)
+    f_out.write(prefix + struct.pack("<H", len(header)) + header.encode("latin1"))
+
+
+def _read_npy_header(f_in):
+    f_in.seek(0)
+    np.lib.format.read_magic(f_in)
+    shape, _, dtype = np.lib.format.read_array_header_1_0(f_in)
+    if f_in.tell() != HEADER_SIZE:
+        raise ValueError(f"{f_in.name} was not written by vector_store and cannot be appended to")
+    return shape, dtype
+
+
+def _write_json(path, data):
+    # Write then rename so readers never see a half-written manifest
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wt', encoding='utf-8') as f_out:
+        json.dump(data, f_out, indent=2)
+    os.replace(tmp_path, path)
+
+
+class VectorStore:
+    """ One contiguous .npy per field, an ids.txt row mapping and a manifest.json
+
+    The manifest is written last, so its count is the number of complete rows.
+    """
+
+    def __init__(self, path=VECTOR_STORE_PATH):
+        self.path = path
+        with open(f"{path}/manifest.json", 'rt', encoding='utf-8') as f_in:
+            self.manifest = json.load(f_in)
+        with open(f"{path}/ids.txt", 'rt', encoding='utf-8') as f_in:
+            self.ids = [line.rstrip("\n") for _, line in zip(range(self.count), f_in)]
+        self._rows = None
+
+    @classmethod
+    def create(cls, path, model_name, dims, fields=FIELDS, dtype="float32"):
+        os.makedirs(path, exist_ok=True)
+        for field in fields:
+            with open(f"{path}/{field}.npy", 'wb') as f_out:
+                _write_npy_header(f_out, dtype, (0, dims))
+        open(f"{path}/ids.txt", 'wt', encoding='utf-8').close()
+        _write_json(f"{path}/manifest.json", {
+            "model_name": model_name,
+            "dims": dims,
+            "dtype": np.dtype(dtype).name,
+            "count": 0,
+            "fields": list(fields),
+        })
+        return cls(path)
+
+    @property
+    def count(self):
+        return self.manifest["count"]
+
+    @property
+    def fields(self):
+        return self.manifest["fields"]
+
+    def row_of(self, doc_id):
+        if self._rows is None:
+            self._rows = {doc_id: row for row, doc_id in enumerate(self.ids)}
+        return self._rows[doc_id]
+
+    def open_field(self, field):
+        """ Zero-copy, read-only view of a field's vectors """
+        if field not in self.fields:
+            raise KeyError(f"Field {field} is not in the vector store at {self.path}")
+        return np.load(f"{self.path}/{field}.npy", mmap_mode='r')[:self.count]
+
+    def append(self, ids, vectors):
+        """ Append rows for ids, vectors maps every field of the store to an (n, dims) array """
+        ids = [str(doc_id) for doc_id in ids]
+        if set(vectors) != set(self.fields):
+            raise ValueError(f"Expected vectors for {self.fields}, got {sorted(vectors)}")
+        for field in self.fields:
+            field_vectors = np.asarray(vectors[field])
+            if field_vectors.shape != (len(ids), self.manifest["dims"]):
+                raise ValueError(f"{field} has shape {field_vectors.shape}, expected {(len(ids), self.manifest['dims'])}")
+
+        for field in self.fields:
+            with open(f"{self.path}/{field}.npy", 'r+b') as f_out:
+                _, dtype = _read_npy_header(f_out)
+                # Drop rows left over from an append that never reached the manifest
+                f_out.truncate(HEADER_SIZE + self.count * self.manifest["dims"] * dtype.itemsize)
+                f_out.seek(0, os.SEEK_END)
+                f_out.write(np.ascontiguousarray(vectors[field], dtype=dtype).tobytes())
+                _write_npy_header(f_out, dtype, (self.count + len(ids), self.manifest["dims"]))
+
+        with open(f"{self.path}/ids.txt", 'wt', encoding='utf-8') as f_out:
+            f_out.writelines(f"{doc_id}\n" for doc_id in self.ids + ids)
+        self.ids = self.ids + ids
+        self._rows = None
+        self.manifest["count"] = len(self.ids)
+        _write_json(f"{self.path}/manifest.json", self.manifest)
+
+
+def load_pickled_vectors(field, path=VECTOR_DATA_PATH):
+    with open(f"{path}/{field}_pickle/{field}.pkl", 'rb') as file:
+        vector_list = pickle.load(file)
+    return np.stack([item[field] for item in vector_list])
+
+
+def convert_pickles(out_path, model_name, fields=FIELDS, dtype="float32", path=VECTOR_DATA_PATH):
+    """ Build a vector store from the {field}_pickle/{field}.pkl files of the embedding notebook """
+    with open(f"{path}/documents-with-ids.json", 'rt', encoding='utf-8') as f_in:
+        ids = [doc["id"] for doc in json.load(f_in)]
+
+    vectors = {}
+    for field in fields:
+        print(f"Loading {field}...")
+        vectors[field] = load_pickled_vectors(field, path)
+        if len(vectors[field]) != len(ids):
+            raise ValueError(f"{field} has {len(vectors[field])} vectors for {len(ids)} documents")
+
+    dims = next(iter(vectors.values())).shape[1]
+    store = VectorStore.create(out_path, model_name, dims, fields, dtype)
+    store.append(ids, vectors)
+    print(f"Wrote {store.count} rows of {', '.join(fields)} to {out_path}")
+    return store
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert pickled vector lists to a memory-mapped vector store")
+    parser.add_argument("--out", default=VECTOR_STORE_PATH)
+    parser.add_argument("--model", default="paraphrase-multilingual-MiniLM-L12-v2", help="model that produced the pickles")
+    parser.add_argument("--fields", nargs="+", default=FIELDS)
+    parser.add_argument("--float16", action="store_true", help="store vectors as float16")
+    args = parser.parse_args()
+    convert_pickles(args.out, args.model, args.fields, "float16" if args.float16 else "float32")
+
+
+if __name__ == "__main__":
+    main()